@@ -43,6 +43,13 @@ def main(default_role=None):
     parser.add_option("-j", "--journaldir", action="store", dest="journaldir", help="Path to the job journal directory (for masters)", metavar="PATH", default=None)
     parser.add_option("-b", "--blockstore", action="store", dest="blockstore", help="Path to the block store directory", metavar="PATH", default=None)
     parser.add_option("-H", "--hostname", action="store", dest="hostname", help="Hostname the master and other workers should use to contact this host", default=None)
+    parser.add_option("-t", "--slots", action="store", dest="slots", help="Number of tasks to run concurrently (for workers)", metavar="N", type="int", default=None)
+    parser.add_option("-P", "--prefetch", action="store", dest="prefetch", help="Number of tasks to queue in addition to the running tasks (for workers)", metavar="N", type="int", default=None)
+    parser.add_option("-O", "--object-cache-size", action="store", dest="object_cache_size", help="Megabytes of memory used to cache decoded objects (for workers)", metavar="MB", type="int", default=None)
+    parser.add_option("-G", "--gc-watermark", action="store", dest="gc_watermark", help="Percentage of disk usage above which unneeded blocks are deleted (for workers)", metavar="PERCENT", type="int", default=None)
+    parser.add_option("-B", "--block-server-port", action="store", dest="block_server_port", help="Port from which committed blocks are served (for workers; default is any free port)", metavar="PORT", type="int", default=None)
+    parser.add_option("-D", "--locality-delay", action="store", dest="locality_delay", help="Seconds that a task will wait for a worker holding its inputs (for masters)", metavar="SECS", type="float", default=None)
+    parser.add_option("-C", "--checkpoint-records", action="store", dest="checkpoint_records", help="Number of journal records after which a job is checkpointed (for masters)", metavar="N", type="int", default=None)
     parser.add_option("-l", "--lib", action="store", dest="lib", help="Path to standard library of Skywriting scripts (for workers)", metavar="PATH", default=os.path.join(os.path.dirname(__file__), '../../sw/stdlib'))
     (options, _) = parser.parse_args()
    
@@ -12,7 +12,7 @@
 # ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 from __future__ import with_statement
-from threading import Lock
+from threading import Lock, Condition
 from urllib2 import URLError, HTTPError
 from skywriting.runtime.exceptions import ExecutionInterruption,\
     MissingInputException, RuntimeSkywritingError
@@ -29,10 +29,13 @@ import logging
 import pycurl
 import select
 import fcntl
+import threading
 import re
+import time
 from datetime import datetime, timedelta
 from cStringIO import StringIO
-from errno import EAGAIN, EPIPE, ENXIO
+from collections import deque
+from errno import EAGAIN, EPIPE, ENXIO, EINTR
 
 # XXX: Hack because urlparse doesn't nicely support custom schemes.
 import urlparse
@@ -41,7 +44,8 @@ from skywriting.runtime.references import SWRealReference,\
     build_reference_from_tuple, SW2_ConcreteReference, SWDataValue,\
     SWErrorReference, SWNullReference, SWURLReference, \
     SWTaskOutputProvenance, SW2_StreamReference,\
-    SW2_TombstoneReference
+    SW2_TombstoneReference, SW2_SliceReference
+from skywriting.runtime.cache import LRUCache
 import hashlib
 import contextlib
 from skywriting.lang.parser import CloudScriptParser
@@ -49,7 +53,117 @@ urlparse.uses_netloc.append("swbs")
 
 BLOCK_LIST_RECORD_STRUCT = struct.Struct("!120pQ")
 
+# The block log records every block that is added to ('A') or removed from
+# ('D') the block store. The generation of the block store is the number of
+# records in the log, so a master that has seen the blocks up to a given
+# generation need only fetch the subsequent records.
+BLOCK_LOG_RECORD_STRUCT = struct.Struct("!c120pQ")
+BLOCK_ADDED = 'A'
+BLOCK_REMOVED = 'D'
+
+# A replica is a copy of a block that was fetched from another block store,
+# and so it may be evicted if the disk is full.
+BLOCK_REPLICA_ADDED = 'C'
+
+# The content hash index records the SHA-1 hash of each block's contents, so
+# that a block with the same contents as an existing block can be stored as a
+# hard link to it, and a fetch can be skipped if we already hold the contents.
+BLOCK_HASH_RECORD_STRUCT = struct.Struct("!120p20s")
+
+# The default budgets for the decoded-object and URL caches, in bytes.
+DEFAULT_OBJECT_CACHE_BYTES = 64 * 1048576
+DEFAULT_URL_CACHE_BYTES = 1024 * 1048576
+
+class ObjectCacheMiss:
+    pass
+OBJECT_CACHE_MISS = ObjectCacheMiss()
+
+# The block log is rewritten on start-up if it contains more than this many
+# records in addition to twice the number of blocks.
+BLOCK_LOG_COMPACTION_THRESHOLD = 65536
+
+# Blocks are stored in 256 subdirectories of the block store, named by the
+# first two hex digits of the MD5 hash of the block ID.
+BLOCK_SHARD_NAMES = ['%02x' % i for i in range(256)]
+
+def get_block_shard_name(id):
+    return hashlib.md5(id).hexdigest()[:2]
+
+def read_block_records(file, record_struct=BLOCK_LOG_RECORD_STRUCT, chunk_size=1048576):
+    """
+    Yields the records in the given block log (or block list) file, ignoring
+    a partially-written record at the end.
+    """
+    leftover = ''
+    while True:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            break
+        if len(leftover) > 0:
+            chunk = leftover + chunk
+        end = len(chunk) - (len(chunk) % record_struct.size)
+        for offset in xrange(0, end, record_struct.size):
+            yield record_struct.unpack_from(chunk, offset)
+        leftover = chunk[end:]
+
+def hash_file(filename, chunk_size=1048576):
+    hash = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            hash.update(chunk)
+    return hash.digest()
+
+class HashingFile:
+    """
+    Wraps a file that is open for writing, and computes the SHA-1 hash of the
+    data that is written to it.
+    """
+    
+    def __init__(self, file):
+        self.file = file
+        self.hash = hashlib.sha1()
+        
+    def write(self, data):
+        self.hash.update(data)
+        self.file.write(data)
+        
+    def flush(self):
+        self.file.flush()
+        
+    def tell(self):
+        return self.file.tell()
+    
+    def digest(self):
+        return self.hash.digest()
+
+# Blocks that are at least this large, and that have more than one replica,
+# are fetched in stripes from all of the replicas at once. The size of each
+# stripe is chosen so that it takes about STRIPE_TARGET_SECONDS to fetch from
+# its replica.
+STRIPED_FETCH_THRESHOLD = 32 * 1048576
+INITIAL_STRIPE_SIZE = 4 * 1048576
+MIN_STRIPE_SIZE = 1048576
+MAX_STRIPE_SIZE = 64 * 1048576
+STRIPE_TARGET_SECONDS = 2.0
+
+# Blocks of at most BATCH_FETCH_THRESHOLD bytes are fetched with a single
+# request to each peer that holds at least BATCH_FETCH_MIN_BLOCKS of them. In
+# the response, each block is preceded by a record of its ID and size (or -1
+# if the peer does not have the block).
+BATCH_FETCH_THRESHOLD = 1048576
+BATCH_FETCH_MIN_BLOCKS = 2
+BATCH_RECORD_STRUCT = struct.Struct("!120pq")
+
+# A streaming fetch buffers at most this much data that the consumer has not
+# yet read from its FIFO, before pausing the transfer. The transfer resumes
+# when the buffer drains below half of this size.
+STREAM_BUFFER_BYTES = 1048576
+
 length_regex = re.compile("^Content-Length:\s*([0-9]+)")
+content_range_regex = re.compile("^Content-Range:\s*bytes\s+([0-9]+)-([0-9]+)/([0-9]+)", re.IGNORECASE)
 
 class StreamRetry:
     pass
@@ -80,60 +194,270 @@ def sw_to_external_url(url):
     else:
         return url
 
-class TransferSetContext:
-    def __init__(self):
+class TransferEngine:
+    """
+    Performs the HTTP transfers for every fetch in this process, using a
+    single CurlMulti that is driven by a single thread. Idle curl handles are
+    pooled for each peer, so that their connections are kept alive and reused
+    by subsequent fetches. Any thread may start a fetch by creating transfer
+    contexts in a TransferSetContext, and then waits for the whole set to
+    complete in transfer_all().
+    """
+
+    def __init__(self, max_connections=100, max_idle_handles_per_peer=8):
         self.curl_ctx = pycurl.CurlMulti()
         self.curl_ctx.setopt(pycurl.M_PIPELINING, 0)
-        self.curl_ctx.setopt(pycurl.M_MAXCONNECTS, 20)
+        self.curl_ctx.setopt(pycurl.M_MAXCONNECTS, max_connections)
+        self.max_idle_handles_per_peer = max_idle_handles_per_peer
         self.active_handles = 0
-        self._handles = []
+        
+        # Mapping from netloc to a list of idle curl handles.
+        self.idle_handles = {}
+        
+        # Transfer sets that have outstanding transfers. N.B. This, and the
+        # CurlMulti, must only be used in the engine thread.
+        self.transfer_sets = []
+        
+        self._lock = Lock()
+        self.pending_actions = []
+        self.wakeup_read = None
+        self.wakeup_write = None
+        self.thread = None
+        self.is_running = False
 
-    def start_fetch(self, ctx):
+    def start(self):
+        with self._lock:
+            if self.is_running:
+                return
+            self.wakeup_read, self.wakeup_write = os.pipe()
+            for fd in (self.wakeup_read, self.wakeup_write):
+                fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            self.is_running = True
+            self.thread = threading.Thread(target=self.thread_main, name='TransferEngine')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        with self._lock:
+            if not self.is_running:
+                return
+            self.is_running = False
+        self.wake_up()
+        if threading.currentThread() is not self.thread:
+            self.thread.join()
+
+    def run_in_engine_thread(self, action):
+        if threading.currentThread() is self.thread:
+            action()
+        else:
+            self.start()
+            with self._lock:
+                self.pending_actions.append(action)
+            self.wake_up()
+
+    def wake_up(self):
+        try:
+            os.write(self.wakeup_write, 'X')
+        except OSError, e:
+            # If the pipe is full, the engine thread will wake up anyway.
+            if e.errno != EAGAIN:
+                raise
+
+    def acquire_handle(self, url):
+        netloc = urlparse.urlparse(url).netloc
+        try:
+            curl_ctx = self.idle_handles[netloc].pop()
+        except (KeyError, IndexError):
+            curl_ctx = pycurl.Curl()
+            curl_ctx.setopt(pycurl.FOLLOWLOCATION, 1)
+            curl_ctx.setopt(pycurl.MAXREDIRS, 5)
+            curl_ctx.setopt(pycurl.CONNECTTIMEOUT, 30)
+            curl_ctx.setopt(pycurl.NOSIGNAL, 1)
+            # Abort a transfer that stalls (unless we have paused it).
+            curl_ctx.setopt(pycurl.LOW_SPEED_LIMIT, 1)
+            curl_ctx.setopt(pycurl.LOW_SPEED_TIME, 60)
+        curl_ctx.netloc = netloc
+        return curl_ctx
+
+    def release_handle(self, curl_ctx, is_reusable=True):
+        curl_ctx.ctx = None
+        if is_reusable:
+            idle_handles = self.idle_handles.setdefault(curl_ctx.netloc, [])
+            if len(idle_handles) < self.max_idle_handles_per_peer:
+                idle_handles.append(curl_ctx)
+                return
+        curl_ctx.close()
+
+    def add_handle(self, curl_ctx, transfer_set):
+        self.register_transfer_set(transfer_set)
         self.active_handles += 1
-        self.curl_ctx.add_handle(ctx.curl_ctx)
-        self._handles.append(ctx)
+        self.curl_ctx.add_handle(curl_ctx)
 
-    def process(self):
+    def remove_handle(self, curl_ctx):
+        self.active_handles -= 1
+        self.curl_ctx.remove_handle(curl_ctx)
+
+    def register_transfer_set(self, transfer_set):
+        if not transfer_set.is_registered:
+            transfer_set.is_registered = True
+            self.transfer_sets.append(transfer_set)
+
+    def thread_main(self):
+        while self.is_running:
+            with self._lock:
+                actions = self.pending_actions
+                self.pending_actions = []
+            for action in actions:
+                try:
+                    action()
+                except:
+                    cherrypy.log.error('Error starting transfer', 'CURL_FETCH', logging.ERROR, True)
+
+            try:
+                self.process()
+            except:
+                cherrypy.log.error('Error processing transfers', 'CURL_FETCH', logging.ERROR, True)
 
+            for transfer_set in self.transfer_sets[:]:
+                if transfer_set.is_complete():
+                    self.transfer_sets.remove(transfer_set)
+                    transfer_set.is_registered = False
+                    transfer_set.completed()
+
+            self.select()
+
+    def process(self):
         while 1:
-            go_again = False
-            while 1:
-                # Will generate write_data callbacks as appropriate
-                ret, num_handles = self.curl_ctx.perform()
-                if ret != pycurl.E_CALL_MULTI_PERFORM:
-                    break
-            while 1:
-                num_q, ok_list, err_list = self.curl_ctx.info_read()
-                if len(ok_list) != 0 or len(err_list) != 0:
-                    # We'll be making callbacks, which might schedule more work.
-                    # We should try processing again afterwards;
-                    # worst that happens, perform() will return OK right away and we'll drop out.
+            go_again = self.perform()
+            for transfer_set in self.transfer_sets:
+                if transfer_set.process():
                     go_again = True
-                for c in ok_list:
-                    self.curl_ctx.remove_handle(c)
-                    self.active_handles -= 1
-                    c.ctx._success()
-                for c, errno, errmsg in err_list:
-                    self.curl_ctx.remove_handle(c)
-                    self.active_handles -= 1
-                    cherrypy.log.error("Curl failure: %s, %s" % (str(errno), str(errmsg)), "CURL_FETCH", logging.INFO)
-                    c.ctx._failure(errno, errmsg)
-                if num_q == 0:
-                    break
             if not go_again:
                 break
 
+    def perform(self):
+        go_again = False
+        while 1:
+            # Will generate write_data callbacks as appropriate
+            ret, num_handles = self.curl_ctx.perform()
+            if ret != pycurl.E_CALL_MULTI_PERFORM:
+                break
+        while 1:
+            num_q, ok_list, err_list = self.curl_ctx.info_read()
+            if len(ok_list) != 0 or len(err_list) != 0:
+                # We'll be making callbacks, which might schedule more work.
+                # We should try processing again afterwards;
+                # worst that happens, perform() will return OK right away and we'll drop out.
+                go_again = True
+            for c in ok_list:
+                self.remove_handle(c)
+                self.dispatch(c.ctx, c.ctx._success)
+            for c, errno, errmsg in err_list:
+                self.remove_handle(c)
+                cherrypy.log.error("Curl failure: %s, %s" % (str(errno), str(errmsg)), "CURL_FETCH", logging.INFO)
+                self.dispatch(c.ctx, c.ctx._failure, errno, errmsg)
+            if num_q == 0:
+                break
+        return go_again
+
+    def dispatch(self, ctx, callback, *args):
+        try:
+            callback(*args)
+        except:
+            # A failed callback must not stop the other transfers, or leave
+            # the caller waiting forever.
+            cherrypy.log.error('Error in transfer callback', 'CURL_FETCH', logging.ERROR, True)
+            ctx.has_completed = True
+            ctx.has_succeeded = False
+
+    def select(self):
+        read, write, exn = self.curl_ctx.fdset()
+        if self.active_handles > 0 and len(read) + len(write) + len(exn) == 0:
+            # cURL is busy (e.g. resolving a hostname) but has no sockets yet.
+            timeout = 0.01
+        else:
+            timeout = 1.0
+        read.append(self.wakeup_read)
+        for transfer_set in self.transfer_sets:
+            set_read, set_write, set_timeout = transfer_set.get_select_args()
+            read.extend(set_read)
+            write.extend(set_write)
+            if set_timeout is not None:
+                timeout = max(0.0, min(timeout, set_timeout))
+        try:
+            read_ret, _, _ = select.select(read, write, exn, timeout)
+        except select.error, e:
+            if e[0] == EINTR:
+                return
+            raise
+        if self.wakeup_read in read_ret:
+            drain_pipe(self.wakeup_read)
+        for transfer_set in self.transfer_sets:
+            transfer_set.handle_readable(read_ret)
+
+def drain_pipe(pipefd):
+    oldflags = fcntl.fcntl(pipefd, fcntl.F_GETFL)
+    newflags = oldflags | os.O_NONBLOCK
+    fcntl.fcntl(pipefd, fcntl.F_SETFL, newflags)
+    try:
+        while(os.read(pipefd, 1024) >= 0):
+            pass
+    except OSError, e:
+        if e.errno == EAGAIN:
+            return
+        else:
+            raise
+
+class TransferSetContext:
+    def __init__(self, engine):
+        self.engine = engine
+        self.handles = []
+        self.is_registered = False
+        self.is_sealed = False
+        self._completed = threading.Event()
+
+    def add_context(self, ctx):
+        # Called in the engine thread when the context starts its first fetch.
+        self.handles.append(ctx)
+
+    def is_complete(self):
+        if not self.is_sealed:
+            return False
+        for handle in self.handles:
+            if not handle.has_completed:
+                return False
+        return True
+
+    def completed(self):
+        self._completed.set()
+
+    def process(self):
+        """Called in the engine thread; returns True if the engine should process again."""
+        return False
+
+    def get_select_args(self):
+        return [], [], None
+
+    def handle_readable(self, read_fds):
+        pass
+
+    def seal(self):
+        # No more contexts will be added, so the set may now complete.
+        self.is_sealed = True
+        self.engine.register_transfer_set(self)
+
     def transfer_all(self):
-        while self.active_handles > 0:
-            self.process()
-            self.curl_ctx.select(5.0)
+        # N.B. The engine thread runs actions in order, so every transfer in
+        #      this set will have started before it is sealed.
+        self.engine.run_in_engine_thread(self.seal)
+        self._completed.wait()
 
     def cleanup(self):
-        self.curl_ctx.close()
+        pass
 
     def get_failed_refs(self):
         failure_bindings = {}
-        for handle in self._handles:
+        for handle in self.handles:
             if not handle.has_succeeded:
                 failure_bindings[handle.ref.id] = SW2_TombstoneReference(handle.ref.id, handle.ref.location_hints)
         if len(failure_bindings) > 0:
@@ -142,218 +466,750 @@ class TransferSetContext:
             return None
 
 class StreamTransferSetContext(TransferSetContext):
-    def __init__(self):
-        TransferSetContext.__init__(self)
-        self.handles = []
-
-    def writable_handles(self):
-        return filter(lambda x: (not x.has_completed) and len(x.mem_buffer) > 0, self.handles)
-
-    def write_waitable_handles(self):
-        return filter(lambda x: (not x.has_completed) and len(x.mem_buffer) > 0 and x.fifo_fd != -1, self.handles)
-
-    def dormant_handles(self):
-        return filter(lambda x: x.dormant_until is not None, self.handles)
+    def __init__(self, engine):
+        TransferSetContext.__init__(self, engine)
+        self.death_pipe = None
+        
+        # The handles that have buffered data for an open FIFO, and the
+        # handles that are waiting to retry. The handles maintain these sets,
+        # so that we do not scan every handle on each iteration.
+        self.buffered_handles = set()
+        self.dormant_handles = set()
 
     def process(self):
-        while 1:
-            go_again = False
-            # go_again is set when cURL's handle-group might have changed, since the last perform(),
-            # so it's not safe to select() at this time.
-            TransferSetContext.process(self)
-            for handle in self.writable_handles():
-                if handle.try_empty_buffer():
-                    go_again = True
-            for handle in self.dormant_handles():
-                if datetime.now() > handle.dormant_until:
+        go_again = False
+        for handle in list(self.buffered_handles):
+            if handle.try_empty_buffer():
+                go_again = True
+        if len(self.dormant_handles) > 0:
+            now = datetime.now()
+            for handle in list(self.dormant_handles):
+                if now > handle.dormant_until:
                     handle.wake_up()
                     go_again = True
-            if not go_again:
-                return
+        return go_again
 
-    def drain_pipe(self, pipefd):
-        oldflags = fcntl.fcntl(pipefd, fcntl.F_GETFL)
-        newflags = oldflags | os.O_NONBLOCK
-        fcntl.fcntl(pipefd, fcntl.F_SETFL, newflags)
-        try:
-            while(os.read(pipefd, 1024) >= 0):
-                pass
-        except OSError, e:
-            if e.errno == EAGAIN:
-                return
-            else:
-                raise
+    def get_select_args(self):
 
-    def select(self, death_pipe):
-
-        shortest_timeout = 15.0
+        shortest_timeout = None
 
         def td_secs(td):
-            return (float(td.microseconds) / 10**6) + float(td.seconds)
+            return (float(td.microseconds) / 10**6) + float(td.seconds) + td.days * 86400
 
-        for handle in self.dormant_handles():
+        for handle in self.dormant_handles:
             time_to_wait = td_secs(handle.dormant_until - datetime.now())
-            if time_to_wait < shortest_timeout:
+            if shortest_timeout is None or time_to_wait < shortest_timeout:
                 shortest_timeout = time_to_wait
-        (read, write, exn) = self.curl_ctx.fdset()
-        for handle in self.write_waitable_handles():
-            write.append(handle.fifo_fd)
-        read.append(death_pipe)
-        read_ret, write_ret, exn_ret = select.select(read, write, exn, shortest_timeout)
-        if death_pipe in read_ret:
-            self.drain_pipe(death_pipe)
+        write = [handle.fifo_fd for handle in self.buffered_handles]
+        if self.death_pipe is not None:
+            read = [self.death_pipe]
+        else:
+            read = []
+        return read, write, shortest_timeout
+
+    def handle_readable(self, read_fds):
+        if self.death_pipe is not None and self.death_pipe in read_fds:
+            drain_pipe(self.death_pipe)
+            self.death_pipe = None
             cherrypy.log.error("Closing fetch FIFOs due to process death", 'CURL_FETCH', logging.INFO)
             for handle in self.handles:
                 handle.fifo_closed()
 
     def transfer_all(self, death_pipe):
-        while 1:
-            self.process()
-            remaining_transfers = filter(lambda x: not x.has_completed, self.handles)
-            if len(remaining_transfers) == 0:
-                cherrypy.log.error("All transfers complete", 'CURL_FETCH', logging.INFO)
-                return
-            self.select(death_pipe)
+        def seal():
+            self.death_pipe = death_pipe
+            self.seal()
+        self.engine.run_in_engine_thread(seal)
+        self._completed.wait()
+        cherrypy.log.error("All transfers complete", 'CURL_FETCH', logging.INFO)
 
     def cleanup(self, block_store):
         for handle in self.handles:
             handle.save_result(block_store)
             handle.cleanup()
         TransferSetContext.cleanup(self)
-        
-    def get_failed_refs(self):
-        failure_bindings = {}
-        for handle in self.handles:
-            if not handle.has_succeeded:
-                failure_bindings[handle.ref.id] = SW2_TombstoneReference(handle.ref.id, handle.ref.location_hints)
-        if len(failure_bindings) > 0:
-            return failure_bindings
-        else:
-            return None
 
 class TransferContext:
 
+    # The maximum time for a single transfer, in seconds (0 means no limit).
+    timeout = 300
+
+    # If set, the request is a POST with this body.
+    post_data = None
+
     def __init__(self, multi):
 
         self.multi = multi
-        self.curl_ctx = pycurl.Curl()
-        self.curl_ctx.setopt(pycurl.FOLLOWLOCATION, 1)
-        self.curl_ctx.setopt(pycurl.MAXREDIRS, 5)
-        self.curl_ctx.setopt(pycurl.CONNECTTIMEOUT, 30)
-        self.curl_ctx.setopt(pycurl.TIMEOUT, 300)
-        self.curl_ctx.setopt(pycurl.NOSIGNAL, 1)
-        self.curl_ctx.setopt(pycurl.WRITEFUNCTION, self.write_data)
-        self.curl_ctx.setopt(pycurl.HEADERFUNCTION, self.write_header_line)
-        self.curl_ctx.ctx = self
+        self.curl_ctx = None
         self.active = False
+        self.is_added = False
 
     def start_fetch(self, url, range=None):
+        # The transfer is started by the engine thread, because a CurlMulti
+        # may only be used by one thread.
+        engine = self.multi.engine
+        engine.run_in_engine_thread(lambda: engine.dispatch(self, self._start_fetch, url, range))
+
+    def _start_fetch(self, url, range):
         if self.active:
             raise Exception("Bad state: tried to start_fetch a curl context which was already active")
+        if not self.is_added:
+            self.is_added = True
+            self.multi.add_context(self)
         self.active = True
+        self.curl_ctx = self.multi.engine.acquire_handle(str(url))
         self.curl_ctx.setopt(pycurl.URL, str(url))
-        if range is not None:
+        self.curl_ctx.setopt(pycurl.TIMEOUT, self.timeout)
+        self.curl_ctx.setopt(pycurl.WRITEFUNCTION, self.write_data)
+        self.curl_ctx.setopt(pycurl.HEADERFUNCTION, self.write_header_line)
+        if self.post_data is not None:
+            # N.B. Do not wait for a 100 Continue response before sending the body.
+            self.curl_ctx.setopt(pycurl.POSTFIELDS, self.post_data)
+            self.curl_ctx.setopt(pycurl.HTTPHEADER, ["Content-Type: application/json", "Expect:"])
+        elif range is not None and range[1] is None:
+            self.curl_ctx.setopt(pycurl.HTTPHEADER, ["Range: bytes=%d-" % range[0]])
+        elif range is not None:
             self.curl_ctx.setopt(pycurl.HTTPHEADER, ["Range: bytes=%d-%d" % range])
-        self.multi.start_fetch(self)
+        else:
+            self.curl_ctx.setopt(pycurl.HTTPHEADER, [])
+        if self.post_data is None:
+            # The handle may previously have been used for a POST.
+            self.curl_ctx.setopt(pycurl.HTTPGET, 1)
+        self.curl_ctx.ctx = self
+        self.multi.engine.add_handle(self.curl_ctx, self.multi)
+
+    def _release_handle(self, is_reusable):
+        self.active = False
+        curl_ctx = self.curl_ctx
+        self.curl_ctx = None
+        self.multi.engine.release_handle(curl_ctx, is_reusable)
             
     def _success(self):
-        self.active = False
         response_code = self.curl_ctx.getinfo(pycurl.RESPONSE_CODE)
+        self._release_handle(True)
         if str(response_code).startswith("2"):
             self.success()
         else:
             self.failure(response_code, "")
 
     def _failure(self, errno, errmsg):
-        self.active = False
+        # The connection may be broken, so we do not reuse the handle.
+        self._release_handle(False)
         self.failure(errno, errmsg)
 
-    def cleanup(self):
-        self.curl_ctx.close()
-
-class BufferTransferContext(TransferContext):
+    def _cancel(self):
+        if self.active:
+            self.multi.engine.remove_handle(self.curl_ctx)
+            self._release_handle(False)
 
-    def __init__(self, urls, multi):
+    def cleanup(self):
+        if self.active:
+            self.multi.engine.run_in_engine_thread(self._cancel)
+
+class ResumableTransferContext(TransferContext):
+    """
+    Fetches a whole block (or the range of a block that a slice reference
+    names), failing over to the next URL if a fetch fails. The next fetch
+    resumes from the current offset with a Range request, and is checked
+    against the size of the block (and its content hash, if known).
+    Subclasses implement sink_write() and sink_reset().
+    """
+
+    def __init__(self, ref, urls, multi):
         TransferContext.__init__(self, multi)
-        self.buffer = StringIO()
+        self.ref = ref
         self.urls = urls
         self.failures = 0
         self.has_completed = False
         self.has_succeeded = False
-        self.start_fetch(self.urls[0])
+        
+        self.bytes_written = 0
+        self.total_size = getattr(ref, 'size_hint', None)
+        self.is_slice = isinstance(ref, SW2_SliceReference)
+        if self.is_slice:
+            self.offset = ref.start
+        else:
+            self.offset = 0
+        content_hash = getattr(ref, 'content_hash', None)
+        if content_hash is not None:
+            self.expected_digest = content_hash.decode('hex')
+            self.hash = hashlib.sha1()
+        else:
+            self.expected_digest = None
+            self.hash = None
+        self.reset_response()
 
-    def write_data(self, _str):
-        self.buffer.write(_str)
+    def reset_response(self):
+        self.response_status = None
+        self.response_range = None
+        self.response_length = None
+        self.skip_bytes = None
+
+    def start_next_fetch(self):
+        url = self.urls[self.failures]
+        if self.bytes_written > 0:
+            cherrypy.log.error('Resuming fetch from %s at offset %d' % (url, self.bytes_written), 'CURL_FETCH', logging.INFO)
+        if self.is_slice:
+            self.start_fetch(url, (self.offset + self.bytes_written, self.offset + self.total_size - 1))
+        elif self.bytes_written > 0:
+            self.start_fetch(url, (self.bytes_written, None))
+        else:
+            self.start_fetch(url)
 
     def write_header_line(self, _str):
-        pass
+        if _str.startswith('HTTP/'):
+            # N.B. There will be more than one status line if we are redirected.
+            self.reset_response()
+            self.response_status = _str.split()[1]
+        else:
+            match_obj = length_regex.match(_str)
+            if match_obj is not None:
+                self.response_length = int(match_obj.group(1))
+            match_obj = content_range_regex.match(_str)
+            if match_obj is not None:
+                self.response_range = int(match_obj.group(1)), int(match_obj.group(3))
+
+    def check_response(self):
+        """
+        Returns the number of bytes at the start of the response that we
+        already have, or None if the response does not match the data that
+        we have fetched so far.
+        """
+        if self.response_status == '206' and self.response_range is not None:
+            start, total = self.response_range
+            if start != self.offset + self.bytes_written:
+                return None
+            if not self.is_slice:
+                if self.total_size is not None and total != self.total_size:
+                    return None
+                self.total_size = total
+            return 0
+        elif self.response_status == '200' and self.offset == 0:
+            # The server ignored the Range header (or we did not send one),
+            # so we discard the data that we already have.
+            if self.response_length is not None:
+                if self.total_size is not None and self.response_length != self.total_size:
+                    return None
+                self.total_size = self.response_length
+            return self.bytes_written
+        return None
+
+    def write_data(self, _str):
+        if self.skip_bytes is None:
+            self.skip_bytes = self.check_response()
+            if self.skip_bytes is None:
+                cherrypy.log.error('Response from %s does not match the data fetched so far' % self.urls[self.failures], 'CURL_FETCH', logging.WARNING)
+                return 0
+        if self.skip_bytes > 0:
+            skipped = min(self.skip_bytes, len(_str))
+            self.skip_bytes -= skipped
+            _str = _str[skipped:]
+        if self.hash is not None:
+            self.hash.update(_str)
+        self.sink_write(_str)
+        self.bytes_written += len(_str)
 
     def success(self):
-        self.has_completed = True
-        self.has_succeeded = True
+        if self.total_size is not None and self.bytes_written != self.total_size:
+            cherrypy.log.error('Fetch from %s ended after %d of %d bytes' % (self.urls[self.failures], self.bytes_written, self.total_size), 'CURL_FETCH', logging.WARNING)
+            self.failure(None, 'Short read')
+        elif self.hash is not None and self.hash.digest() != self.expected_digest:
+            # We cannot tell which replica served the bad data, so we start
+            # again from the beginning.
+            cherrypy.log.error('Content hash mismatch for data fetched from %s' % ', '.join(self.urls[:self.failures + 1]), 'CURL_FETCH', logging.WARNING)
+            self.bytes_written = 0
+            self.hash = hashlib.sha1()
+            self.sink_reset()
+            self.failure(None, 'Content hash mismatch')
+        else:
+            self.has_completed = True
+            self.has_succeeded = True
 
     def failure(self, errno, errmsg):
         self.failures += 1
         try:
-            self.start_fetch(self.urls[self.failures])
-            self.buffer.close()
-            self.buffer = StringIO()
+            self.start_next_fetch()
         except IndexError:
             self.has_completed = True
             self.has_succeeded = False
 
+class BufferTransferContext(ResumableTransferContext):
+
+    def __init__(self, ref, urls, multi):
+        ResumableTransferContext.__init__(self, ref, urls, multi)
+        self.buffer = StringIO()
+        self.start_next_fetch()
+
+    def sink_write(self, _str):
+        self.buffer.write(_str)
+
+    def sink_reset(self):
+        self.buffer.close()
+        self.buffer = StringIO()
+
     def cleanup(self):
         self.buffer.close()
         TransferContext.cleanup(self)
 
-class FileTransferContext(TransferContext):
+class FileTransferContext(ResumableTransferContext):
 
-    def __init__(self, urls, save_id, multi):
-        TransferContext.__init__(self, multi)
+    def __init__(self, ref, urls, save_id, multi):
+        ResumableTransferContext.__init__(self, ref, urls, multi)
         with tempfile.NamedTemporaryFile(delete=False) as sinkfile:
             self.sinkfile_name = sinkfile.name
         self.sink_fp = open(self.sinkfile_name, "wb")
-        self.urls = urls
-        self.failures = 0
+        self.save_id = save_id
+        self.start_next_fetch()
+
+    def sink_write(self, _str):
+        self.sink_fp.write(_str)
+
+    def sink_reset(self):
+        self.sink_fp.seek(0)
+        self.sink_fp.truncate(0)
+
+    def cleanup(self):
+        self.sink_fp.close()
+        TransferContext.cleanup(self)
+
+    def save_result(self, block_store):
+        if self.has_completed and self.has_succeeded:
+            self.sink_fp.flush()
+            block_store.store_file(self.sinkfile_name, self.save_id, True, True)
+
+class BatchTransferContext(TransferContext):
+    """
+    Fetches several small blocks from one peer in a single request. Each
+    block that arrives in full (and matches its size and content hash, if
+    known) is saved; the rest are left for the caller to fetch individually.
+    """
+
+    def __init__(self, refs, url, multi):
+        TransferContext.__init__(self, multi)
+        self.refs_by_id = dict((ref.id, ref) for ref in refs)
+        self.url = url
+        self.post_data = simplejson.dumps(self.refs_by_id.keys())
         self.has_completed = False
         self.has_succeeded = False
-        self.save_id = save_id
-        self.start_fetch(self.urls[0])
+        self.response_status = None
+
+        self.record = ''
+        self.current_id = None
+        self.current_remaining = 0
+        self.current_fp = None
+        self.current_hash = None
+        self.received = []
+        self.start_fetch(url)
+
+    def write_header_line(self, _str):
+        if _str.startswith('HTTP/'):
+            self.response_status = _str.split()[1]
 
     def write_data(self, _str):
-        self.sink_fp.write(_str)
+        if self.response_status != '200':
+            return 0
+        offset = 0
+        while offset < len(_str):
+            if self.current_fp is None:
+                needed = BATCH_RECORD_STRUCT.size - len(self.record)
+                self.record += _str[offset:offset + needed]
+                offset += needed
+                if len(self.record) < BATCH_RECORD_STRUCT.size:
+                    break
+                id, size = BATCH_RECORD_STRUCT.unpack(self.record)
+                self.record = ''
+                if size < 0:
+                    continue
+                self.start_block(id, size)
+            else:
+                data = _str[offset:offset + self.current_remaining]
+                offset += len(data)
+                self.current_remaining -= len(data)
+                self.current_fp.write(data)
+                self.current_hash.update(data)
+            if self.current_fp is not None and self.current_remaining == 0:
+                self.finish_block()
+
+    def start_block(self, id, size):
+        with tempfile.NamedTemporaryFile(delete=False) as sinkfile:
+            self.current_filename = sinkfile.name
+        self.current_fp = open(self.current_filename, "wb")
+        self.current_id = id
+        self.current_remaining = size
+        self.current_hash = hashlib.sha1()
+
+    def finish_block(self):
+        self.current_fp.close()
+        self.current_fp = None
+        ref = self.refs_by_id.get(self.current_id)
+        size = os.path.getsize(self.current_filename)
+        if ref is None or (ref.size_hint is not None and size != ref.size_hint) or (ref.content_hash is not None and self.current_hash.hexdigest() != ref.content_hash):
+            cherrypy.log.error('Discarding block %s from batch fetch from %s' % (self.current_id, self.url), 'CURL_FETCH', logging.WARNING)
+            os.unlink(self.current_filename)
+        else:
+            self.received.append((self.current_id, self.current_filename))
+
+    def discard_current_block(self):
+        if self.current_fp is not None:
+            self.current_fp.close()
+            self.current_fp = None
+            os.unlink(self.current_filename)
+
+    def success(self):
+        self.has_completed = True
+        self.has_succeeded = self.current_fp is None and len(self.record) == 0
+        self.discard_current_block()
+
+    def failure(self, errno, errmsg):
+        cherrypy.log.error('Batch fetch from %s failed after %d of %d blocks' % (self.url, len(self.received), len(self.refs_by_id)), 'CURL_FETCH', logging.WARNING)
+        self.has_completed = True
+        self.discard_current_block()
+
+    def cleanup(self):
+        self.discard_current_block()
+        for _, filename in self.received:
+            if os.path.exists(filename):
+                os.unlink(filename)
+        TransferContext.cleanup(self)
+
+    def save_result(self, block_store):
+        for id, filename in self.received:
+            block_store.store_file(filename, id, True, True)
+        self.received = []
+
+class StripeTransferContext(TransferContext):
+    """
+    Fetches a byte range of a block on behalf of a StripedFileTransferContext,
+    writing the data at the corresponding offset of the destination file.
+    """
+
+    def __init__(self, parent, url, start, end):
+        TransferContext.__init__(self, parent.multi)
+        # The parent context is added to the transfer set instead.
+        self.is_added = True
+        self.parent = parent
+        self.url = url
+        self.start = start
+        self.end = end
+        self.position = start
+        self.is_valid = True
+        self.started_at = time.time()
+        self.has_completed = False
+        self.has_succeeded = False
+        self.start_fetch(url, (start, end))
+
+    def remaining(self):
+        return self.end + 1 - self.position
+
+    def write_data(self, _str):
+        if not self.is_valid:
+            return 0
+        remaining = self.remaining()
+        if remaining < len(_str):
+            # The end of this stripe may have been given to another replica,
+            # so we abort the transfer when we reach it.
+            _str = _str[:max(remaining, 0)]
+            self.parent.write_at(self.position, _str)
+            self.position += len(_str)
+            return len(_str)
+        self.parent.write_at(self.position, _str)
+        self.position += len(_str)
 
     def write_header_line(self, _str):
-        pass
+        if _str.startswith('HTTP/'):
+            # If the server ignored the Range header, the data will start at
+            # the wrong offset, unless this is the first stripe.
+            status = _str.split()[1]
+            self.is_valid = status == '206' or (status == '200' and self.start == 0)
+        elif _str.lower().startswith('content-range:'):
+            total = _str.strip().split('/')[-1]
+            if total.isdigit() and int(total) != self.parent.size:
+                cherrypy.log.error('Size mismatch for %s: expected %d, got %s' % (self.url, self.parent.size, total), 'CURL_FETCH', logging.WARNING)
+                self.is_valid = False
 
     def success(self):
         self.has_completed = True
-        self.has_succeeded = True
+        self.has_succeeded = self.remaining() <= 0
+        self.parent.stripe_finished(self)
 
     def failure(self, errno, errmsg):
-        self.failures += 1
+        # A stripe that we aborted on reaching its end has succeeded.
+        self.has_completed = True
+        self.has_succeeded = self.remaining() <= 0
+        self.parent.stripe_finished(self)
+
+class StripedFileTransferContext:
+    """
+    Fetches a large block from all of its replicas concurrently, by splitting
+    it into byte ranges (stripes) that are written directly into the
+    destination file. Each replica takes the next stripe as soon as it
+    finishes its current one, and the stripe size for each replica grows or
+    shrinks with its measured throughput, so faster replicas fetch more of the
+    block. When no stripes remain, an idle replica takes over half of the
+    largest outstanding stripe.
+    """
+
+    def __init__(self, ref, urls, save_id, multi, size):
+        self.ref = ref
+        self.urls = urls
+        self.save_id = save_id
+        self.multi = multi
+        self.size = size
+        self.has_completed = False
+        self.has_succeeded = False
+        self.is_added = False
+        
+        with tempfile.NamedTemporaryFile(delete=False) as sinkfile:
+            self.sinkfile_name = sinkfile.name
+        self.sink_fp = open(self.sinkfile_name, "r+b")
+        self.sink_fp.truncate(size)
+
+        # Byte ranges that must be refetched, and the start of the remainder
+        # of the block that has not yet been assigned to a replica.
+        self.pending_ranges = []
+        self.next_offset = 0
+
+        # Mappings from URL to the stripe that it is currently fetching (if
+        # any), and to its most recent throughput in bytes per second.
+        self.active_stripes = {}
+        self.rates = {}
+        self.failed_urls = set()
+
+        engine = multi.engine
+        engine.run_in_engine_thread(lambda: engine.dispatch(self, self._start))
+
+    def _start(self):
+        self.is_added = True
+        self.multi.add_context(self)
+        for url in self.urls:
+            self.assign_stripe(url)
+
+    def write_at(self, offset, _str):
+        self.sink_fp.seek(offset)
+        self.sink_fp.write(_str)
+
+    def get_stripe_size(self, url):
         try:
-            self.sink_fp.seek(0)
-            self.sink_fp.truncate(0)
-            self.start_fetch(self.urls[self.failures])
-            
-        except IndexError:
-            self.has_completed = True
-            self.has_succeeded = False
+            stripe_size = int(self.rates[url] * STRIPE_TARGET_SECONDS)
+        except KeyError:
+            return INITIAL_STRIPE_SIZE
+        return min(max(stripe_size, MIN_STRIPE_SIZE), MAX_STRIPE_SIZE)
+
+    def assign_stripe(self, url):
+        stripe_size = self.get_stripe_size(url)
+        if len(self.pending_ranges) > 0:
+            start, end = self.pending_ranges.pop()
+            if end - start + 1 > stripe_size:
+                self.pending_ranges.append((start + stripe_size, end))
+                end = start + stripe_size - 1
+        elif self.next_offset < self.size:
+            start = self.next_offset
+            end = min(start + stripe_size, self.size) - 1
+            self.next_offset = end + 1
+        else:
+            # Take over the second half of the stripe with the most data left
+            # to fetch, which is probably on a slower replica.
+            victims = [x for x in self.active_stripes.values() if x.remaining() >= 2 * MIN_STRIPE_SIZE]
+            if len(victims) == 0:
+                return
+            victim = max(victims, key=lambda x: x.remaining())
+            start = victim.position + victim.remaining() / 2
+            end = victim.end
+            victim.end = start - 1
+        self.active_stripes[url] = StripeTransferContext(self, url, start, end)
+
+    def stripe_finished(self, stripe):
+        del self.active_stripes[stripe.url]
+        elapsed = time.time() - stripe.started_at
+        if elapsed > 0:
+            rate = (stripe.position - stripe.start) / elapsed
+            self.rates[stripe.url] = (self.rates.get(stripe.url, rate) + rate) / 2
+        
+        if not stripe.has_succeeded:
+            cherrypy.log.error('Stripe fetch from %s failed; will not use this replica again' % stripe.url, 'CURL_FETCH', logging.WARNING)
+            self.failed_urls.add(stripe.url)
+            if stripe.remaining() > 0:
+                self.pending_ranges.append((stripe.position, stripe.end))
+
+        for url in self.urls:
+            if url not in self.failed_urls and url not in self.active_stripes:
+                self.assign_stripe(url)
+        
+        if len(self.active_stripes) == 0:
+            self.fetch_finished(len(self.pending_ranges) == 0 and self.next_offset >= self.size)
 
+    def fetch_finished(self, succeeded):
+        self.has_completed = True
+        self.has_succeeded = succeeded
+            
     def cleanup(self):
+        for stripe in self.active_stripes.values():
+            stripe.cleanup()
         self.sink_fp.close()
-        TransferContext.cleanup(self)
 
     def save_result(self, block_store):
         if self.has_completed and self.has_succeeded:
-            block_store.store_file(self.sinkfile_name, self.save_id, True)
+            self.sink_fp.flush()
+            block_store.store_file(self.sinkfile_name, self.save_id, True, True)
+
+class StripedStreamTransferContext(StripedFileTransferContext):
+    """
+    Fetches a large block in stripes from all of its replicas, and streams it
+    in order to a FIFO for an executor. The stripes are written to the
+    destination file as they arrive, and the FIFO is fed from that file as
+    the fetched prefix of the block grows. Therefore a slow consumer does
+    not slow down the fetch, and buffers at most STREAM_BUFFER_BYTES in
+    memory.
+    """
+
+    def __init__(self, ref, urls, save_id, multi, size):
+        self.mem_buffer = StreamBuffer()
+        self.fifo_dir = tempfile.mkdtemp()
+        self.fifo_name = os.path.join(self.fifo_dir, 'fetch_fifo')
+        os.mkfifo(self.fifo_name)
+        self.fifo_fd = os.open(self.fifo_name, os.O_RDWR | os.O_NONBLOCK)
+        
+        # The length of the prefix of the block that has been fetched, the
+        # fetched ranges beyond that prefix (as a mapping from end to start),
+        # and the number of bytes that have been passed to the FIFO.
+        self.prefix_bytes = 0
+        self.ranges_by_end = {}
+        self.fed_bytes = 0
+        
+        self.fetch_has_completed = False
+        self.fetch_has_succeeded = False
+        StripedFileTransferContext.__init__(self, ref, urls, save_id, multi, size)
+
+    def write_at(self, offset, _str):
+        StripedFileTransferContext.write_at(self, offset, _str)
+        start, end = offset, offset + len(_str)
+        if start <= self.prefix_bytes:
+            self.prefix_bytes = max(self.prefix_bytes, end)
+            # Absorb any ranges that now adjoin the prefix.
+            should_check = True
+            while should_check:
+                should_check = False
+                for range_end, range_start in self.ranges_by_end.items():
+                    if range_start <= self.prefix_bytes:
+                        del self.ranges_by_end[range_end]
+                        self.prefix_bytes = max(self.prefix_bytes, range_end)
+                        should_check = True
+            self.feed_fifo()
+        else:
+            # Each stripe is written in order, so it usually extends a range.
+            start = self.ranges_by_end.pop(start, start)
+            self.ranges_by_end[end] = start
+
+    def feed_fifo(self):
+        if self.fifo_fd != -1:
+            while self.fed_bytes < self.prefix_bytes and len(self.mem_buffer) < STREAM_BUFFER_BYTES:
+                self.sink_fp.seek(self.fed_bytes)
+                data = self.sink_fp.read(min(self.prefix_bytes - self.fed_bytes, STREAM_BUFFER_BYTES - len(self.mem_buffer)))
+                if len(data) == 0:
+                    break
+                self.fed_bytes += len(data)
+                self.mem_buffer.append(memoryview(data))
+                if self.mem_buffer.write_to(self.fifo_fd) == 0:
+                    break
+            if len(self.mem_buffer) > 0:
+                self.multi.buffered_handles.add(self)
+            else:
+                self.multi.buffered_handles.discard(self)
+        self.check_completed()
+
+    def try_empty_buffer(self):
+        self.mem_buffer.write_to(self.fifo_fd)
+        self.feed_fifo()
+        return False
+
+    def fetch_finished(self, succeeded):
+        self.fetch_has_completed = True
+        self.fetch_has_succeeded = succeeded
+        if not succeeded:
+            self.close_fifo()
+        self.check_completed()
+
+    def check_completed(self):
+        if self.has_completed or not self.fetch_has_completed:
+            return
+        if self.fifo_fd != -1 and (self.fed_bytes < self.size or len(self.mem_buffer) > 0):
+            return
+        self.close_fifo()
+        self.has_completed = True
+        self.has_succeeded = self.fetch_has_succeeded
+
+    def close_fifo(self):
+        if self.fifo_fd == -1:
+            return
+        os.close(self.fifo_fd)
+        self.fifo_fd = -1
+        self.mem_buffer.clear()
+        self.multi.buffered_handles.discard(self)
+
+    def fifo_closed(self):
+        self.close_fifo()
+        self.check_completed()
+
+    def cleanup(self):
+        StripedFileTransferContext.cleanup(self)
+        self.close_fifo()
+        os.unlink(self.fifo_name)
+        os.rmdir(self.fifo_dir)
+
+class StreamBuffer:
+    """
+    A queue of data waiting to be written to a non-blocking file descriptor.
+    Data is held in memoryviews, so that a partial write does not copy the
+    remainder of the data.
+    """
+
+    def __init__(self):
+        self.chunks = deque()
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, data):
+        if len(data) > 0:
+            self.chunks.append(data)
+            self.size += len(data)
+
+    def clear(self):
+        self.chunks.clear()
+        self.size = 0
+
+    def write_to(self, fd):
+        """Writes as much data as possible to fd, and returns the number of bytes written."""
+        total_written = 0
+        while len(self.chunks) > 0:
+            chunk = self.chunks[0]
+            try:
+                bytes_written = os.write(fd, chunk)
+            except OSError, e:
+                # Note that we can't get EPIPE here, as we ourselves hold a read handle.
+                if e.errno == EAGAIN:
+                    break
+                else:
+                    raise
+            total_written += bytes_written
+            self.size -= bytes_written
+            if bytes_written < len(chunk):
+                self.chunks[0] = chunk[bytes_written:]
+                break
+            self.chunks.popleft()
+        return total_written
 
 class StreamTransferContext(TransferContext):
 
+    # A paused transfer may last indefinitely, so we rely on the low-speed
+    # limit (and the server's idle timeout) instead.
+    timeout = 0
+
     def __init__(self, ref, urls, save_id, multi):
         TransferContext.__init__(self, multi)
-        self.mem_buffer = ""
+        self.mem_buffer = StreamBuffer()
+        self.is_receive_paused = False
         self.ref = ref
         self.urls = urls
         self.failures = 0
@@ -368,7 +1224,26 @@ class StreamTransferContext(TransferContext):
         self.fifo_fd = os.open(self.fifo_name, os.O_RDWR | os.O_NONBLOCK)
         self.sink_fp = open(self.sinkfile_name, "wb")
         self.current_start_byte = 0
-        self.chunk_size = 1048576
+        # For a slice reference, we fetch only its range of the block.
+        if isinstance(ref, SW2_SliceReference):
+            self.offset = ref.start
+            self.length = ref.end - ref.start
+        else:
+            self.offset = 0
+            self.length = None
+        # The size of the whole block, if it is known. After a failure, the
+        # fetch resumes from the current offset on the next replica, so we
+        # check that each response matches the data that we already have.
+        if isinstance(ref, SW2_ConcreteReference):
+            self.block_size = ref.size_hint
+        else:
+            self.block_size = None
+        self.response_status = None
+        self.response_range = None
+        self.response_is_checked = False
+        # The buffer bounds the memory that we use, so we can ask for large
+        # chunks and pause the transfer if the consumer falls behind.
+        self.chunk_size = 8 * 1048576
         self.have_written_to_process = False
         self.response_had_stream = False
         self.dormant_until = None
@@ -378,7 +1253,6 @@ class StreamTransferContext(TransferContext):
         self.save_id = save_id
         self.multi = multi
         self.description = self.urls[0]
-        multi.handles.append(self)
         self.start_next_fetch()
 
     def close_fifo(self):
@@ -386,7 +1260,9 @@ class StreamTransferContext(TransferContext):
             return
         os.close(self.fifo_fd)
         self.fifo_fd = -1
-        self.mem_buffer = ""
+        self.mem_buffer.clear()
+        self.multi.buffered_handles.discard(self)
+        self.resume_receiving()
 
     def fifo_closed(self):
         self.close_fifo()
@@ -394,42 +1270,70 @@ class StreamTransferContext(TransferContext):
             self.requests_paused = False
             self.consider_restart()
 
-    def write_without_blocking(self, fd, _str):
-
-        if self.fifo_fd == -1:
-            # Silently swallow data; the other end is gone.
-            return len(_str)
-        total_written = 0
-        while len(_str) > 0:
-            try:
-                bytes_written = os.write(self.fifo_fd, _str)
-                _str = _str[bytes_written:]
-                total_written += bytes_written
-            except OSError, e:
-                # Note that we can't get EPIPE here, as we ourselves hold a read handle.
-                if e.errno == EAGAIN:
-                    return total_written
-                else:
-                    raise
-        return total_written
+    def resume_receiving(self):
+        if self.is_receive_paused:
+            self.is_receive_paused = False
+            if self.curl_ctx is not None:
+                # N.B. This may call write_data() with the data that we
+                #      refused when we paused.
+                self.curl_ctx.pause(pycurl.PAUSE_CONT)
+
+    def check_response(self):
+        """Returns True if the current response starts at the current offset of the block."""
+        start = self.offset + self.current_start_byte
+        if self.response_status == '206' and self.response_range is not None:
+            response_start, total = self.response_range
+            if response_start != start:
+                return False
+            if self.block_size is not None and total != self.block_size:
+                return False
+            self.block_size = total
+            return True
+        elif self.response_status == '206':
+            # A streaming response does not know the total size.
+            return True
+        elif self.response_status == '200':
+            # The server ignored the Range header, so the data starts at the
+            # beginning of the block.
+            return start == 0
+        return False
 
     def write_data(self, _str):
         
-        if len(self.mem_buffer) > 0:
-            self.mem_buffer += _str
-        else:
-            written = self.write_without_blocking(self.fifo_fd, _str)
-            if written < len(_str):
-                self.mem_buffer += _str[written:]
+        if not self.response_is_checked:
+            if not self.check_response():
+                cherrypy.log.error('Response from %s does not match the data fetched so far' % self.urls[self.failures], 'CURL_FETCH', logging.WARNING)
+                return 0
+            self.response_is_checked = True
+        
+        if self.fifo_fd != -1:
+            if len(self.mem_buffer) >= STREAM_BUFFER_BYTES:
+                # The consumer is not keeping up, so we pause the transfer.
+                # cURL will pass the same data to us when we resume.
+                self.is_receive_paused = True
+                return pycurl.WRITEFUNC_PAUSE
+            self.mem_buffer.append(memoryview(_str))
+            self.mem_buffer.write_to(self.fifo_fd)
+            if len(self.mem_buffer) > 0:
+                self.multi.buffered_handles.add(self)
         self.sink_fp.write(_str)
         self.current_start_byte += len(_str)
         self.have_written_to_process = True
 
     def start_next_fetch(self):
+        if self.length is not None and self.current_start_byte >= self.length:
+            # N.B. We only get here when the buffer is empty.
+            self.close_fifo()
+            self.has_completed = True
+            self.has_succeeded = True
+            return
         cherrypy.log.error("Fetch %s offset %d" % (self.description, self.current_start_byte), 'CURL_FETCH', logging.INFO)
+        end = self.current_start_byte + self.chunk_size
+        if self.length is not None:
+            end = min(end, self.length - 1)
         self.start_fetch(self.urls[self.failures], 
-                         (self.current_start_byte, 
-                          self.current_start_byte + self.chunk_size))
+                         (self.offset + self.current_start_byte, 
+                          self.offset + end))
 
     def consider_restart(self):
         if self.dormant_until is None and not self.requests_paused:
@@ -437,14 +1341,19 @@ class StreamTransferContext(TransferContext):
 
     def wake_up(self):
         self.dormant_until = None
+        self.multi.dormant_handles.discard(self)
         cherrypy.log.error("Wakeup %s fetch; considering restart" % self.description, 'CURL_FETCH', logging.INFO)
         self.consider_restart()
 
     def try_empty_buffer(self):
 
-        written = self.write_without_blocking(self.fifo_fd, self.mem_buffer)
-        self.mem_buffer = self.mem_buffer[written:]
-        if len(self.mem_buffer) == 0 and self.requests_paused:
+        self.mem_buffer.write_to(self.fifo_fd)
+        if len(self.mem_buffer) < STREAM_BUFFER_BYTES / 2:
+            self.resume_receiving()
+        if len(self.mem_buffer) > 0:
+            return False
+        self.multi.buffered_handles.discard(self)
+        if self.requests_paused:
             cherrypy.log.error("Consumer buffer empty for %s, considering restart" % self.description, 'CURL_FETCH', logging.INFO)
             self.requests_paused = False
             self.consider_restart()
@@ -452,26 +1361,45 @@ class StreamTransferContext(TransferContext):
         return False
 
     def write_header_line(self, _str):
-        if _str.startswith("Pragma") != -1 and _str.find("streaming") != -1:
+        if _str.startswith('HTTP/'):
+            # N.B. There will be more than one status line if we are redirected.
+            self.response_status = _str.split()[1]
+            self.response_range = None
+            self.request_length = None
+        if _str.startswith("Pragma") and _str.find("streaming") != -1:
             self.response_had_stream = True
         match_obj = length_regex.match(_str)
         if match_obj is not None:
             self.request_length = int(match_obj.group(1))
+        match_obj = content_range_regex.match(_str)
+        if match_obj is not None:
+            self.response_range = int(match_obj.group(1)), int(match_obj.group(3))
 
     def start_fetch(self, url, range):
         self.response_had_stream = False
+        self.request_length = None
+        self.response_status = None
+        self.response_range = None
+        self.response_is_checked = False
+        self.is_receive_paused = False
         TransferContext.start_fetch(self, url, range)
 
     def pause_for(self, secs):
         self.dormant_until = datetime.now() + timedelta(0, secs)
+        self.multi.dormant_handles.add(self)
         cherrypy.log.error("Pausing %s fetch due to producer buffer empty" % self.description, 'CURL_FETCH', logging.INFO)
 
     def success(self):
 
-        cherrypy.log.error("Fetch %s succeeded (length %d)" % (self.description, self.request_length), "CURL_FETCH", logging.INFO)
+        cherrypy.log.error("Fetch %s succeeded (length %s)" % (self.description, str(self.request_length)), "CURL_FETCH", logging.INFO)
  
         if len(self.mem_buffer) == 0:
-            if self.request_length is not None and self.request_length < (self.chunk_size / 2):
+            # A streaming response from the push endpoint has no
+            # Content-Length, and the server has already waited for more
+            # data, so we can ask for the next chunk straight away. A short
+            # response from a server that only polls means that we have caught
+            # up with the producer.
+            if self.response_had_stream and self.request_length is not None and self.request_length < (self.chunk_size / 2):
                 self.pause_for(1)
             else:
                 self.start_next_fetch()
@@ -486,31 +1414,29 @@ class StreamTransferContext(TransferContext):
 
         cherrypy.log.error("Fetch %s failed (error %s)" % (self.description, str(errno)), "CURL_FETCH", logging.INFO)
 
-        if errno == 416:
-            if not self.response_had_stream:
-                self.close_fifo()
-                self.has_completed = True
-                self.has_succeeded = True
-            else:
-                # We've got ahead of the producer.
-                # Pause for 1 seconds.
-                self.pause_for(1)
-
+        if errno == 416 and self.response_had_stream:
+            # We've got ahead of the producer.
+            # Pause for 1 seconds.
+            self.pause_for(1)
+        elif errno == 416 and (self.block_size is None or self.offset + self.current_start_byte == self.block_size):
+            self.close_fifo()
+            self.has_completed = True
+            # A slice may extend past the end of its block.
+            self.has_succeeded = self.length is None or self.current_start_byte == self.length
         else:
-            if self.have_written_to_process:
-                # Can't just fail-over; we've failed after having written bytes to a process.
+            # Fail over to the next replica. Since we fetch by byte range,
+            # the next fetch resumes from the current offset, even if we
+            # have already written bytes to the process.
+            self.failures += 1
+            try:
+                if self.have_written_to_process:
+                    cherrypy.log.error('Resuming fetch from %s at offset %d' % (self.urls[self.failures], self.current_start_byte), 'CURL_FETCH', logging.INFO)
+                self.start_next_fetch()
+            except IndexError:
+                # Run out of URLs to try
                 self.close_fifo()
                 self.has_completed = True
                 self.has_succeeded = False
-            else:
-                self.failures += 1
-                try:
-                    self.start_fetch(self.urls[self.failures], (0, self.chunk_size))
-                except IndexError:
-                    # Run out of URLs to try
-                    self.close_fifo()
-                    self.has_completed = True
-                    self.has_succeeded = False
 
     def cleanup(self):
         TransferContext.cleanup(self)
@@ -520,28 +1446,313 @@ class StreamTransferContext(TransferContext):
 
     def save_result(self, block_store):
         if self.has_completed and self.has_succeeded:
-            block_store.store_file(self.sinkfile_name, self.save_id, True)
+            self.sink_fp.flush()
+            block_store.store_file(self.sinkfile_name, self.save_id, True, True)
 
 class BlockStore:
     
-    def __init__(self, hostname, port, base_dir):
+    def __init__(self, hostname, port, base_dir, object_cache_bytes=DEFAULT_OBJECT_CACHE_BYTES, url_cache_bytes=DEFAULT_URL_CACHE_BYTES):
         self._lock = Lock()
         self.netloc = "%s:%s" % (hostname, port)
         self.base_dir = base_dir
-        self.object_cache = {}
+        
+        # Objects that have been stored in this block store, which are
+        # charged at the size of their encoded form.
+        self.object_cache = LRUCache(object_cache_bytes)
     
         # Maintains a set of block IDs that are currently being written.
         # (i.e. They are in the pre-publish/streamable state, and have not been
         #       committed to the block store.)
         self.streaming_id_set = set()
+        
+        # Notified when a streaming block is committed or rolled back.
+        self._streaming_condition = Condition(self._lock)
     
-        self.current_cache_access_id = 0
-        self.url_cache_filenames = {}
-        self.url_cache_access_times = {}
+        # Mapping from URL to the local file that holds its contents, which is
+        # charged at the size of the file.
+        self.url_cache = LRUCache(url_cache_bytes)
+        
+        # All fetches from this block store share one transfer engine, so
+        # that connections to other block stores are reused.
+        self.transfer_engine = TransferEngine()
         
         self.encoders = {'noop': self.encode_noop, 'json': self.encode_json, 'pickle': self.encode_pickle}
         self.decoders = {'noop': self.decode_noop, 'json': self.decode_json, 'pickle': self.decode_pickle, 'handle': self.decode_handle, 'script': self.decode_script}
+        
+        # Mapping from block ID to size for every block in the store, which is
+        # loaded from the block log.
+        self._block_log_lock = Lock()
+        self.block_log_fp = None
+        self.block_store_id = None
+        self.block_generation = 0
+        self.block_sizes = {}
+        
+        # The IDs of blocks that are replicas, and of blocks that the master
+        # has told us are no longer reachable, which are the candidates for
+        # garbage collection.
+        self.replica_ids = set()
+        self.dead_ids = set()
+        
+        # Mappings from block ID to content hash (as a binary SHA-1 digest),
+        # and from content hash to the set of blocks with those contents.
+        self.block_hashes_fp = None
+        self.block_hashes = {}
+        self.blocks_by_hash = {}
+        if self.base_dir is not None:
+            for shard_name in BLOCK_SHARD_NAMES:
+                shard_dir = os.path.join(self.base_dir, shard_name)
+                if not os.path.exists(shard_dir):
+                    os.mkdir(shard_dir)
+            self.open_block_log()
+    
+    def open_block_log(self):
+        """
+        Opens the block log, which is also the index of the blocks in the
+        store, and loads the index into memory. If the block store does not
+        have a log, its blocks are moved into the sharded layout and a new log
+        (with a new block store ID) is written.
+        """
+        block_store_id_path = os.path.join(self.base_dir, '.block_store_id')
+        block_log_path = os.path.join(self.base_dir, '.block_log')
+        if os.path.exists(block_store_id_path) and os.path.exists(block_log_path):
+            with open(block_store_id_path, 'r') as block_store_id_file:
+                self.block_store_id = block_store_id_file.read().strip()
+            
+            # Discard any partially-written record.
+            with open(block_log_path, 'rb') as block_log_file:
+                for op, block_name, block_size in read_block_records(block_log_file):
+                    self._apply_block_log_record(op, block_name, block_size)
+                    self.block_generation += 1
+            self.block_log_fp = open(block_log_path, 'ab')
+            self.block_log_fp.truncate(self.block_generation * BLOCK_LOG_RECORD_STRUCT.size)
+            self.load_block_hashes()
+            
+            # If most of the log describes blocks that have been removed, we
+            # rewrite it. This changes the generation numbers, so we must also
+            # change the block store ID.
+            if self.block_generation > 2 * len(self.block_sizes) + BLOCK_LOG_COMPACTION_THRESHOLD:
+                cherrypy.log.error('Compacting block log (%d records for %d blocks)' % (self.block_generation, len(self.block_sizes)), 'BLOCKSTORE', logging.INFO)
+                self.block_log_fp.close()
+                self.write_block_log()
+        else:
+            for block_name in os.listdir(self.base_dir):
+                block_filename = os.path.join(self.base_dir, block_name)
+                if not block_name.startswith('.') and os.path.isfile(block_filename):
+                    # Blocks from an older version are stored in base_dir.
+                    os.rename(block_filename, self.filename(block_name))
+            for shard_name in os.listdir(self.base_dir):
+                shard_dir = os.path.join(self.base_dir, shard_name)
+                if not shard_name.startswith('.') and os.path.isdir(shard_dir):
+                    for block_name in os.listdir(shard_dir):
+                        self.block_sizes[block_name] = os.path.getsize(os.path.join(shard_dir, block_name))
+            self.write_block_log()
+            
+    def write_block_log(self):
+        """
+        Writes a new block log containing the current blocks, under a new
+        block store ID.
+        """
+        block_store_id_path = os.path.join(self.base_dir, '.block_store_id')
+        block_log_path = os.path.join(self.base_dir, '.block_log')
+        with open(block_log_path + '.tmp', 'wb') as block_log_file:
+            for block_name, block_size in self.block_sizes.items():
+                if block_name in self.replica_ids:
+                    op = BLOCK_REPLICA_ADDED
+                else:
+                    op = BLOCK_ADDED
+                block_log_file.write(BLOCK_LOG_RECORD_STRUCT.pack(op, block_name, block_size))
+            block_log_file.flush()
+            os.fsync(block_log_file.fileno())
+        os.rename(block_log_path + '.tmp', block_log_path)
+        self.block_generation = len(self.block_sizes)
+        self.block_log_fp = open(block_log_path, 'ab')
+        
+        self.block_store_id = str(uuid.uuid1())
+        with open(block_store_id_path, 'w') as block_store_id_file:
+            block_store_id_file.write(self.block_store_id)
+            
+        self.write_block_hashes()
+    
+    def load_block_hashes(self):
+        """
+        Loads the content hash index, ignoring the hashes of blocks that are
+        no longer in the store.
+        """
+        block_hashes_path = os.path.join(self.base_dir, '.block_hashes')
+        num_records = 0
+        if os.path.exists(block_hashes_path):
+            with open(block_hashes_path, 'rb') as block_hashes_file:
+                for block_name, digest in read_block_records(block_hashes_file, BLOCK_HASH_RECORD_STRUCT):
+                    if block_name in self.block_sizes:
+                        self._remove_block_hash(block_name)
+                        self._add_block_hash(block_name, digest)
+                    num_records += 1
+        self.block_hashes_fp = open(block_hashes_path, 'ab')
+        self.block_hashes_fp.truncate(num_records * BLOCK_HASH_RECORD_STRUCT.size)
+        
+    def write_block_hashes(self):
+        """
+        Writes a new content hash index containing the current blocks.
+        """
+        block_hashes_path = os.path.join(self.base_dir, '.block_hashes')
+        if self.block_hashes_fp is not None:
+            self.block_hashes_fp.close()
+        with open(block_hashes_path + '.tmp', 'wb') as block_hashes_file:
+            for block_name, digest in self.block_hashes.items():
+                block_hashes_file.write(BLOCK_HASH_RECORD_STRUCT.pack(block_name, digest))
+        os.rename(block_hashes_path + '.tmp', block_hashes_path)
+        self.block_hashes_fp = open(block_hashes_path, 'ab')
+    
+    def record_block_added(self, id, size, is_replica=False):
+        if is_replica:
+            self._append_to_block_log(BLOCK_REPLICA_ADDED, id, size)
+        else:
+            self._append_to_block_log(BLOCK_ADDED, id, size)
+        
+    def record_block_removed(self, id):
+        self._append_to_block_log(BLOCK_REMOVED, id, 0)
     
+    def _append_to_block_log(self, op, id, size):
+        if self.block_log_fp is None:
+            return
+        id = str(id)
+        with self._block_log_lock:
+            self.block_log_fp.write(BLOCK_LOG_RECORD_STRUCT.pack(op, id, size))
+            self.block_log_fp.flush()
+            self.block_generation += 1
+            self._apply_block_log_record(op, id, size)
+            
+    def _apply_block_log_record(self, op, id, size):
+        if op == BLOCK_REMOVED:
+            self.block_sizes.pop(id, None)
+            self.replica_ids.discard(id)
+            self.dead_ids.discard(id)
+            self._remove_block_hash(id)
+        else:
+            self.block_sizes[id] = size
+            if op == BLOCK_REPLICA_ADDED:
+                self.replica_ids.add(id)
+            else:
+                self.replica_ids.discard(id)
+                
+    def record_content_hash(self, id, digest):
+        if self.block_hashes_fp is None:
+            return
+        id = str(id)
+        with self._block_log_lock:
+            # N.B. Records that are lost in a crash are harmless, because
+            #      we only lose the chance to deduplicate those blocks.
+            self.block_hashes_fp.write(BLOCK_HASH_RECORD_STRUCT.pack(id, digest))
+            self.block_hashes_fp.flush()
+            self._remove_block_hash(id)
+            self._add_block_hash(id, digest)
+            
+    def _add_block_hash(self, id, digest):
+        self.block_hashes[id] = digest
+        try:
+            self.blocks_by_hash[digest].add(id)
+        except KeyError:
+            self.blocks_by_hash[digest] = set([id])
+            
+    def _remove_block_hash(self, id):
+        digest = self.block_hashes.pop(id, None)
+        if digest is not None:
+            ids = self.blocks_by_hash[digest]
+            ids.discard(id)
+            if len(ids) == 0:
+                del self.blocks_by_hash[digest]
+
+    def get_content_hash(self, id):
+        """Returns the content hash of the given block as a hex string, or None if it is not known."""
+        with self._block_log_lock:
+            digest = self.block_hashes.get(str(id))
+        if digest is None:
+            return None
+        return digest.encode('hex')
+    
+    def find_block_with_digest(self, digest, exclude_id=None):
+        """Returns the ID of a block in this store with the given contents, or None."""
+        with self._block_log_lock:
+            for id in self.blocks_by_hash.get(digest, ()):
+                if id != exclude_id:
+                    return id
+        return None
+    
+    def try_link_duplicate(self, id, digest):
+        """
+        If another block has the same contents as the given block, replaces
+        the given block's file with a hard link to that block's file, and
+        returns True.
+        """
+        duplicate_id = self.find_block_with_digest(digest, id)
+        if duplicate_id is None:
+            return False
+        link_filename = os.path.join(self.base_dir, '.%s.link' % id)
+        try:
+            os.link(self.filename(duplicate_id), link_filename)
+            os.rename(link_filename, self.filename(id))
+            return True
+        except OSError:
+            # The other block may have been garbage collected, or the file
+            # system may not support hard links.
+            return False
+
+    def get_block_log_position(self):
+        with self._block_log_lock:
+            return self.block_store_id, self.block_generation
+    
+    def block_log_generator(self, since_generation, until_generation, chunk_size=1048576):
+        """
+        Yields the raw block log records between the given generations.
+        """
+        records_per_chunk = chunk_size / BLOCK_LOG_RECORD_STRUCT.size
+        with open(os.path.join(self.base_dir, '.block_log'), 'rb') as block_log_file:
+            block_log_file.seek(since_generation * BLOCK_LOG_RECORD_STRUCT.size)
+            remaining = until_generation - since_generation
+            while remaining > 0:
+                to_read = min(remaining, records_per_chunk)
+                chunk = block_log_file.read(to_read * BLOCK_LOG_RECORD_STRUCT.size)
+                if len(chunk) == 0:
+                    break
+                remaining -= to_read
+                yield chunk
+    
+    def batch_generator(self, ids, chunk_size=1048576):
+        """
+        Yields the blocks with the given IDs, each preceded by a
+        BATCH_RECORD_STRUCT containing its ID and size (which is -1 if the
+        block is not stored here). Small blocks are coalesced into chunks.
+        """
+        chunk = []
+        chunk_len = 0
+        for id in ids:
+            id = str(id)
+            try:
+                block_file = open(self.filename(id), 'rb')
+            except IOError:
+                chunk.append(BATCH_RECORD_STRUCT.pack(id, -1))
+                chunk_len += BATCH_RECORD_STRUCT.size
+                continue
+            with block_file:
+                remaining = os.fstat(block_file.fileno()).st_size
+                chunk.append(BATCH_RECORD_STRUCT.pack(id, remaining))
+                chunk_len += BATCH_RECORD_STRUCT.size
+                while remaining > 0:
+                    data = block_file.read(min(chunk_size, remaining))
+                    if len(data) == 0:
+                        # Abort the response, so that the client does not
+                        # receive a short block.
+                        raise Exception('Block %s was truncated while being sent' % id)
+                    remaining -= len(data)
+                    chunk.append(data)
+                    chunk_len += len(data)
+                    if chunk_len >= chunk_size:
+                        yield ''.join(chunk)
+                        chunk = []
+                        chunk_len = 0
+        if chunk_len > 0:
+            yield ''.join(chunk)
+
     def decode_handle(self, file):
         return file
     def decode_script(self, file):
@@ -559,34 +1770,17 @@ class BlockStore:
     def decode_pickle(self, file):
         return pickle.load(file)
         
-    def mark_url_as_accessed(self, url):
-        self.url_cache_access_times[url] = self.current_cache_access_id
-        self.current_cache_access_id += 1
-        
     def find_url_in_cache(self, url):
-        with self._lock:
-            try:
-                ret = self.url_cache_filenames[url]
-            except KeyError:
-                return None
-            self.mark_url_as_accessed(url)
-            return ret
-    
-    def evict_lru_from_url_cache(self):
-        lru_url = min([(access_time, url) for (url, access_time) in self.url_cache_access_times.items()])[1]
-        del self.url_cache_filenames[lru_url]
-        del self.url_cache_access_times[lru_url] 
+        return self.url_cache.get(url)
     
     def allocate_new_id(self):
         return str(uuid.uuid1())
     
-    CACHE_SIZE_LIMIT=1024
     def store_url_in_cache(self, url, filename):
-        with self._lock:
-            if len(self.url_cache_filenames) == BlockStore.CACHE_SIZE_LIMIT:
-                self.evict_lru_from_url_cache()
-            self.url_cache_filenames[url] = filename
-            self.mark_url_as_accessed(url)
+        self.url_cache.put(url, filename, os.path.getsize(filename))
+        
+    def get_cache_stats(self):
+        return {'objects': self.object_cache.as_descriptor(), 'urls': self.url_cache.as_descriptor()}
     
     def maybe_streaming_filename(self, id):
         with self._lock:
@@ -595,33 +1789,94 @@ class BlockStore:
             else:
                 return False, self.filename(id)
     
+    def is_streaming(self, id):
+        with self._lock:
+            return id in self.streaming_id_set
+    
+    def wait_for_stream(self, id, timeout):
+        '''
+        Waits until the given block is committed or rolled back, or the
+        timeout expires.
+        '''
+        with self._lock:
+            if id in self.streaming_id_set:
+                self._streaming_condition.wait(timeout)
+    
     def streaming_filename(self, id):
         return os.path.join(self.base_dir, '.%s' % id)
     
     def filename(self, id):
-        return os.path.join(self.base_dir, str(id))
+        id = str(id)
+        return os.path.join(self.base_dir, get_block_shard_name(id), id)
         
+    def temporary_block_file(self):
+        # Blocks are written to a temporary file and renamed into place,
+        # because the existing file for a block ID may be a hard link that is
+        # shared with a duplicate block.
+        return tempfile.NamedTemporaryFile('wb', prefix='.', dir=self.base_dir, delete=False)
+
     def store_raw_file(self, incoming_fobj, id):
-        with open(self.filename(id), "wb") as data_file:
-            shutil.copyfileobj(incoming_fobj, data_file)
+        with self.temporary_block_file() as data_file:
+            hashing_file = HashingFile(data_file)
+            shutil.copyfileobj(incoming_fobj, hashing_file)
             file_size = data_file.tell()
+        os.rename(data_file.name, self.filename(id))
+        self.try_link_duplicate(id, hashing_file.digest())
+        self.record_block_added(id, file_size)
+        self.record_content_hash(id, hashing_file.digest())
         return 'swbs://%s/%s' % (self.netloc, str(id)), file_size            
     
+    def store_block_range(self, block_id, start, end, id):
+        """Stores the bytes [start, end) of the given block as a new replica."""
+        with self.temporary_block_file() as range_file:
+            range_filename = range_file.name
+            hashing_file = HashingFile(range_file)
+            with open(self.filename(block_id), 'rb') as block_file:
+                block_file.seek(start)
+                remaining = end - start
+                while remaining > 0:
+                    data = block_file.read(min(1048576, remaining))
+                    if len(data) == 0:
+                        break
+                    hashing_file.write(data)
+                    remaining -= len(data)
+            file_size = range_file.tell()
+        os.rename(range_filename, self.filename(id))
+        self.record_block_added(id, file_size, True)
+        self.record_content_hash(id, hashing_file.digest())
+        return 'swbs://%s/%s' % (self.netloc, str(id)), file_size
+
     def store_object(self, object, encoder, id):
         """Stores the given object as a block, and returns a swbs URL to it."""
-        self.object_cache[id] = object
-        with open(self.filename(id), "wb") as object_file:
-            self.encoders[encoder](object, object_file)
+        with self.temporary_block_file() as object_file:
+            hashing_file = HashingFile(object_file)
+            self.encoders[encoder](object, hashing_file)
             file_size = object_file.tell()
+        os.rename(object_file.name, self.filename(id))
+        self.object_cache.put(id, object, file_size)
+        self.try_link_duplicate(id, hashing_file.digest())
+        self.record_block_added(id, file_size)
+        self.record_content_hash(id, hashing_file.digest())
         return 'swbs://%s/%s' % (self.netloc, str(id)), file_size
     
-    def store_file(self, filename, id, can_move=False):
+    def store_file(self, filename, id, can_move=False, is_replica=False):
         """Stores the file with the given local filename as a block, and returns a swbs URL to it."""
-        if can_move:
-            shutil.move(filename, self.filename(id))
+        digest = hash_file(filename)
+        if self.try_link_duplicate(id, digest):
+            if can_move:
+                os.unlink(filename)
+        elif can_move and os.stat(filename).st_dev == os.stat(self.base_dir).st_dev:
+            os.rename(filename, self.filename(id))
         else:
-            shutil.copyfile(filename, self.filename(id))
+            with self.temporary_block_file() as block_file:
+                with open(filename, 'rb') as source_file:
+                    shutil.copyfileobj(source_file, block_file)
+            os.rename(block_file.name, self.filename(id))
+            if can_move:
+                os.unlink(filename)
         file_size = os.path.getsize(self.filename(id))
+        self.record_block_added(id, file_size, is_replica)
+        self.record_content_hash(id, digest)
         return 'swbs://%s/%s' % (self.netloc, str(id)), file_size
 
     def make_stream_sink(self, id):
@@ -656,6 +1911,7 @@ class BlockStore:
                 self.streaming_id_set.remove(id)
                 os.unlink(self.streaming_filename(id))
                 os.symlink(self.filename(id), self.streaming_filename(id))
+                self._streaming_condition.notify_all()
         else:
             # A copy will be necessary, so do this outside the lock.
             url, file_size = self.store_file(filename, id, False)
@@ -663,6 +1919,7 @@ class BlockStore:
                 self.streaming_id_set.remove(id)
                 os.unlink(self.streaming_filename(id))
                 os.symlink(self.filename(id), self.streaming_filename(id))
+                self._streaming_condition.notify_all()
             
         return url, file_size
 
@@ -671,6 +1928,7 @@ class BlockStore:
         with self._lock:
             self.streaming_id_set.remove(id)
             os.unlink(self.streaming_filename(id))
+            self._streaming_condition.notify_all()
     
     def try_retrieve_filename_for_ref_without_transfer(self, ref):
         assert isinstance(ref, SWRealReference)
@@ -691,10 +1949,32 @@ class BlockStore:
             with open(self.filename(id), 'w') as obj_file:
                 self.encode_json(ref.value, obj_file)
             return self.filename(id)
+        elif isinstance(ref, SW2_SliceReference):
+            # Executors read whole files, so we store the range as a block of
+            # its own, which later tasks on this worker can reuse.
+            slice_id = self.get_slice_id(ref)
+            maybe_local_filename = self.filename(slice_id)
+            if os.path.exists(maybe_local_filename):
+                return maybe_local_filename
+            if ref.end <= ref.start:
+                self.store_raw_file(StringIO(), slice_id)
+                return maybe_local_filename
+            block_filename = self.filename(ref.id)
+            if os.path.exists(block_filename):
+                if ref.start == 0 and ref.end == os.path.getsize(block_filename):
+                    return block_filename
+                self.store_block_range(ref.id, ref.start, ref.end, slice_id)
+                return maybe_local_filename
+            return None
         elif isinstance(ref, SW2_ConcreteReference) or isinstance(ref, SW2_StreamReference):
             maybe_local_filename = self.filename(ref.id)
             if os.path.exists(maybe_local_filename):
                 return maybe_local_filename
+            if isinstance(ref, SW2_ConcreteReference) and ref.content_hash is not None:
+                # We may hold the same contents under a different block ID.
+                duplicate_id = self.find_block_with_digest(ref.content_hash.decode('hex'))
+                if duplicate_id is not None and os.path.exists(self.filename(duplicate_id)):
+                    return self.filename(duplicate_id)
             check_urls = ["swbs://%s/%s" % (loc_hint, str(ref.id)) for loc_hint in ref.location_hints]
             return find_first_cached(check_urls)
         elif isinstance(ref, SWURLReference):
@@ -708,40 +1988,103 @@ class BlockStore:
 
         # Basically like the same task for files, but with the possibility of cached decoded forms
         if isinstance(ref, SW2_ConcreteReference):
-            for loc in ref.location_hints:
-                if loc == self.netloc:
-                    try:
-                        return self.object_cache[ref.id]
-                    except:
-                        pass
+            if ref.has_location_hint(self.netloc):
+                obj = self.object_cache.get(ref.id, OBJECT_CACHE_MISS)
+                if obj is not OBJECT_CACHE_MISS:
+                    return obj
+        elif isinstance(ref, SW2_SliceReference) and ref.end > ref.start:
+            # Decode the range directly from the block, if we have it.
+            try:
+                with open(self.filename(ref.id), 'rb') as block_file:
+                    block_file.seek(ref.start)
+                    return self.decoders[decoder](StringIO(block_file.read(ref.end - ref.start)))
+            except IOError:
+                pass
         cached_file = self.try_retrieve_filename_for_ref_without_transfer(ref)
         if cached_file is not None:
             with open(cached_file, "r") as f:
                 return self.decoders[decoder](f)
         return None
 
+    def get_slice_id(self, ref):
+        return '%s:slice:%d-%d' % (ref.id, ref.start, ref.end)
+
     def get_fetch_urls_for_ref(self, ref):
 
-        if isinstance(ref, SW2_ConcreteReference) or isinstance(ref, SW2_StreamReference):
+        if isinstance(ref, SW2_ConcreteReference) or isinstance(ref, SW2_StreamReference) or isinstance(ref, SW2_SliceReference):
             return ["http://%s/data/%s" % (loc_hint, ref.id) for loc_hint in ref.location_hints]
         elif isinstance(ref, SWURLReference):
             return map(sw_to_external_url, ref.urls)
                 
+    def fetch_refs_in_batches(self, refs):
+        """
+        Fetches the small blocks among the given refs with one request to each
+        peer that holds several of them, and returns the number of blocks
+        fetched. The caller must fetch any remaining blocks individually.
+        """
+        candidates = {}
+        for ref in refs:
+            if isinstance(ref, SW2_ConcreteReference) and ref.size_hint is not None and ref.size_hint <= BATCH_FETCH_THRESHOLD and len(ref.location_hints) > 0:
+                candidates[ref.id] = ref
+        if len(candidates) < BATCH_FETCH_MIN_BLOCKS:
+            return 0
+
+        # Fetch each block from the peer that holds the most candidates, so
+        # that we make as few requests as possible.
+        hint_counts = {}
+        for ref in candidates.values():
+            for hint in ref.location_hints:
+                hint_counts[hint] = hint_counts.get(hint, 0) + 1
+        refs_by_peer = {}
+        for ref in candidates.values():
+            peer = max(ref.location_hints, key=lambda hint: hint_counts[hint])
+            refs_by_peer.setdefault(peer, []).append(ref)
+
+        fetch_ctx = TransferSetContext(self.transfer_engine)
+        request_list = []
+        for peer, peer_refs in refs_by_peer.items():
+            if len(peer_refs) >= BATCH_FETCH_MIN_BLOCKS:
+                request_list.append(BatchTransferContext(peer_refs, "http://%s/data/batch" % peer, fetch_ctx))
+        if len(request_list) == 0:
+            return 0
+
+        fetch_ctx.transfer_all()
+
+        fetched = 0
+        for req in request_list:
+            fetched += len(req.received)
+            req.save_result(self)
+            req.cleanup()
+        fetch_ctx.cleanup()
+        cherrypy.log.error('Fetched %d of %d blocks in %d batches' % (fetched, len(candidates), len(request_list)), 'CURL_FETCH', logging.INFO)
+        return fetched
+
+    def resolve_refs_after_batch_fetch(self, refs, resolved_refs):
+        unresolved_refs = [ref for (ref, resolution) in zip(refs, resolved_refs) if resolution is None]
+        if self.fetch_refs_in_batches(unresolved_refs) == 0:
+            return resolved_refs
+        return [resolution if resolution is not None else self.try_retrieve_filename_for_ref_without_transfer(ref) for (ref, resolution) in zip(refs, resolved_refs)]
+
     def retrieve_filenames_for_refs_eager(self, refs):
 
-        fetch_ctx = TransferSetContext()
+        fetch_ctx = TransferSetContext(self.transfer_engine)
 
-        # Step 1: Resolve from local cache
+        # Step 1: Resolve from local cache, fetching small blocks in batches
         resolved_refs = map(self.try_retrieve_filename_for_ref_without_transfer, refs)
+        resolved_refs = self.resolve_refs_after_batch_fetch(refs, resolved_refs)
 
         # Step 2: Build request descriptors
         def create_transfer_context(ref):
             urls = self.get_fetch_urls_for_ref(ref)
             if isinstance(ref, SW2_ConcreteReference) or isinstance(ref, SW2_StreamReference):
                 save_id = ref.id
+            elif isinstance(ref, SW2_SliceReference):
+                save_id = self.get_slice_id(ref)
             else:
                 save_id = self.allocate_new_id()
-            return FileTransferContext(urls, save_id, fetch_ctx)
+            if isinstance(ref, SW2_ConcreteReference) and ref.size_hint is not None and ref.size_hint >= STRIPED_FETCH_THRESHOLD and len(urls) > 1:
+                return StripedFileTransferContext(ref, urls, save_id, fetch_ctx, ref.size_hint)
+            return FileTransferContext(ref, urls, save_id, fetch_ctx)
 
         request_list = []
         for (ref, resolution) in zip(refs, resolved_refs):
@@ -773,18 +2116,27 @@ class BlockStore:
 
     def retrieve_filenames_for_refs(self, refs):
 
-        fetch_ctx = StreamTransferSetContext()
+        fetch_ctx = StreamTransferSetContext(self.transfer_engine)
 
-        # Step 1: Resolve from local cache
+        # Step 1: Resolve from local cache, fetching small blocks in batches
         resolved_refs = map(self.try_retrieve_filename_for_ref_without_transfer, refs)
+        resolved_refs = self.resolve_refs_after_batch_fetch(refs, resolved_refs)
 
         # Step 2: Build request descriptors
         def create_transfer_context(ref):
             urls = self.get_fetch_urls_for_ref(ref)
             if isinstance(ref, SW2_ConcreteReference) or isinstance(ref, SW2_StreamReference):
                 save_id = ref.id
+            elif isinstance(ref, SW2_SliceReference):
+                save_id = self.get_slice_id(ref)
             else:
                 save_id = self.allocate_new_id()
+            if isinstance(ref, SW2_StreamReference):
+                # Ask the producer's block store to push data to us as it is
+                # written, rather than polling for it.
+                urls = ['%s?stream=1' % url for url in urls]
+            elif isinstance(ref, SW2_ConcreteReference) and ref.size_hint is not None and ref.size_hint >= STRIPED_FETCH_THRESHOLD and len(urls) > 1:
+                return StripedStreamTransferContext(ref, urls, save_id, fetch_ctx, ref.size_hint)
             return StreamTransferContext(ref, urls, save_id, fetch_ctx)
 
         result_list = []
@@ -801,19 +2153,21 @@ class BlockStore:
     def retrieve_objects_for_refs(self, refs, decoder):
         
         easy_solutions = [self.try_retrieve_object_for_ref_without_transfer(ref, decoder) for ref in refs]
+        if self.fetch_refs_in_batches([ref for (ref, solution) in zip(refs, easy_solutions) if solution is None]) > 0:
+            easy_solutions = [solution if solution is not None else self.try_retrieve_object_for_ref_without_transfer(ref, decoder) for (ref, solution) in zip(refs, easy_solutions)]
         fetch_urls = [self.get_fetch_urls_for_ref(ref) for ref in refs]
 
         result_list = []
         request_list = []
         
-        transfer_ctx = TransferSetContext()
+        transfer_ctx = TransferSetContext(self.transfer_engine)
 
-        for (solution, this_fetch_urls) in zip(easy_solutions, fetch_urls):
+        for (ref, solution, this_fetch_urls) in zip(refs, easy_solutions, fetch_urls):
             if solution is not None:
                 result_list.append(solution)
             else:
                 result_list.append(None)
-                request_list.append((ref, BufferTransferContext(this_fetch_urls, transfer_ctx)))
+                request_list.append((ref, BufferTransferContext(ref, this_fetch_urls, transfer_ctx)))
 
         transfer_ctx.transfer_all()
 
@@ -878,7 +2232,7 @@ class BlockStore:
             id = 'urlfetch:%s' % hash.hexdigest()
             _, size = self.store_file(fetch_filename, id, True)
             
-            ref = SW2_ConcreteReference(id, SWTaskOutputProvenance(task_id, -1), size)
+            ref = SW2_ConcreteReference(id, SWTaskOutputProvenance(task_id, -1), size, content_hash=hash.hexdigest())
             ref.add_location_hint(self.netloc)
         
         return ref
@@ -901,18 +2255,79 @@ class BlockStore:
         
     def block_list_generator(self):
         cherrypy.log.error('Generating block list for local consumption', 'BLOCKSTORE', logging.INFO)
-        for block_name in os.listdir(self.base_dir):
-            if not block_name.startswith('.'):
-                block_size = os.path.getsize(os.path.join(self.base_dir, block_name))
-                yield block_name, block_size
-    
-    def generate_block_list_file(self):
-        cherrypy.log.error('Generating block list file', 'BLOCKSTORE', logging.INFO)
-        with tempfile.NamedTemporaryFile('w', delete=False) as block_list_file:
-            filename = block_list_file.name
-            for block_name, block_size in self.block_list_generator():
-                block_list_file.write(BLOCK_LIST_RECORD_STRUCT.pack(block_name, block_size))
-        return filename
+        with self._block_log_lock:
+            block_list = self.block_sizes.items()
+        for block_name, block_size in block_list:
+            yield block_name, block_size
+
+    def mark_blocks_dead(self, ids):
+        with self._block_log_lock:
+            for id in ids:
+                id = str(id)
+                if id in self.block_sizes:
+                    self.dead_ids.add(id)
+
+    def delete_block(self, id):
+        with self._lock:
+            if id in self.streaming_id_set:
+                return False
+            try:
+                os.unlink(self.filename(id))
+            except OSError:
+                pass
+        self.object_cache.remove(id)
+        self.record_block_removed(id)
+        return True
+
+    def get_disk_usage(self):
+        stat = os.statvfs(self.base_dir)
+        return 1.0 - float(stat.f_bavail) / stat.f_blocks
+
+    def collect_garbage(self, high_watermark=0.9, low_watermark=0.8):
+        """
+        If the fraction of the disk that is used exceeds the high watermark,
+        deletes dead blocks, and then replicas, (largest first) until it is
+        below the low watermark. Primary copies of live blocks are never
+        deleted. Returns the IDs of the deleted blocks.
+        """
+        if self.base_dir is None or self.get_disk_usage() <= high_watermark:
+            return []
+        
+        with self._block_log_lock:
+            dead_blocks = [(self.block_sizes.get(id, 0), id) for id in self.dead_ids]
+            replica_blocks = [(self.block_sizes.get(id, 0), id) for id in self.replica_ids if id not in self.dead_ids]
+        dead_blocks.sort(reverse=True)
+        replica_blocks.sort(reverse=True)
+        
+        # Deduplicated blocks share a file, which is only freed when every
+        # block that links to it has been deleted. Therefore we delete such
+        # blocks together, and skip any that share a file with a block that
+        # we may not delete.
+        blocks_by_file = {}
+        files = []
+        for _, id in dead_blocks + replica_blocks:
+            try:
+                file_stat = os.stat(self.filename(id))
+                file_key, link_count = (file_stat.st_dev, file_stat.st_ino), file_stat.st_nlink
+            except OSError:
+                file_key, link_count = id, 1
+            if file_key not in blocks_by_file:
+                blocks_by_file[file_key] = (link_count, [])
+                files.append(file_key)
+            blocks_by_file[file_key][1].append(id)
+        
+        deleted_ids = []
+        for file_key in files:
+            if self.get_disk_usage() <= low_watermark:
+                break
+            link_count, ids = blocks_by_file[file_key]
+            if len(ids) < link_count:
+                continue
+            for id in ids:
+                if self.delete_block(id):
+                    deleted_ids.append(id)
+        cherrypy.log.error('Garbage collected %d block(s)' % len(deleted_ids), 'BLOCKSTORE', logging.INFO)
+        return deleted_ids
 
     def is_empty(self):
-        return len(os.listdir(self.base_dir)) == 0
+        return len(self.block_sizes) == 0
@@ -0,0 +1,131 @@
+# Copyright (c) 2010 Derek Murray <derek.murray@cl.cam.ac.uk>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+from __future__ import with_statement
+from threading import Lock
+import sys
+
+# Indices into a cache entry, which is a list so that it can be updated in
+# place: [previous entry, next entry, key, value, size].
+PREV = 0
+NEXT = 1
+KEY = 2
+VALUE = 3
+SIZE = 4
+
+def estimate_object_size(obj, max_depth=3):
+    """
+    Returns a rough estimate of the memory used by the given object, including
+    the contents of containers (up to the given depth).
+    """
+    size = sys.getsizeof(obj)
+    if max_depth > 0:
+        if isinstance(obj, dict):
+            for key, value in obj.iteritems():
+                size += estimate_object_size(key, max_depth - 1) + estimate_object_size(value, max_depth - 1)
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            for elem in obj:
+                size += estimate_object_size(elem, max_depth - 1)
+    return size
+
+class LRUCache:
+    """
+    A thread-safe cache that evicts the least-recently-used entries when the
+    total size of its entries exceeds a budget (in bytes). Entries are kept in
+    a circular doubly-linked list, so that lookup, insertion and eviction take
+    constant time.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+
+        self.entries = {}
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None, 0]
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                entry = self.entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._unlink(entry)
+            self._link_at_head(entry)
+            return entry[VALUE]
+
+    def put(self, key, value, size=None):
+        """
+        Adds the given value to the cache, with the given size in bytes, or
+        the estimated size of the value if none is given. A value that is
+        larger than the cache is not added.
+        """
+        if size is None:
+            size = estimate_object_size(value)
+        with self._lock:
+            try:
+                self._remove_entry(self.entries[key])
+            except KeyError:
+                pass
+            if size > self.max_bytes:
+                return
+            while self.current_bytes + size > self.max_bytes:
+                self._remove_entry(self.root[PREV])
+                self.evictions += 1
+            entry = [None, None, key, value, size]
+            self._link_at_head(entry)
+            self.entries[key] = entry
+            self.current_bytes += size
+
+    def remove(self, key):
+        with self._lock:
+            try:
+                self._remove_entry(self.entries[key])
+            except KeyError:
+                pass
+
+    def _remove_entry(self, entry):
+        self._unlink(entry)
+        del self.entries[entry[KEY]]
+        self.current_bytes -= entry[SIZE]
+
+    def _unlink(self, entry):
+        entry[PREV][NEXT] = entry[NEXT]
+        entry[NEXT][PREV] = entry[PREV]
+
+    def _link_at_head(self, entry):
+        head = self.root[NEXT]
+        entry[PREV] = self.root
+        entry[NEXT] = head
+        head[PREV] = entry
+        self.root[NEXT] = entry
+
+    def as_descriptor(self):
+        with self._lock:
+            return {'entries': len(self.entries),
+                    'bytes': self.current_bytes,
+                    'max_bytes': self.max_bytes,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
@@ -254,7 +254,7 @@ class SWStdinoutExecutor(SWExecutor):
             _, size_hint = block_store.store_file(temp_output.name, self.output_ids[0], can_move=True)
         
         # XXX: We fix the provenance in the caller.
-        real_ref = SW2_ConcreteReference(self.output_ids[0], SWNoProvenance(), size_hint)
+        real_ref = SW2_ConcreteReference(self.output_ids[0], SWNoProvenance(), size_hint, content_hash=block_store.get_content_hash(self.output_ids[0]))
         real_ref.add_location_hint(block_store.netloc)
         self.output_refs[0] = real_ref
         
@@ -326,7 +326,7 @@ class EnvironmentExecutor(SWExecutor):
         for i, filename in enumerate(output_filenames):
             _, size_hint = block_store.store_file(filename, self.output_ids[i], can_move=True)
             # XXX: We fix the provenance in the caller.
-            real_ref = SW2_ConcreteReference(self.output_ids[i], SWNoProvenance(), size_hint)
+            real_ref = SW2_ConcreteReference(self.output_ids[i], SWNoProvenance(), size_hint, content_hash=block_store.get_content_hash(self.output_ids[i]))
             real_ref.add_location_hint(block_store.netloc)
             self.output_refs[i] = real_ref
         
@@ -444,7 +444,7 @@ class JavaExecutor(SWExecutor):
                 _, size_hint = block_store.store_file(filename, self.output_ids[i], can_move=True)
             
             # XXX: fix provenance.
-            real_ref = SW2_ConcreteReference(self.output_ids[i], SWNoProvenance(), size_hint)
+            real_ref = SW2_ConcreteReference(self.output_ids[i], SWNoProvenance(), size_hint, content_hash=block_store.get_content_hash(self.output_ids[i]))
             real_ref.add_location_hint(block_store.netloc)
             self.output_refs[i] = real_ref
             
@@ -539,7 +539,7 @@ class DotNetExecutor(SWExecutor):
         for i, filename in enumerate(file_outputs):
             _, size_hint = block_store.store_file(filename, self.output_ids[i], can_move=True)
             # XXX: fix provenance.
-            real_ref = SW2_ConcreteReference(self.output_ids[i], SWNoProvenance(), size_hint)
+            real_ref = SW2_ConcreteReference(self.output_ids[i], SWNoProvenance(), size_hint, content_hash=block_store.get_content_hash(self.output_ids[i]))
             real_ref.add_location_hint(block_store.netloc)
             self.output_refs[i] = real_ref
 
@@ -624,7 +624,7 @@ class CExecutor(SWExecutor):
         for i, filename in enumerate(file_outputs):
             _, size_hint = block_store.store_file(filename, self.output_ids[i], can_move=True)
             # XXX: fix provenance.
-            real_ref = SW2_ConcreteReference(self.output_ids[i], SWNoProvenance(), size_hint)
+            real_ref = SW2_ConcreteReference(self.output_ids[i], SWNoProvenance(), size_hint, content_hash=block_store.get_content_hash(self.output_ids[i]))
             real_ref.add_location_hint(block_store.netloc)
             self.output_refs[i] = real_ref
             
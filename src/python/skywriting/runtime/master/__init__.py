@@ -19,6 +19,11 @@ from skywriting.runtime.master.deferred_work import DeferredWorkPlugin
 from skywriting.runtime.master.master_view import MasterRoot
 from skywriting.runtime.master.data_store import GlobalNameDirectory
 from skywriting.runtime.master.worker_pool import WorkerPool
+from skywriting.runtime.master.task_dispatcher import TaskDispatcher
+from skywriting.runtime.master.job_archive import TaskArchive, JobArchiver
+from skywriting.runtime.master.block_reaper import BlockReaper
+from skywriting.runtime.master.journal import JournalWriter,\
+    JournalCheckpointer
 from skywriting.runtime.block_store import BlockStore
 from skywriting.runtime.task_executor import TaskExecutorPlugin
 from skywriting.runtime.master.task_pool import TaskPool
@@ -44,15 +49,41 @@ def master_main(options):
     global_name_directory = GlobalNameDirectory(cherrypy.engine)
     global_name_directory.subscribe()
 
-    worker_pool = WorkerPool(cherrypy.engine, deferred_worker)
+    task_dispatcher = TaskDispatcher(cherrypy.engine)
+    task_dispatcher.subscribe()
+
+    worker_pool = WorkerPool(cherrypy.engine, deferred_worker, task_dispatcher)
     worker_pool.subscribe()
 
-    lazy_task_pool = LazyTaskPool(cherrypy.engine)
+    if options.journaldir is not None:
+        # The archive must not live in the journal directory, because every
+        # entry in that directory is recovered as a job.
+        archive_dir = os.path.normpath(options.journaldir) + '-archive'
+        if not os.path.exists(archive_dir):
+            os.mkdir(archive_dir)
+    else:
+        archive_dir = tempfile.mkdtemp(prefix=os.getenv('TEMP', default='/tmp/sw-archive-'))
+    archive = TaskArchive(archive_dir)
+
+    lazy_task_pool = LazyTaskPool(cherrypy.engine, archive)
     task_pool_adapter = LazyTaskPoolAdapter(lazy_task_pool)
     lazy_task_pool.subscribe()
     
-    job_pool = JobPool(cherrypy.engine, lazy_task_pool, options.journaldir, global_name_directory)
+    journal_writer = JournalWriter(cherrypy.engine)
+    journal_writer.subscribe()
+    
+    job_pool = JobPool(cherrypy.engine, lazy_task_pool, options.journaldir, global_name_directory, journal_writer)
     job_pool.subscribe()
+    
+    block_reaper = BlockReaper(cherrypy.engine, worker_pool)
+    block_reaper.subscribe()
+    
+    if options.journaldir is not None:
+        if options.checkpoint_records is not None:
+            journal_checkpointer = JournalCheckpointer(cherrypy.engine, job_pool, lazy_task_pool, deferred_worker, min_records=options.checkpoint_records)
+        else:
+            journal_checkpointer = JournalCheckpointer(cherrypy.engine, job_pool, lazy_task_pool, deferred_worker)
+        journal_checkpointer.subscribe()
 
     local_hostname = socket.getfqdn()
     local_port = cherrypy.config.get('server.socket_port')
@@ -66,10 +97,16 @@ def master_main(options):
 
     block_store = BlockStore(local_hostname, local_port, block_store_dir)
 
+    job_archiver = JobArchiver(cherrypy.engine, lazy_task_pool, block_store, deferred_worker)
+    job_archiver.subscribe()
+
     recovery_manager = RecoveryManager(cherrypy.engine, job_pool, lazy_task_pool, block_store, deferred_worker)
     recovery_manager.subscribe()
 
-    scheduler = LazyScheduler(cherrypy.engine, lazy_task_pool, worker_pool)
+    if options.locality_delay is not None:
+        scheduler = LazyScheduler(cherrypy.engine, lazy_task_pool, worker_pool, deferred_worker, options.locality_delay)
+    else:
+        scheduler = LazyScheduler(cherrypy.engine, lazy_task_pool, worker_pool, deferred_worker)
     scheduler.subscribe()
     
     root = MasterRoot(task_pool_adapter, worker_pool, block_store, global_name_directory, job_pool)
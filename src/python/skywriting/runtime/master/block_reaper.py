@@ -0,0 +1,53 @@
+# Copyright (c) 2010 Derek Murray <derek.murray@cl.cam.ac.uk>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+from skywriting.runtime.plugins import AsynchronousExecutePlugin
+import simplejson
+import httplib2
+import cherrypy
+import logging
+
+class BlockReaper(AsynchronousExecutePlugin):
+    """
+    Tells workers which of their blocks are no longer reachable from any
+    active job, so that they can be garbage collected when disk space runs
+    low. The dead references are published by the task pool when it evicts a
+    completed job.
+    """
+
+    def __init__(self, bus, worker_pool, timeout=30):
+        AsynchronousExecutePlugin.__init__(self, bus, 1, 'blocks_dead')
+        self.worker_pool = worker_pool
+        self.timeout = timeout
+
+    def handle_input(self, dead_refs):
+        dead_block_ids_by_netloc = {}
+        for ref in dead_refs:
+            for netloc in ref.location_hints:
+                try:
+                    dead_block_ids_by_netloc[netloc].append(ref.id)
+                except KeyError:
+                    dead_block_ids_by_netloc[netloc] = [ref.id]
+
+        for netloc, block_ids in dead_block_ids_by_netloc.items():
+            worker = self.worker_pool.get_worker_at_netloc(netloc)
+            if worker is None or worker.failed:
+                # The master's own block store is not garbage collected, and
+                # a failed worker will re-register its blocks if it returns.
+                continue
+            try:
+                response, _ = httplib2.Http(timeout=self.timeout).request('http://%s/gc/' % netloc, 'POST', simplejson.dumps(block_ids))
+                if response.status != 200:
+                    cherrypy.log.error('Worker %s rejected %d dead block(s): %s' % (netloc, len(block_ids), str(response.status)), 'GC', logging.WARNING)
+            except:
+                cherrypy.log.error('Error sending %d dead block(s) to %s' % (len(block_ids), netloc), 'GC', logging.WARNING, True)
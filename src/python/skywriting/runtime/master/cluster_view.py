@@ -11,11 +11,11 @@
 # WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
 # ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
-from skywriting.runtime.master.job_pool import JOB_STATE_NAMES
+from skywriting.runtime.master.job_pool import JOB_STATE_NAMES,\
+    JOB_PRIORITY_NAMES
 from cherrypy._cperror import HTTPError
 from skywriting.runtime.task import TASK_STATES, TASK_STATE_NAMES
 import cherrypy
-import time
 from skywriting.runtime.references import SWURLReference, SWDataValue
 
 def table_row(key, value):
@@ -77,6 +77,10 @@ class JobBrowserRoot:
         job_string += table_row('Root task', task_link(job.root_task))
         job_string += table_row('State', JOB_STATE_NAMES[job.state])
         job_string += table_row('Output ref', ref_id_link(job.root_task.expected_outputs[0]))
+        job_string += table_row('Priority', JOB_PRIORITY_NAMES[job.priority])
+        job_string += table_row('Share', job.share)
+        job_string += table_row('Local input bytes', job.local_input_bytes)
+        job_string += table_row('Remote input bytes', job.remote_input_bytes)
         job_string += span_row('Task states')
         for name, state in TASK_STATES.items():
             try:
@@ -96,7 +100,10 @@ class TaskBrowserRoot:
         try:
             task = self.task_pool.get_task_by_id(task_id)
         except KeyError:
-            raise HTTPError(404)
+            try:
+                return self.archived_task_page(self.task_pool.get_task_descriptor_by_id(task_id))
+            except KeyError:
+                raise HTTPError(404)
         
         task_string = '<html><head><title>Task Browser</title></head>'
         task_string += '<body><table>'
@@ -112,7 +119,7 @@ class TaskBrowserRoot:
             task_string += table_row(i, ref_id_link(output_id))
         task_string += span_row('History')
         for t, name in task.history:
-            task_string += table_row(time.mktime(t.timetuple()) + t.microsecond / 1e6, name)
+            task_string += table_row(t, name)
         if len(task.children) > 0:
             task_string += span_row('Children')
             for i, child in enumerate(task.children):
@@ -120,6 +127,32 @@ class TaskBrowserRoot:
         task_string += '</table></body></html>'
         return task_string
 
+    def archived_task_page(self, descriptor):
+        task_string = '<html><head><title>Task Browser</title></head>'
+        task_string += '<body><table>'
+        task_string += table_row('ID', descriptor['task_id'])
+        task_string += table_row('State', descriptor['state'] + ' (archived)')
+        task_string += table_row('Job', '<a href="/browse/job/%s">%s</a>' % (descriptor['job_id'], descriptor['job_id']))
+        try:
+            task_string += table_row('Worker', descriptor['worker_id'])
+        except KeyError:
+            pass
+        task_string += span_row('Dependencies')
+        for local_id, ref in descriptor['dependencies'].items():
+            task_string += table_row(local_id, ref_link(ref))
+        task_string += span_row('Outputs')
+        for i, output_id in enumerate(descriptor['expected_outputs']):
+            task_string += table_row(i, ref_id_link(output_id))
+        task_string += span_row('History')
+        for t, name in descriptor['history']:
+            task_string += table_row(t, name)
+        if len(descriptor['children']) > 0:
+            task_string += span_row('Children')
+            for i, child_id in enumerate(descriptor['children']):
+                task_string += table_row(i, '<a href="/browse/task/%s">%s</a>' % (child_id, child_id))
+        task_string += '</table></body></html>'
+        return task_string
+
 class RefBrowserRoot:
     
     def __init__(self, task_pool):
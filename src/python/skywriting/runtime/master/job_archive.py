@@ -0,0 +1,184 @@
+# Copyright (c) 2010 Derek Murray <derek.murray@cl.cam.ac.uk>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+from __future__ import with_statement
+from skywriting.runtime.plugins import AsynchronousExecutePlugin
+from skywriting.runtime.block_store import SWReferenceJSONEncoder,\
+    json_decode_object_hook
+from skywriting.runtime.references import SWRealReference, SWDataValue,\
+    SW2_ConcreteReference, SWTaskOutputProvenance
+from threading import Lock
+import simplejson
+import anydbm
+import os
+import cherrypy
+import logging
+
+# The master does not fetch Skywriting values that are larger than this, to
+# find the references that they contain.
+MAX_RESULT_VALUE_SIZE = 1048576
+
+class TaskArchive:
+    """
+    An on-disk store of the descriptors of tasks, and the references that they
+    produced, for jobs that have been evicted from the task pool. It also
+    records the IDs of the references that are reachable from the results of
+    evicted jobs, so that their blocks remain live after a master restart.
+    """
+    
+    def __init__(self, archive_dir):
+        self.db = anydbm.open(os.path.join(archive_dir, 'archive.db'), 'c')
+        self._lock = Lock()
+        
+    def archive_job(self, job, task_descriptors, refs, result_ref_ids=None):
+        with self._lock:
+            for descriptor in task_descriptors:
+                descriptor['job_id'] = job.id
+                self.db['task:%s' % descriptor['task_id']] = simplejson.dumps(descriptor, cls=SWReferenceJSONEncoder)
+            for ref_id, ref in refs.items():
+                self.db['ref:%s' % ref_id] = simplejson.dumps(ref, cls=SWReferenceJSONEncoder)
+            if result_ref_ids is not None:
+                for ref_id in result_ref_ids:
+                    self.db['result:%s' % str(ref_id)] = str(job.id)
+            if hasattr(self.db, 'sync'):
+                self.db.sync()
+                
+    def get_task_descriptor(self, task_id):
+        with self._lock:
+            descriptor = self.db['task:%s' % str(task_id)]
+        return simplejson.loads(descriptor, object_hook=json_decode_object_hook)
+    
+    def get_ref(self, ref_id):
+        with self._lock:
+            ref = self.db['ref:%s' % str(ref_id)]
+        return simplejson.loads(ref, object_hook=json_decode_object_hook)
+    
+    def is_result_ref(self, ref_id):
+        with self._lock:
+            return self.db.has_key('result:%s' % str(ref_id))
+
+class JobArchiver(AsynchronousExecutePlugin):
+    """
+    Evicts the tasks and intermediate references of completed jobs from the
+    task pool, which archives them in its TaskArchive. If some of a job's tasks
+    are still running, eviction is retried later. The references that are
+    reachable from a job's result are passed to the task pool, so that their
+    blocks are not declared dead.
+    """
+    
+    def __init__(self, bus, task_pool, block_store, deferred_worker, retry_interval=30.0, max_attempts=10):
+        AsynchronousExecutePlugin.__init__(self, bus, 1, 'job_completed')
+        self.task_pool = task_pool
+        self.block_store = block_store
+        self.deferred_worker = deferred_worker
+        self.retry_interval = retry_interval
+        self.max_attempts = max_attempts
+        self.attempts = {}
+        self.result_ref_ids = {}
+        
+    def get_current_ref(self, ref):
+        """
+        Returns the task pool's reference for the given reference's ID, or the
+        given reference if the task pool does not know of it.
+        """
+        try:
+            return self.task_pool.get_ref_by_id(ref.id)
+        except KeyError:
+            return ref
+        
+    def is_skywriting_value(self, ref):
+        """
+        Returns True if the given reference is the result of a Skywriting
+        task, whose block may contain further references, False if its block
+        holds opaque data, or None if its producing task is unknown.
+        """
+        provenance = getattr(ref, 'provenance', None)
+        if not isinstance(provenance, SWTaskOutputProvenance) or provenance.index < 0:
+            return False
+        try:
+            descriptor = self.task_pool.get_task_descriptor_by_id(provenance.task_id)
+        except KeyError:
+            return None
+        return descriptor['handler'] == 'swi'
+        
+    def get_result_ref_ids(self, job):
+        """
+        Returns the IDs of the references that are reachable from the given
+        job's result, following the references in each Skywriting value that
+        it reaches, or None if some of them could not be found.
+        """
+        ref_ids = set()
+        values = [job.result_ref]
+        while len(values) > 0:
+            value = values.pop()
+            if isinstance(value, SWDataValue):
+                values.append(value.value)
+            elif isinstance(value, SWRealReference):
+                if not hasattr(value, 'id') or value.id in ref_ids:
+                    continue
+                ref_ids.add(value.id)
+                ref = self.get_current_ref(value)
+                if isinstance(ref, SWDataValue):
+                    values.append(ref.value)
+                    continue
+                
+                is_value = self.is_skywriting_value(ref)
+                if is_value is False:
+                    continue
+                elif is_value is None or not isinstance(ref, SW2_ConcreteReference):
+                    cherrypy.log.error('Cannot find the references in %s for job %s' % (value.id, job.id), 'ARCHIVE', logging.WARNING)
+                    return None
+                elif ref.size_hint is None or ref.size_hint > MAX_RESULT_VALUE_SIZE:
+                    cherrypy.log.error('Not fetching large value %s for job %s' % (value.id, job.id), 'ARCHIVE', logging.WARNING)
+                    return None
+                
+                try:
+                    values.append(self.block_store.retrieve_object_for_ref(ref, 'json'))
+                except:
+                    cherrypy.log.error('Error retrieving value %s for job %s' % (value.id, job.id), 'ARCHIVE', logging.WARNING, True)
+                    return None
+            elif isinstance(value, dict):
+                values.extend(value.keys())
+                values.extend(value.values())
+            elif isinstance(value, (list, tuple)):
+                values.extend(value)
+        return ref_ids
+        
+    def handle_input(self, job):
+        try:
+            result_ref_ids = self.result_ref_ids[job.id]
+        except KeyError:
+            result_ref_ids = self.get_result_ref_ids(job)
+            if result_ref_ids is not None:
+                self.result_ref_ids[job.id] = result_ref_ids
+        
+        try:
+            remaining = self.task_pool.evict_job(job, result_ref_ids)
+        except:
+            cherrypy.log.error('Error evicting job %s' % job.id, 'ARCHIVE', logging.ERROR, True)
+            self.result_ref_ids.pop(job.id, None)
+            return
+        
+        if remaining == 0:
+            self.attempts.pop(job.id, None)
+            self.result_ref_ids.pop(job.id, None)
+            return
+        
+        attempt = self.attempts.get(job.id, 0) + 1
+        if attempt < self.max_attempts:
+            self.attempts[job.id] = attempt
+            self.deferred_worker.do_deferred_after(self.retry_interval, lambda: self.receive_input(job))
+        else:
+            cherrypy.log.error('Giving up evicting %d active task(s) for job %s' % (remaining, job.id), 'ARCHIVE', logging.WARNING)
+            del self.attempts[job.id]
+            self.result_ref_ids.pop(job.id, None)
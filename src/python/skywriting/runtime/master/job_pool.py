@@ -12,7 +12,7 @@
 # ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 from skywriting.runtime.task import TASK_STATES,\
-    build_taskpool_task_from_descriptor
+    build_taskpool_task_from_descriptor, TASK_QUEUED, TASK_ASSIGNED
 from threading import Lock, Condition
 import uuid
 from cherrypy.process import plugins
@@ -20,6 +20,7 @@ import os
 import simplejson
 from skywriting.runtime.block_store import SWReferenceJSONEncoder
 import struct
+import bisect
 import logging
 import cherrypy
 
@@ -35,25 +36,72 @@ JOB_STATE_NAMES = {}
 for (name, number) in JOB_STATES.items():
     JOB_STATE_NAMES[number] = name
 
+# Jobs in a lower-numbered priority class are always scheduled before jobs
+# in a higher-numbered class. Within a class, workers are shared between jobs
+# in proportion to their shares.
+JOB_PRIORITY_INTERACTIVE = 0
+JOB_PRIORITY_NORMAL = 1
+JOB_PRIORITY_BATCH = 2
+
+JOB_PRIORITIES = {'INTERACTIVE': JOB_PRIORITY_INTERACTIVE,
+                  'NORMAL': JOB_PRIORITY_NORMAL,
+                  'BATCH': JOB_PRIORITY_BATCH}
+
+JOB_PRIORITY_NAMES = {}
+for (name, number) in JOB_PRIORITIES.items():
+    JOB_PRIORITY_NAMES[number] = name
+
 RECORD_HEADER_STRUCT = struct.Struct('!cI')
 
+def get_journal_path(job_dir, generation):
+    # The first generation uses the original journal name, so that journals
+    # from older masters can be recovered.
+    if generation == 0:
+        return os.path.join(job_dir, 'task_journal')
+    else:
+        return os.path.join(job_dir, 'task_journal.%d' % generation)
+
 class Job:
     
-    def __init__(self, id, root_task, job_dir=None):
+    def __init__(self, id, root_task, job_dir=None, priority=JOB_PRIORITY_NORMAL, share=1.0):
         self.id = id
         self.root_task = root_task
         self.job_dir = job_dir
         
+        self.priority = priority
+        self.share = share
+        
         self.state = JOB_ACTIVE
         
         self.result_ref = None
 
         self.task_journal_fp = None
+        self.journal_writer = None
+        
+        # Completed when the last journal file to be closed has been synced.
+        self.journal_close_commit = None
+        
+        # The journal is split into generations by checkpoints. We count the
+        # records in the current generation to decide when to checkpoint.
+        self.journal_generation = 0
+        self.journal_records = 0
         
         # Counters for each task state.
         self.task_state_counts = {}
         for state in TASK_STATES.values():
             self.task_state_counts[state] = 0
+            
+        # Total size of task inputs that were stored on the worker to which
+        # each task was assigned, and that had to be fetched from elsewhere.
+        self.local_input_bytes = 0
+        self.remote_input_bytes = 0
+        
+        # Mapping from handler name to a sorted list of the running times of
+        # committed tasks with that handler, which is used to detect stragglers.
+        self.task_runtimes = {}
+        self.backup_tasks_launched = 0
+        self.backup_tasks_won = 0
+        
         self._lock = Lock()
         self._condition = Condition(self._lock)
 
@@ -70,52 +118,167 @@ class Job:
         with self._lock:
             self._condition.notify_all()
 
-    def start_journalling(self):
+    def start_journalling(self, journal_writer=None):
         if self.task_journal_fp is None and self.job_dir is not None:
-            self.task_journal_fp = open(os.path.join(self.job_dir, 'task_journal'), 'ab')
+            self.journal_writer = journal_writer
+            self.task_journal_fp = open(get_journal_path(self.job_dir, self.journal_generation), 'ab')
 
     def stop_journalling(self):
         with self._lock:
-            if self.task_journal_fp is not None:
-                self.task_journal_fp.close()
-            self.task_journal_fp = None
+            self._close_journal()
                 
         if self.job_dir is not None:
             with open(os.path.join(self.job_dir, 'result'), 'w') as result_file:
                 simplejson.dump(self.result_ref, result_file, cls=SWReferenceJSONEncoder)
 
+    def _close_journal(self):
+        if self.task_journal_fp is not None:
+            if self.journal_writer is not None:
+                self.journal_close_commit = self.journal_writer.close(self.task_journal_fp)
+            else:
+                self.task_journal_fp.close()
+        self.task_journal_fp = None
+
+    def rotate_journal(self):
+        """
+        Starts writing to a new journal file, and returns its generation
+        number, or None if the job is not being journalled. The caller must
+        hold the task pool lock, so that the new journal holds exactly the
+        records that follow a checkpoint.
+        """
+        with self._lock:
+            if self.task_journal_fp is None:
+                return None
+            self._close_journal()
+            self.journal_generation += 1
+            self.journal_records = 0
+            self.task_journal_fp = open(get_journal_path(self.job_dir, self.journal_generation), 'ab')
+            return self.journal_generation
+
+    def write_checkpoint(self, generation, root_task_descriptor, task_descriptors, refs):
+        """
+        Atomically replaces the job's checkpoint with a snapshot of its tasks
+        and references, which precedes the journal with the given generation.
+        Older journals are then deleted.
+        """
+        checkpoint = {'generation': generation,
+                      'root_task': root_task_descriptor,
+                      'tasks': task_descriptors,
+                      'refs': refs}
+        checkpoint_path = os.path.join(self.job_dir, 'checkpoint')
+        with open(checkpoint_path + '.tmp', 'wb') as checkpoint_file:
+            simplejson.dump(checkpoint, checkpoint_file, cls=SWReferenceJSONEncoder)
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        os.rename(checkpoint_path + '.tmp', checkpoint_path)
+        
+        for old_generation in range(generation - 1, -1, -1):
+            old_journal_path = get_journal_path(self.job_dir, old_generation)
+            if not os.path.exists(old_journal_path):
+                break
+            os.unlink(old_journal_path)
+
     def flush_journal(self):
+        """
+        Blocks until all of the job's journal records have reached the disk.
+        Records are written in order by the journal writer, so the callers of
+        this method share the fsyncs of a single batch (group commit).
+        """
         with self._lock:
-            if self.task_journal_fp is not None:
+            if self.task_journal_fp is None:
+                commit = self.journal_close_commit
+            elif self.journal_writer is None:
                 self.task_journal_fp.flush()
                 os.fsync(self.task_journal_fp.fileno())
+                return
+            else:
+                commit = self.journal_writer.sync(self.task_journal_fp)
+        if commit is not None:
+            commit.wait()
 
-    def add_reference(self, id, ref, should_sync=False):
+    def write_journal_record(self, record_type, record_details):
+        """
+        Appends a record to the task journal. If the job has a journal writer,
+        the record is written asynchronously; use flush_journal() to wait
+        until it is durable.
+        """
+        record = RECORD_HEADER_STRUCT.pack(record_type, len(record_details)) + record_details
         with self._lock:
-            if self.task_journal_fp is not None:
-                ref_details = simplejson.dumps({'id': id, 'ref': ref}, cls=SWReferenceJSONEncoder)
-                self.task_journal_fp.write(RECORD_HEADER_STRUCT.pack('R', len(ref_details)))
-                self.task_journal_fp.write(ref_details)
-                if should_sync:
-                    self.task_journal_fp.flush()
-                    os.fsync(self.task_journal_fp.fileno())
-
-    def add_task(self, task, should_sync=False):
+            if self.task_journal_fp is None:
+                return
+            self.journal_records += 1
+            if self.journal_writer is not None:
+                self.journal_writer.append(self.task_journal_fp, record)
+            else:
+                self.task_journal_fp.write(record)
+
+    def add_reference(self, id, ref):
+        if self.task_journal_fp is not None:
+            ref_details = simplejson.dumps({'id': id, 'ref': ref}, cls=SWReferenceJSONEncoder)
+            self.write_journal_record('R', ref_details)
+
+    def add_task(self, task):
         with self._lock:
             self.task_state_counts[task.state] = self.task_state_counts[task.state] + 1
-            if self.task_journal_fp is not None:
-                task_details = simplejson.dumps(task.as_descriptor(), cls=SWReferenceJSONEncoder)
-                self.task_journal_fp.write(RECORD_HEADER_STRUCT.pack('T', len(task_details)))
-                self.task_journal_fp.write(task_details)
-                if should_sync:
-                    self.task_journal_fp.flush()
-                    os.fsync(self.task_journal_fp.fileno())
+        if self.task_journal_fp is not None:
+            task_details = simplejson.dumps(task.as_descriptor(), cls=SWReferenceJSONEncoder)
+            self.write_journal_record('T', task_details)
+
+    def add_tasks(self, tasks):
+        """
+        Journals a batch of tasks (e.g. the children spawned by a single task)
+        as a single record.
+        """
+        with self._lock:
+            for task in tasks:
+                self.task_state_counts[task.state] = self.task_state_counts[task.state] + 1
+        if self.task_journal_fp is not None:
+            batch_details = simplejson.dumps([task.as_descriptor() for task in tasks], cls=SWReferenceJSONEncoder)
+            self.write_journal_record('B', batch_details)
 
     def record_state_change(self, prev_state, next_state):
         with self._lock:
             self.task_state_counts[prev_state] = self.task_state_counts[prev_state] - 1
             self.task_state_counts[next_state] = self.task_state_counts[next_state] + 1
 
+    def get_share_usage(self):
+        """
+        Returns the number of tasks that this job is currently running,
+        relative to its share. The scheduler favours jobs with lower usage.
+        """
+        with self._lock:
+            return self.task_state_counts[TASK_ASSIGNED] / self.share
+
+    def record_task_runtime(self, handler, runtime, was_backup=False):
+        with self._lock:
+            try:
+                runtimes = self.task_runtimes[handler]
+            except KeyError:
+                runtimes = []
+                self.task_runtimes[handler] = runtimes
+            bisect.insort(runtimes, runtime)
+            if was_backup:
+                self.backup_tasks_won += 1
+                
+    def get_median_task_runtime(self, handler, min_samples=1):
+        with self._lock:
+            try:
+                runtimes = self.task_runtimes[handler]
+            except KeyError:
+                return None
+            if len(runtimes) < min_samples:
+                return None
+            return runtimes[len(runtimes) / 2]
+        
+    def record_backup_task(self):
+        with self._lock:
+            self.backup_tasks_launched += 1
+
+    def record_input_locality(self, local_bytes, remote_bytes):
+        with self._lock:
+            self.local_input_bytes += local_bytes
+            self.remote_input_bytes += remote_bytes
+
     def as_descriptor(self):
         counts = {}
         ret = {'job_id': self.id, 
@@ -123,18 +286,27 @@ class Job:
                'state': JOB_STATE_NAMES[self.state], 
                'root_task': self.root_task.task_id if self.root_task is not None else None,
                'expected_outputs': self.root_task.expected_outputs if self.root_task is not None else None,
-               'result_ref': self.result_ref}
+               'result_ref': self.result_ref,
+               'priority': JOB_PRIORITY_NAMES[self.priority],
+               'share': self.share}
         with self._lock:
+            ret['running_tasks'] = self.task_state_counts[TASK_ASSIGNED]
+            ret['backlog'] = self.task_state_counts[TASK_QUEUED]
+            ret['local_input_bytes'] = self.local_input_bytes
+            ret['remote_input_bytes'] = self.remote_input_bytes
+            ret['backup_tasks_launched'] = self.backup_tasks_launched
+            ret['backup_tasks_won'] = self.backup_tasks_won
             for (name, state_index) in TASK_STATES.items():
                 counts[name] = self.task_state_counts[state_index]
         return ret
 
 class JobPool(plugins.SimplePlugin):
 
-    def __init__(self, bus, task_pool, journal_root, global_name_directory):
+    def __init__(self, bus, task_pool, journal_root, global_name_directory, journal_writer=None):
         plugins.SimplePlugin.__init__(self, bus)
         self.task_pool = task_pool
         self.journal_root = journal_root
+        self.journal_writer = journal_writer
         self.global_name_directory = global_name_directory
     
         # Mapping from job ID to job object.
@@ -178,7 +350,7 @@ class JobPool(plugins.SimplePlugin):
         job.state = JOB_FAILED
         self.jobs[job_id] = job
     
-    def create_job_for_task(self, task_descriptor):
+    def create_job_for_task(self, task_descriptor, priority=JOB_PRIORITY_NORMAL, share=1.0):
         
         job_id = self.allocate_job_id()
         task_id = 'root:%s' % (job_id, ) 
@@ -200,9 +372,13 @@ class JobPool(plugins.SimplePlugin):
             task_descriptor['expected_outputs'] = expected_outputs
             
         task = build_taskpool_task_from_descriptor(task_id, task_descriptor, self, None)
-        job = Job(job_id, task, job_dir)
+        job = Job(job_id, task, job_dir, priority, share)
         task.job = job
         
+        if job_dir is not None:
+            with open(os.path.join(job_dir, 'scheduling'), 'w') as scheduling_file:
+                simplejson.dump({'priority': priority, 'share': share}, scheduling_file)
+        
         self.add_job(job)
 
         return job
@@ -216,13 +392,15 @@ class JobPool(plugins.SimplePlugin):
             return None
 
     def start_job(self, job):
-        job.start_journalling()
+        job.start_journalling(self.journal_writer)
         self.task_pool.add_task(job.root_task, True)
         
+        # The job is not acknowledged until its root task is durable.
+        job.flush_journal()
+        
     def restart_job(self, job):
-        job.start_journalling()
-        self.task_pool.register_job_interest_for_output(job.root_task.expected_outputs[0], job)
-        self.task_pool.do_graph_reduction(object_ids=job.root_task.expected_outputs)
+        job.start_journalling(self.journal_writer)
+        self.task_pool.resume_job(job)
 
     def wait_for_completion(self, job):
         with job._lock:
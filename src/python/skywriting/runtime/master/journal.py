@@ -0,0 +1,179 @@
+# Copyright (c) 2010 Derek Murray <derek.murray@cl.cam.ac.uk>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+from __future__ import with_statement
+from skywriting.runtime.plugins import AsynchronousExecutePlugin,\
+    THREAD_TERMINATOR
+from skywriting.runtime.master.job_pool import JOB_ACTIVE
+from cherrypy.process import plugins
+from threading import Event
+from Queue import Empty
+import os
+import cherrypy
+import logging
+
+JOURNAL_WRITE = 0
+JOURNAL_CLOSE = 1
+
+class JournalCommit:
+    """
+    A handle on a journal write, which allows the caller to wait until the
+    write has completed (and, if it was requested, reached the disk).
+    """
+
+    def __init__(self):
+        self.error = None
+        self._event = Event()
+
+    def completed(self, error=None):
+        self.error = error
+        self._event.set()
+
+    def is_completed(self):
+        return self._event.isSet()
+
+    def wait(self, timeout=None):
+        self._event.wait(timeout)
+        if self.error is not None:
+            raise self.error
+        return self._event.isSet()
+
+class JournalWriter(AsynchronousExecutePlugin):
+    """
+    Writes journal records on behalf of all jobs, using a single thread. The
+    writer takes all of the records that are waiting in its queue, writes them,
+    and then calls fsync once on each file that needs to be synced, before
+    completing the callers' JournalCommits (group commit). Records are written
+    in the order that they were appended.
+    """
+
+    def __init__(self, bus, max_batch_size=4096):
+        AsynchronousExecutePlugin.__init__(self, bus, 1, 'journal_write')
+        self.max_batch_size = max_batch_size
+
+        # Counters for the journal statistics.
+        self.records_written = 0
+        self.batches_written = 0
+        self.syncs = 0
+
+    def append(self, fp, data, should_sync=False):
+        commit = JournalCommit()
+        self.receive_input((JOURNAL_WRITE, fp, data, should_sync, commit))
+        return commit
+
+    def sync(self, fp):
+        return self.append(fp, '', True)
+
+    def close(self, fp):
+        commit = JournalCommit()
+        self.receive_input((JOURNAL_CLOSE, fp, None, True, commit))
+        return commit
+
+    def thread_main(self):
+        while True:
+            input = self.queue.get()
+            if input is THREAD_TERMINATOR:
+                break
+
+            batch = [input]
+            should_terminate = False
+            while len(batch) < self.max_batch_size:
+                try:
+                    input = self.queue.get_nowait()
+                except Empty:
+                    break
+                if input is THREAD_TERMINATOR:
+                    # Finish writing the current batch before we exit.
+                    should_terminate = True
+                    break
+                batch.append(input)
+
+            self.write_batch(batch)
+            if should_terminate:
+                break
+
+    def write_batch(self, batch):
+        files_to_sync = []
+        error = None
+        try:
+            for (op, fp, data, should_sync, _) in batch:
+                if should_sync and fp not in files_to_sync:
+                    files_to_sync.append(fp)
+                if op == JOURNAL_WRITE:
+                    if len(data) > 0:
+                        fp.write(data)
+                        self.records_written += 1
+                elif op == JOURNAL_CLOSE:
+                    fp.flush()
+                    os.fsync(fp.fileno())
+                    fp.close()
+                    files_to_sync.remove(fp)
+
+            for fp in files_to_sync:
+                fp.flush()
+                os.fsync(fp.fileno())
+                self.syncs += 1
+            self.batches_written += 1
+        except Exception, ex:
+            cherrypy.log.error('Error writing batch of %d journal record(s)' % len(batch), 'JOURNAL', logging.ERROR, True)
+            error = ex
+
+        for (_, _, _, _, commit) in batch:
+            commit.completed(error)
+
+class JournalCheckpointer(plugins.SimplePlugin):
+    """
+    Periodically checkpoints each active job that has written many journal
+    records since its last checkpoint. On recovery, the master loads the
+    checkpoint and replays only the journal records that follow it.
+    """
+
+    def __init__(self, bus, job_pool, task_pool, deferred_worker, interval=60.0, min_records=1000):
+        plugins.SimplePlugin.__init__(self, bus)
+        self.job_pool = job_pool
+        self.task_pool = task_pool
+        self.deferred_worker = deferred_worker
+        self.interval = interval
+        self.min_records = min_records
+        self.is_stopping = False
+
+    def subscribe(self):
+        self.bus.subscribe('stop', self.server_stopping, 10)
+        self.deferred_worker.do_deferred_after(self.interval, self.check_journals)
+
+    def unsubscribe(self):
+        self.bus.unsubscribe('stop', self.server_stopping)
+
+    def server_stopping(self):
+        self.is_stopping = True
+
+    def check_journals(self):
+        if self.is_stopping:
+            return
+        for job in self.job_pool.jobs.values():
+            if job.state == JOB_ACTIVE and job.journal_records >= self.min_records:
+                self.checkpoint_job(job)
+        self.deferred_worker.do_deferred_after(self.interval, self.check_journals)
+
+    def checkpoint_job(self, job):
+        try:
+            snapshot = self.task_pool.checkpoint_job(job)
+            if snapshot is None:
+                return
+            generation, root_task_descriptor, task_descriptors, refs = snapshot
+            job.write_checkpoint(generation, root_task_descriptor, task_descriptors, refs)
+            cherrypy.log.error('Checkpointed %d task(s) and %d reference(s) for job %s' % (len(task_descriptors) + 1, len(refs), job.id), 'JOURNAL', logging.INFO)
+        except:
+            # The previous checkpoint and journals are only deleted after the
+            # new checkpoint is written, so the job can still be recovered.
+            cherrypy.log.error('Error checkpointing job %s' % job.id, 'JOURNAL', logging.ERROR, True)
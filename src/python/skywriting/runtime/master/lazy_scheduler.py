@@ -11,7 +11,9 @@
 # WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
 # ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
-from skywriting.runtime.references import SWURLReference, SW2_ConcreteReference
+from __future__ import with_statement
+from skywriting.runtime.references import SWURLReference, SW2_ConcreteReference,\
+    SW2_SliceReference
 from skywriting.runtime.block_store import get_netloc_for_sw_url
 
 '''
@@ -20,20 +22,114 @@ Created on 15 Apr 2010
 @author: dgm36
 '''
 from skywriting.runtime.plugins import AsynchronousExecutePlugin
-from Queue import Empty
-from skywriting.runtime.master.task_pool import TASK_QUEUED
+from Queue import Queue, Empty
+from skywriting.runtime.task import TASK_QUEUED, TASK_ASSIGNED
+from threading import Lock
+import cherrypy
+import logging
+import heapq
+import time
+
+# Locality levels through which a delayed task is relaxed.
+LOCALITY_HOST = 0
+LOCALITY_ANY = 1
+
+# Tasks with these handlers are never run speculatively, because they may
+# spawn tasks with non-deterministic names.
+NON_SPECULATIVE_HANDLERS = set(['swi'])
+
+# The number of committed tasks with the same handler that we must see before
+# judging whether a running task is a straggler, and the minimum amount of
+# time (in seconds) by which a straggler must exceed the median running time.
+MIN_RUNTIME_SAMPLES = 5
+MIN_STRAGGLER_DELAY = 5.0
 
 class LazyScheduler(AsynchronousExecutePlugin):
     
-    def __init__(self, bus, task_pool, worker_pool):
+    def __init__(self, bus, task_pool, worker_pool, deferred_worker, locality_delay=2.0, speculation_threshold=2.0, speculation_interval=5.0):
         AsynchronousExecutePlugin.__init__(self, bus, 1, 'schedule')
         self.worker_pool = worker_pool
         self.task_pool = task_pool
+        self.deferred_worker = deferred_worker
+        
+        # The time (in seconds) for which a task will wait for a worker that
+        # holds its inputs, before it may run on any worker on the same host,
+        # and then the same time again before it may run on any worker.
+        self.locality_delay = locality_delay
+        
+        # Set when a scheduling pass has been requested but not yet started.
+        # Any number of schedule events that arrive before the pass starts
+        # are coalesced into that pass.
+        self.is_dirty = False
+        self._dirty_lock = Lock()
+        
+        # Mapping from task ID to the queues that contain that task, so that
+        # we can remove the task from all of them as soon as it is assigned.
+        # N.B. This is only accessed from the scheduler thread.
+        self.queues_for_task = {}
+        
+        # A thread-safe queue of tasks that have left the QUEUED state outside
+        # the scheduler thread, which are removed from the worker queues at
+        # the start of the next scheduling pass.
+        self.dequeued_tasks = Queue()
+        
+        # Heap of (deadline, sequence, level, task, queues, hostname) entries
+        # for tasks that are waiting to be added to a less-local queue. An
+        # entry is stale if the task is no longer queued in the given list.
+        self.delayed_tasks = []
+        self.delayed_task_sequence = 0
+        
+        # Deadline of the earliest outstanding wakeup timer, if any.
+        self.next_wakeup = None
+        
+        # A backup copy of a running task will be launched if it has been
+        # running for speculation_threshold times the median running time of
+        # similar tasks. Set this to None to disable speculative execution.
+        self.speculation_threshold = speculation_threshold
+        self.speculation_interval = speculation_interval
+        self.is_stopping = False
+        
+    def subscribe(self):
+        AsynchronousExecutePlugin.subscribe(self)
+        self.bus.subscribe('stop', self.server_stopping, 10)
+        self.bus.subscribe('task_dequeued', self.task_dequeued)
+        if self.speculation_threshold is not None:
+            self.deferred_worker.do_deferred_after(self.speculation_interval, self.check_for_stragglers)
+            
+    def unsubscribe(self):
+        AsynchronousExecutePlugin.unsubscribe(self)
+        self.bus.unsubscribe('stop', self.server_stopping)
+        self.bus.unsubscribe('task_dequeued', self.task_dequeued)
+        
+    def server_stopping(self):
+        self.is_stopping = True
+        
+    def task_dequeued(self, task):
+        self.dequeued_tasks.put(task)
+        self.receive_input()
+        
+    def receive_input(self, input=None):
+        with self._dirty_lock:
+            if self.is_dirty:
+                return
+            self.is_dirty = True
+        AsynchronousExecutePlugin.receive_input(self, input)
         
     def handle_input(self, input):
         
-        # 1. Read runnable tasks from the task pool's task queue, and assign
-        #    them to workers.
+        # Clear the flag before we start, so that any events that arrive
+        # during this pass will trigger exactly one more pass.
+        with self._dirty_lock:
+            self.is_dirty = False
+        
+        # 1. Remove tasks that have been aborted or failed from the worker
+        #    queues, and then read runnable tasks from the task pool's task
+        #    queue, and assign them to workers.
+        while True:
+            try:
+                self.remove_task_from_worker_queues(self.dequeued_tasks.get_nowait())
+            except Empty:
+                break
         queue = self.task_pool.get_task_queue()
         while True:
             try:
@@ -42,29 +138,172 @@ class LazyScheduler(AsynchronousExecutePlugin):
             except Empty:
                 break
         
-        # 2. Assign workers tasks from their respective queues.
-        idle_workers = self.worker_pool.get_idle_workers()
-        attempt_count = 0
-        while len(idle_workers) > 0:
-            retry_workers = []
-            for worker in idle_workers:
+        # Add any tasks that have waited long enough for a local worker to
+        # less-local queues.
+        self.relax_delayed_tasks(time.time())
+        
+        # 2. Assign workers tasks from their respective queues. If nothing is
+        #    queued, there is no need to look at the workers.
+        if len(self.queues_for_task) > 0:
+            self.assign_queued_tasks()
+            
+        # 3. Use any workers that are still idle to run backup copies of
+        #    straggling tasks.
+        if self.speculation_threshold is not None:
+            self.launch_backup_tasks(time.time())
+            
+        self.schedule_wakeup()
+
+    def assign_queued_tasks(self):
+        # Each worker may have several free slots, so we hand out at most one
+        # task per worker in each round, in order to spread tasks across
+        # workers.
+        worker_attempts = [(worker, 0) for worker in self.worker_pool.get_idle_workers()]
+        while len(worker_attempts) > 0 and len(self.queues_for_task) > 0:
+            retry_attempts = []
+            for worker, attempt_count in worker_attempts:
+                if worker.failed:
+                    continue
                 try:
-                    task = worker.queues[attempt_count].get(block=False)
-                    # Skip over tasks that have been aborted or otherwise scheduled.
-                    while task.state != TASK_QUEUED:
-                        task = worker.queues[attempt_count].get(block=False)
-                    self.worker_pool.execute_task_on_worker(worker, task)
-                except Empty:
-                    # Try again on next round of attempts.
-                    retry_workers.append(worker)
+                    queue = worker.queues[attempt_count]
                 except IndexError:
                     # No more queues for worker: now truly idle.
-                    pass
-            idle_workers = retry_workers
-            attempt_count += 1
+                    continue
+                task = self.get_task_for_worker(worker, queue)
+                if task is None:
+                    # Try the worker's next queue on the next round.
+                    retry_attempts.append((worker, attempt_count + 1))
+                else:
+                    self.remove_task_from_worker_queues(task)
+                    self.record_input_locality(worker, task)
+                    self.worker_pool.execute_task_on_worker(worker, task)
+                    if worker.has_free_slot():
+                        retry_attempts.append((worker, attempt_count))
+            worker_attempts = retry_attempts
 
-    # Based on TaskPool.compute_best_worker_for_task()
-    def compute_best_worker_for_task(self, task):
+    def launch_backup_tasks(self, now):
+        idle_workers = [x for x in self.worker_pool.get_idle_workers() if not x.failed and x.has_free_slot()]
+        if len(idle_workers) == 0:
+            return
+        
+        # A task is a straggler if it has been running for much longer than
+        # the median running time of committed tasks with the same handler in
+        # the same job.
+        stragglers = []
+        for task in self.worker_pool.get_running_tasks():
+            if task.state != TASK_ASSIGNED or task.backup_worker is not None or task.job is None:
+                continue
+            if task.handler in NON_SPECULATIVE_HANDLERS or task.assigned_time is None:
+                continue
+            median_runtime = task.job.get_median_task_runtime(task.handler, MIN_RUNTIME_SAMPLES)
+            if median_runtime is None:
+                continue
+            elapsed = now - task.assigned_time
+            if elapsed > max(median_runtime * self.speculation_threshold, median_runtime + MIN_STRAGGLER_DELAY):
+                stragglers.append((elapsed - median_runtime, task))
+                
+        # Back up the slowest stragglers first.
+        stragglers.sort(key=lambda (delay, task): delay, reverse=True)
+        for _, task in stragglers:
+            for worker in idle_workers:
+                if worker is not task.worker and worker.has_free_slot() and worker.can_run_task(task):
+                    if self.task_pool.launch_backup_task(task, worker, self.worker_pool):
+                        cherrypy.log.error('Launched backup of task %s on worker %s' % (task.task_id, worker.id), 'SCHEDULER', logging.INFO)
+                        task.job.record_backup_task()
+                    break
+
+    def check_for_stragglers(self):
+        if not self.is_stopping:
+            self.bus.publish('schedule')
+            self.deferred_worker.do_deferred_after(self.speculation_interval, self.check_for_stragglers)
+
+    def relax_delayed_tasks(self, now):
+        while len(self.delayed_tasks) > 0 and self.delayed_tasks[0][0] <= now:
+            deadline, _, level, task, queues, hostname = heapq.heappop(self.delayed_tasks)
+            if self.queues_for_task.get(task.task_id) is not queues:
+                # Task has been assigned or requeued since the entry was added.
+                continue
+            if level == LOCALITY_HOST:
+                queue = self.worker_pool.host_queues.get_queue_for_feature(hostname)
+                self.add_delayed_task(deadline + self.locality_delay, LOCALITY_ANY, task, queues, hostname)
+            else:
+                queue = self.worker_pool.feature_queues.get_queue_for_feature(task.handler)
+            queue.put(task)
+            queues.append(queue)
+                
+    def add_delayed_task(self, deadline, level, task, queues, hostname):
+        heapq.heappush(self.delayed_tasks, (deadline, self.delayed_task_sequence, level, task, queues, hostname))
+        self.delayed_task_sequence += 1
+
+    def schedule_wakeup(self):
+        """
+        Ensures that a scheduling pass will run when the earliest delayed task
+        becomes eligible to run on a less-local worker.
+        """
+        if len(self.delayed_tasks) == 0:
+            return
+        deadline = self.delayed_tasks[0][0]
+        with self._dirty_lock:
+            if self.next_wakeup is not None and self.next_wakeup <= deadline:
+                return
+            self.next_wakeup = deadline
+        self.deferred_worker.do_deferred_after(max(deadline - time.time(), 0.0), lambda: self.wakeup(deadline))
+        
+    def wakeup(self, deadline):
+        with self._dirty_lock:
+            if self.next_wakeup == deadline:
+                self.next_wakeup = None
+        self.bus.publish('schedule')
+
+    def record_input_locality(self, worker, task):
+        if task.job is None:
+            return
+        local_bytes = 0
+        remote_bytes = 0
+        for netloc, size in self.get_input_sizes_by_netloc(task, worker.netloc).items():
+            if netloc == worker.netloc:
+                local_bytes += size
+            else:
+                remote_bytes += size
+        task.job.record_input_locality(local_bytes, remote_bytes)
+
+    def get_task_for_worker(self, worker, queue):
+        """
+        Returns the task at the head of the given queue if it fits on the
+        given worker, or None if there is no such task.
+        """
+        while True:
+            task = queue.peek()
+            if task is None:
+                return None
+            if task.state != TASK_QUEUED:
+                # The task has left the QUEUED state since this pass started,
+                # so we remove it from the queues now instead of waiting for
+                # its task_dequeued event.
+                self.remove_task_from_worker_queues(task)
+                continue
+            if worker.can_run_task(task):
+                return task
+            else:
+                # The worker lacks the task's handler, or the task does not fit
+                # in its remaining capacity, so leave it for another worker.
+                return None
+
+    def remove_task_from_worker_queues(self, task):
+        try:
+            queues = self.queues_for_task.pop(task.task_id)
+        except KeyError:
+            return
+        for queue in queues:
+            queue.remove(task)
+
+    def get_input_sizes_by_netloc(self, task, fetching_netloc=None):
+        """
+        Returns a dictionary mapping each netloc to the total size of the
+        task's inputs that are stored there. If fetching_netloc is specified,
+        each input is attributed to a single netloc, which is fetching_netloc
+        if it holds a copy of that input.
+        """
         netlocs = {}
         for input in task.inputs.values():
             if isinstance(input, SWURLReference):
@@ -73,20 +312,27 @@ class LazyScheduler(AsynchronousExecutePlugin):
                     # cluster. So we make a guess
                     # TODO: Do something sensible here; probably HTTP HEAD
                     input.size_hint = 10000000
-                for url in input.urls:
-                    netloc = get_netloc_for_sw_url(url)
-                    try:
-                        current_saving_for_netloc = netlocs[netloc]
-                    except KeyError:
-                        current_saving_for_netloc = 0
-                    netlocs[netloc] = current_saving_for_netloc + input.size_hint
-            elif isinstance(input, SW2_ConcreteReference) and input.size_hint is not None:
-                for netloc in input.location_hints:
-                    try:
-                        current_saving_for_netloc = netlocs[netloc]
-                    except KeyError:
-                        current_saving_for_netloc = 0
-                    netlocs[netloc] = current_saving_for_netloc + input.size_hint
+                input_netlocs = [get_netloc_for_sw_url(url) for url in input.urls]
+            elif (isinstance(input, SW2_ConcreteReference) or isinstance(input, SW2_SliceReference)) and input.size_hint is not None:
+                input_netlocs = list(input.location_hints)
+            else:
+                continue
+            if fetching_netloc is not None and len(input_netlocs) > 0:
+                if fetching_netloc in input_netlocs:
+                    input_netlocs = [fetching_netloc]
+                else:
+                    input_netlocs = input_netlocs[:1]
+            for netloc in input_netlocs:
+                try:
+                    current_saving_for_netloc = netlocs[netloc]
+                except KeyError:
+                    current_saving_for_netloc = 0
+                netlocs[netloc] = current_saving_for_netloc + input.size_hint
+        return netlocs
+
+    # Based on TaskPool.compute_best_worker_for_task()
+    def compute_best_worker_for_task(self, task):
+        netlocs = self.get_input_sizes_by_netloc(task)
         ranked_netlocs = [(saving, netloc) for (netloc, saving) in netlocs.items()]
         filtered_ranked_netlocs = filter(lambda (saving, netloc) : self.worker_pool.get_worker_at_netloc(netloc) is not None, ranked_netlocs)
         if len(filtered_ranked_netlocs) > 0:
@@ -97,8 +343,20 @@ class LazyScheduler(AsynchronousExecutePlugin):
     
     # Based on TaskPool.add_task_to_queues()
     def add_task_to_worker_queues(self, task):
+        if task.state != TASK_QUEUED:
+            return
+        # Remove any stale entries if the task is being requeued.
+        self.remove_task_from_worker_queues(task)
         best_worker = self.compute_best_worker_for_task(task)
-        if best_worker is not None:
-            best_worker.local_queue.put(task)
-        handler_queue = self.worker_pool.feature_queues.get_queue_for_feature(task.handler)
-        handler_queue.put(task)
\ No newline at end of file
+        if best_worker is None:
+            queues = [self.worker_pool.feature_queues.get_queue_for_feature(task.handler)]
+        elif self.locality_delay <= 0:
+            queues = [best_worker.local_queue, self.worker_pool.feature_queues.get_queue_for_feature(task.handler)]
+        else:
+            # Delay scheduling: the task will only be added to the host and
+            # feature queues if the best worker does not pick it up in time.
+            queues = [best_worker.local_queue]
+            self.add_delayed_task(time.time() + self.locality_delay, LOCALITY_HOST, task, queues, best_worker.hostname)
+        for queue in queues:
+            queue.put(task)
+        self.queues_for_task[task.task_id] = queues
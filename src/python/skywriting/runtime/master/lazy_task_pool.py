@@ -16,21 +16,27 @@ from Queue import Queue
 from cherrypy.process import plugins
 from skywriting.runtime.master.job_pool import Job
 from skywriting.runtime.references import SW2_FutureReference, \
-    SW2_ConcreteReference, SWErrorReference, combine_references, SW2_StreamReference
+    SW2_ConcreteReference, SWErrorReference, combine_references, SW2_StreamReference,\
+    SWNoProvenance, SW2_TombstoneReference
 from skywriting.runtime.task import TASK_CREATED, TASK_BLOCKING, TASK_RUNNABLE, \
-    TASK_COMMITTED, build_taskpool_task_from_descriptor, TASK_QUEUED, TASK_FAILED
+    TASK_COMMITTED, build_taskpool_task_from_descriptor, TASK_QUEUED, TASK_FAILED, \
+    TASK_ASSIGNED
 from threading import Lock
 import cherrypy
 import collections
 import logging
+import time
 import uuid
 
 class LazyTaskPool(plugins.SimplePlugin):
     
-    def __init__(self, bus):
+    def __init__(self, bus, archive=None):
     
         # Used for publishing schedule events.
         self.bus = bus
+        
+        # On-disk store for the metadata of evicted tasks and references.
+        self.archive = archive
     
         # Mapping from task ID to task object.
         self.tasks = {}
@@ -48,6 +54,10 @@ class LazyTaskPool(plugins.SimplePlugin):
         # produce by lazy graph reduction.
         self.job_outputs = {}
         
+        # Mapping from job ID to the IDs of tasks in that job, which is used
+        # to evict the tasks when the job completes.
+        self.tasks_for_job = {}
+        
         # A thread-safe queue of runnable tasks, which we use to pass tasks to
         # the LazyScheduler.
         self.task_queue = Queue()
@@ -59,64 +69,159 @@ class LazyTaskPool(plugins.SimplePlugin):
         
     def subscribe(self):
         self.bus.subscribe('task_failed', self.task_failed)
+        self.bus.subscribe('blocks_removed', self.blocks_removed)
         
     def unsubscribe(self):
         self.bus.unsubscribe('task_failed', self.task_failed)
+        self.bus.unsubscribe('blocks_removed', self.blocks_removed)
+        
+    def blocks_removed(self, worker, block_ids):
+        self.publish_block_list(worker.netloc, {}, set(block_ids))
         
     def get_task_by_id(self, task_id):
         return self.tasks[task_id]
+    
+    def get_task_descriptor_by_id(self, task_id):
+        """
+        Returns the long descriptor for the given task, which may have been
+        evicted and archived.
+        """
+        try:
+            return self.tasks[task_id].as_descriptor(long=True)
+        except KeyError:
+            if self.archive is None:
+                raise
+            return self.archive.get_task_descriptor(task_id)
         
     def get_ref_by_id(self, ref_id):
         with self._lock:
-            return self.ref_for_output[ref_id]
+            try:
+                return self.ref_for_output[ref_id]
+            except KeyError:
+                if self.archive is None:
+                    raise
+        return self.archive.get_ref(ref_id)
         
     def get_reference_info(self, id):
         with self._lock:
-            ref = self.ref_for_output[id]
             try:
-                consumers = self.consumers_for_output[id]
+                ref = self.ref_for_output[id]
+                try:
+                    consumers = self.consumers_for_output[id]
+                except KeyError:
+                    consumers = []
+                task = self.task_for_output[id]
+                return {'ref': ref, 'consumers': list(consumers), 'task': task.as_descriptor()}
             except KeyError:
-                consumers = []
-            task = self.task_for_output[id]
-            return {'ref': ref, 'consumers': list(consumers), 'task': task.as_descriptor()}
+                if self.archive is None:
+                    raise
+        ref = self.archive.get_ref(id)
+        return {'ref': ref, 'consumers': [], 'task': self.archive.get_task_descriptor(ref.provenance.task_id)}
         
     def add_task(self, task, is_root_task=False):
-        # We don't add tasks multiple times (for example, when replaying a
-        # failed task.
-        if task.task_id in self.tasks:
-            return
-        
-        if task.task_id not in self.tasks:
-            self.tasks[task.task_id] = task
-        
-        if is_root_task:
-            self.job_outputs[task.expected_outputs[0]] = task.job
-            self.register_job_interest_for_output(task.expected_outputs[0], task.job)
-        
-        task.job.add_task(task)
-        
-        # If any of the task outputs are being waited on, we should reduce this
-        # task's graph. 
+        # N.B. Jobs are recovered concurrently, so we must hold the lock while
+        #      modifying the task pool. We also journal the task under the
+        #      lock, so that it cannot be missed by a concurrent checkpoint.
         with self._lock:
+            # We don't add tasks multiple times (for example, when replaying a
+            # failed task.
+            if task.task_id in self.tasks:
+                return
+            
+            self.tasks[task.task_id] = task
+            try:
+                self.tasks_for_job[task.job.id].append(task.task_id)
+            except KeyError:
+                self.tasks_for_job[task.job.id] = [task.task_id]
+            
+            if is_root_task:
+                self.job_outputs[task.expected_outputs[0]] = task.job
+                self.register_job_interest_for_output(task.expected_outputs[0], task.job)
+            
+            # If any of the task outputs are being waited on, we should reduce
+            # this task's graph.
+            task.job.add_task(task)
             should_reduce = self.register_task_outputs(task)
             if should_reduce:
                 self.do_graph_reduction(root_tasks=[task])
             elif is_root_task:
                 self.do_root_graph_reduction()
             
-    def task_completed(self, task, commit_bindings):
-        task.set_state(TASK_COMMITTED)
-        worker = task.worker
+    def add_tasks(self, tasks, job):
+        """
+        Adds a batch of non-root tasks from the same job, such as the children
+        spawned by a single task. The batch is journalled as a single record,
+        and the graph is reduced once for all of the new tasks.
+        """
+        with self._lock:
+            new_tasks = [x for x in tasks if x.task_id not in self.tasks]
+            if len(new_tasks) == 0:
+                return
+            
+            job_task_ids = self.tasks_for_job.setdefault(job.id, [])
+            for task in new_tasks:
+                self.tasks[task.task_id] = task
+                job_task_ids.append(task.task_id)
+            
+            job.add_tasks(new_tasks)
+            
+            # Register all of the outputs before reducing, so that a task may
+            # depend on the output of a later task in the same batch.
+            root_tasks = [x for x in new_tasks if self.register_task_outputs(x)]
+            if len(root_tasks) > 0:
+                self.do_graph_reduction(root_tasks=root_tasks)
+            
+    def resume_job(self, job):
+        """
+        Restarts lazy graph reduction for a recovered job.
+        """
+        with self._lock:
+            self.register_job_interest_for_output(job.root_task.expected_outputs[0], job)
+            self.do_graph_reduction(object_ids=job.root_task.expected_outputs)
+            
+    def task_completed(self, task, commit_bindings, worker=None):
+        if worker is None:
+            worker = task.worker
+        
+        # If a backup copy of the task was running, the first copy to commit
+        # wins, and the other copy is aborted.
+        with self._lock:
+            is_first_commit = task.state != TASK_COMMITTED
+            if is_first_commit:
+                self.set_task_state(task, TASK_COMMITTED)
+                losing_workers = [x for x in task.get_running_workers() if x is not worker]
+                start_time = task.get_start_time_on_worker(worker)
+                
+        if is_first_commit:
+            if start_time is not None and task.job is not None:
+                task.job.record_task_runtime(task.handler, time.time() - start_time, worker is task.backup_worker)
+            for losing_worker in losing_workers:
+                self.bus.publish('abort_task', task, losing_worker)
         
         # Need to notify all of the consumers, which may make other tasks
-        # runnable.
+        # runnable. N.B. A losing copy that commits before it is aborted
+        # produces outputs with the same names, which are combined with the
+        # winner's outputs as additional replicas.
         self.publish_refs(commit_bindings, task.job)
-        self.bus.publish('worker_idle', worker)
-        
+        self.bus.publish('worker_idle', worker, task)
+        
+    def launch_backup_task(self, task, worker, worker_pool):
+        """
+        Runs a backup copy of the given task on the given worker, unless the
+        task is no longer running. This is done under the lock, so that if
+        either copy later commits, task_completed will abort the other copy.
+        Returns True if the backup copy was launched.
+        """
+        with self._lock:
+            if task.state != TASK_ASSIGNED or task.backup_worker is not None:
+                return False
+            worker_pool.execute_backup_task_on_worker(worker, task)
+            return True
+
     def get_task_queue(self):
         return self.task_queue
         
-    def task_failed(self, task, payload):
+    def task_failed(self, task, payload, failed_worker=None):
 
         (reason, details, bindings) = payload
 
@@ -129,18 +234,27 @@ class LazyTaskPool(plugins.SimplePlugin):
 
         self.publish_refs(bindings, task.job)
 
+        if failed_worker is None:
+            failed_worker = task.worker
+
         with self._lock:
-            if reason == 'WORKER_FAILED':
+            if self.is_redundant_failure(task, failed_worker, reason):
+                # Another copy of the task has committed or is still running,
+                # so we only need to release the failed copy's slot.
+                if reason != 'WORKER_FAILED':
+                    worker = failed_worker
+            
+            elif reason == 'WORKER_FAILED':
                 # Try to reschedule task.
                 task.current_attempt += 1
                 # XXX: Remove this hard-coded constant. We limit the number of
                 #      retries in case the task is *causing* the failures.
                 if task.current_attempt > 3:
-                    task.set_state(TASK_FAILED)
+                    self.set_task_state(task, TASK_FAILED)
                     should_notify_outputs = True
                 else:
                     cherrypy.log.error('Rescheduling task %s after worker failure' % task.task_id, 'TASKPOOL', logging.WARNING)
-                    task.set_state(TASK_FAILED)
+                    self.set_task_state(task, TASK_FAILED)
                     self.add_runnable_task(task)
                     self.bus.publish('schedule')
                     
@@ -152,7 +266,7 @@ class LazyTaskPool(plugins.SimplePlugin):
             elif reason == 'RUNTIME_EXCEPTION':
                 # A hard error, so kill the entire job, citing the problem.
                 worker = task.worker
-                task.set_state(TASK_FAILED)
+                self.set_task_state(task, TASK_FAILED)
                 should_notify_outputs = True
 
         # Doing this outside the lock because this leads via add_refs_to_id
@@ -163,10 +277,245 @@ class LazyTaskPool(plugins.SimplePlugin):
                 self._publish_ref(output, SWErrorReference(reason, details), task.job)
 
         if worker is not None:
-            self.bus.publish('worker_idle', worker)
+            self.bus.publish('worker_idle', worker, task)
+    
+    def is_redundant_failure(self, task, failed_worker, reason):
+        if task.state == TASK_COMMITTED:
+            return True
+        elif task.state != TASK_ASSIGNED or task.backup_worker is None:
+            return False
+        elif reason == 'RUNTIME_EXCEPTION':
+            # Tasks are deterministic, so the other copy will fail as well.
+            return False
+        
+        # Forget about the failed copy, and let the other copy continue.
+        if failed_worker is task.backup_worker:
+            task.backup_worker = None
+            task.backup_assigned_time = None
+            return True
+        elif failed_worker is task.worker:
+            task.worker = task.backup_worker
+            task.assigned_time = task.backup_assigned_time
+            task.backup_worker = None
+            task.backup_assigned_time = None
+            return True
+        else:
+            return False
+    
+    def evict_job(self, job, result_ref_ids=None):
+        """
+        Removes the tasks and intermediate references of the given completed
+        job from the pool, after archiving them. A task is not evicted if it
+        is still active, or if a task from another job is waiting for one of
+        its outputs. The job's own outputs remain available. The IDs of the
+        references reachable from the job's result should be given, so that
+        the archive keeps their blocks live; if they are None, or if there is
+        no archive, no blocks are declared dead. Returns the number of the
+        job's tasks that remain in the pool.
+        """
+        if self.archive is None:
+            result_ref_ids = None
+        
+        with self._lock:
+            try:
+                task_ids = self.tasks_for_job[job.id]
+            except KeyError:
+                return 0
+            evicted_tasks = self.get_evictable_tasks(job, task_ids)
+            task_descriptors = [task.as_descriptor(long=True) for task in evicted_tasks.values()]
+            refs = {}
+            for task in evicted_tasks.values():
+                for output in task.expected_outputs:
+                    try:
+                        refs[output] = self.ref_for_output[output]
+                    except KeyError:
+                        pass
+
+        # Writing the archive may be slow, so we do not hold the lock.
+        if self.archive is not None:
+            self.archive.archive_job(job, task_descriptors, refs, result_ref_ids)
+            
+        with self._lock:
+            # Tasks from other jobs may have started waiting for some of these
+            # tasks' outputs, so we must check again.
+            evicted_tasks = self.get_evictable_tasks(job, evicted_tasks.keys())
+            if result_ref_ids is not None:
+                dead_refs = self.get_dead_refs(job, evicted_tasks)
+            else:
+                dead_refs = []
+            for task in evicted_tasks.values():
+                self.evict_task(task, job)
+            for ref in dead_refs:
+                self.ref_for_output.pop(ref.id, None)
+            remaining_task_ids = [x for x in task_ids if x not in evicted_tasks]
+            if len(remaining_task_ids) > 0:
+                self.tasks_for_job[job.id] = remaining_task_ids
+            else:
+                del self.tasks_for_job[job.id]
+            
+        cherrypy.log.error('Evicted %d task(s) for job %s' % (len(evicted_tasks), job.id), 'TASKPOOL', logging.INFO)
+        if len(dead_refs) > 0:
+            self.bus.publish('blocks_dead', dead_refs)
+        return len(remaining_task_ids)
+    
+    def get_dead_refs(self, job, evicted_tasks):
+        """
+        Returns the concrete references whose blocks are no longer reachable
+        once the given tasks are evicted. These are the outputs of the evicted
+        tasks, and the blocks (such as continuations and spawn arguments) that
+        they produced for one another, except the job's outputs and the
+        references that the archive records as reachable from the results of
+        evicted jobs.
+        """
+        dead_refs = {}
+        for task in evicted_tasks.values():
+            for output in task.expected_outputs:
+                if output in self.job_outputs or self.archive.is_result_ref(output):
+                    continue
+                ref = self.ref_for_output.get(output)
+                if isinstance(ref, SW2_ConcreteReference):
+                    dead_refs[output] = ref
+            for ref in task.dependencies.values():
+                if not isinstance(ref, SW2_ConcreteReference) or ref.id in self.job_outputs or self.archive.is_result_ref(ref.id):
+                    continue
+                try:
+                    producer_id = ref.provenance.task_id
+                except AttributeError:
+                    continue
+                if producer_id in evicted_tasks and producer_id != task.task_id:
+                    current_ref = self.ref_for_output.get(ref.id, ref)
+                    if isinstance(current_ref, SW2_ConcreteReference):
+                        dead_refs[ref.id] = current_ref
+        return dead_refs.values()
+    
+    def checkpoint_job(self, job):
+        """
+        Takes a snapshot of the given job's tasks and of the references that
+        they produce or consume, and starts a new journal for the job's
+        subsequent records. Returns a tuple of the new journal generation, the
+        root task descriptor, the other task descriptors (with each parent
+        before its children) and the references, or None if the job is not
+        being journalled.
+        """
+        # Only the journal rotation and the list of tasks must be consistent,
+        # so we build the descriptors outside the lock, to avoid stalling
+        # the scheduler for large jobs. Any task or reference that is added
+        # after the rotation is recorded in the new journal.
+        with self._lock:
+            generation = job.rotate_journal()
+            if generation is None:
+                return None
+            tasks = []
+            for task_id in self.tasks_for_job.get(job.id, []):
+                try:
+                    tasks.append(self.tasks[task_id])
+                except KeyError:
+                    pass
+            
+        task_descriptors = []
+        refs = {}
+        for task in tasks:
+            if task is not job.root_task:
+                task_descriptors.append(self.copy_task_descriptor(task))
+            for id in task.expected_outputs:
+                ref = self.ref_for_output.get(id)
+                if ref is not None:
+                    refs[id] = ref
+            for ref in task.dependencies.values():
+                try:
+                    current_ref = self.ref_for_output.get(ref.id)
+                except AttributeError:
+                    continue
+                if current_ref is not None:
+                    refs[ref.id] = current_ref
+                    
+        return generation, self.copy_task_descriptor(job.root_task), task_descriptors, refs
+    
+    def copy_task_descriptor(self, task):
+        # The task's inputs and dependencies may be modified while the
+        # checkpoint is being written, so we serialize copies of them.
+        descriptor = task.as_descriptor()
+        descriptor['dependencies'] = dict(descriptor['dependencies'])
+        descriptor['inputs'] = dict(descriptor['inputs'])
+        return descriptor
+    
+    def get_evictable_tasks(self, job, task_ids):
+        evictable_tasks = {}
+        for task_id in task_ids:
+            try:
+                task = self.tasks[task_id]
+            except KeyError:
+                continue
+            if task.state in (TASK_CREATED, TASK_BLOCKING, TASK_COMMITTED, TASK_FAILED):
+                evictable_tasks[task_id] = task
+        
+        # Keep any task that produces an output for a task that is not being
+        # evicted, until no more tasks are removed from the evictable set.
+        should_check = True
+        while should_check:
+            should_check = False
+            for task in evictable_tasks.values():
+                if self.has_external_consumers(task, job, evictable_tasks):
+                    del evictable_tasks[task.task_id]
+                    should_check = True
+        return evictable_tasks
+
+    def has_external_consumers(self, task, job, evictable_tasks):
+        for output in task.expected_outputs:
+            try:
+                consumers = self.consumers_for_output[output]
+            except KeyError:
+                continue
+            for consumer in consumers:
+                if isinstance(consumer, Job):
+                    if consumer is not job:
+                        return True
+                elif consumer.task_id not in evictable_tasks:
+                    return True
+        return False
+    
+    def evict_task(self, task, job):
+        del self.tasks[task.task_id]
+        for output in task.expected_outputs:
+            if self.task_for_output.get(output) is task:
+                del self.task_for_output[output]
+            try:
+                del self.consumers_for_output[output]
+            except KeyError:
+                pass
+            if self.job_outputs.get(output) is job:
+                # Keep the job's result, which may be used by later jobs.
+                del self.job_outputs[output]
+            else:
+                try:
+                    del self.ref_for_output[output]
+                except KeyError:
+                    pass
+        
+        # A blocked task may be waiting for another job's outputs.
+        for global_id in task.blocked_on():
+            try:
+                self.consumers_for_output[global_id].discard(task)
+            except KeyError:
+                pass
+            
+        # The job retains its root task, so break the references from this
+        # task to the rest of the task graph.
+        task.children = ()
+        task.parent = None
+        task.history = []
+        task.inputs = {}
     
+    def set_task_state(self, task, state):
+        # A task that leaves the QUEUED state outside the scheduler must be
+        # removed from the worker queues straight away.
+        was_queued = task.state == TASK_QUEUED
+        task.set_state(state)
+        if was_queued and state != TASK_QUEUED:
+            self.bus.publish('task_dequeued', task)
+
     def handle_missing_input(self, task):
-        task.set_state(TASK_FAILED)
+        self.set_task_state(task, TASK_FAILED)
                 
         # Assume that all of the dependencies are unavailable.
         task.convert_dependencies_to_futures()
@@ -186,6 +535,20 @@ class LazyTaskPool(plugins.SimplePlugin):
             for global_id, ref in refs.items():
                 self._publish_ref(global_id, ref, job, should_journal)
         
+    def publish_block_list(self, netloc, added_blocks, removed_blocks):
+        """
+        Publishes the blocks that have been added to (a mapping from block name
+        to size) and removed from (a set of block names) the block store at
+        the given netloc, as a single operation.
+        """
+        with self._lock:
+            for block_name, block_size in added_blocks.items():
+                conc_ref = SW2_ConcreteReference(block_name, SWNoProvenance(), block_size)
+                conc_ref.add_location_hint(netloc)
+                self._publish_ref(block_name, conc_ref, None, False)
+            for block_name in removed_blocks:
+                self._publish_ref(block_name, SW2_TombstoneReference(block_name, [netloc]), None, False)
+        
     def _publish_ref(self, global_id, ref, job, should_journal=True):
         
         if should_journal:
@@ -215,6 +578,7 @@ class LazyTaskPool(plugins.SimplePlugin):
             for consumer in consumers:
                 if isinstance(consumer, Job):
                     consumer.completed(current_ref)
+                    self.bus.publish('job_completed', consumer)
                 else:
                     self.notify_task_of_reference(consumer, global_id, current_ref)
         except KeyError:
@@ -280,6 +644,18 @@ class LazyTaskPool(plugins.SimplePlugin):
         except KeyError:
             return False
     
+    def get_path_length_from_consumers(self, task):
+        path_length = 0
+        for output in task.expected_outputs:
+            try:
+                consumers = self.consumers_for_output[output]
+            except KeyError:
+                continue
+            for consumer in consumers:
+                if not isinstance(consumer, Job):
+                    path_length = max(path_length, consumer.path_length + 1)
+        return path_length
+    
     def add_runnable_task(self, task):
         task.set_state(TASK_QUEUED)
         self.task_queue.put(task)
@@ -302,6 +678,7 @@ class LazyTaskPool(plugins.SimplePlugin):
                 newly_active_task_queue.append(task)
             
         for task in root_tasks:
+            task.path_length = max(task.path_length, self.get_path_length_from_consumers(task))
             newly_active_task_queue.append(task)
                 
         # Do breadth-first search through the task graph to identify other 
@@ -333,6 +710,12 @@ class LazyTaskPool(plugins.SimplePlugin):
                     except KeyError:
                         producing_task = self.tasks[ref.provenance.task_id]
                     
+                    # The producing task is at least one step further from
+                    # the job output than this task. N.B. We do not revisit
+                    # the producer's own inputs, so this is an estimate.
+                    if producing_task.path_length <= task.path_length:
+                        producing_task.path_length = task.path_length + 1
+                    
                     # The producing task is inactive, so recursively visit it.                    
                     if producing_task.state in (TASK_CREATED, TASK_COMMITTED):
                         producing_task.set_state(TASK_BLOCKING)
@@ -361,13 +744,7 @@ class LazyTaskPoolAdapter:
         self.tasks = lazy_task_pool.tasks
      
     def add_task(self, task_descriptor, parent_task=None, job=None):
-        try:
-            task_id = task_descriptor['task_id']
-        except:
-            task_id = self.generate_task_id()
-        
-        task = build_taskpool_task_from_descriptor(task_id, task_descriptor, self, parent_task)
-        task.job = job
+        task = self.build_task(task_descriptor, parent_task, job)
         
         self.lazy_task_pool.add_task(task, parent_task is None)
         
@@ -379,6 +756,16 @@ class LazyTaskPoolAdapter:
 
         return task
     
+    def build_task(self, task_descriptor, parent_task=None, job=None):
+        try:
+            task_id = task_descriptor['task_id']
+        except:
+            task_id = self.generate_task_id()
+        
+        task = build_taskpool_task_from_descriptor(task_id, task_descriptor, self, parent_task)
+        task.job = job
+        return task
+    
     def get_reference_info(self, id):
         return self.lazy_task_pool.get_reference_info(id)
     
@@ -391,6 +778,9 @@ class LazyTaskPoolAdapter:
     def get_task_by_id(self, id):
         return self.lazy_task_pool.get_task_by_id(id)
     
+    def get_task_descriptor_by_id(self, id):
+        return self.lazy_task_pool.get_task_descriptor_by_id(id)
+    
     def publish_refs(self, task, refs):
         self.lazy_task_pool.publish_refs(refs, task.job, True)
     
@@ -399,24 +789,35 @@ class LazyTaskPoolAdapter:
         if parent_task.is_replay_task():
             return
             
+        # Build all of the children before adding them to the pool, so that
+        # they can be added in a single batch.
+        tasks = []
         for child in spawned_task_descriptors:
             try:
                 spawned_task_id = child['task_id']
             except KeyError:
                 raise
             
-            task = self.add_task(child, parent_task, parent_task.job)
-            parent_task.children.append(task)
+            task = self.build_task(child, parent_task, parent_task.job)
+            parent_task.add_child(task)
+            tasks.append(task)
             
             if task.continues_task is not None:
                 parent_task.continuation = spawned_task_id
+                
+        self.lazy_task_pool.add_tasks(tasks, parent_task.job)
 
-    def commit_task(self, task_id, commit_payload):
+    def commit_task(self, task_id, commit_payload, worker=None):
         
         commit_bindings = commit_payload['bindings']
         task = self.lazy_task_pool.get_task_by_id(task_id)
         
-        self.lazy_task_pool.task_completed(task, commit_bindings)
+        self.lazy_task_pool.task_completed(task, commit_bindings, worker)
+        
+        # The commit is not acknowledged until its outputs are durable. The
+        # syncs for concurrent commits are batched by the journal writer.
+        if task.job is not None:
+            task.job.flush_journal()
         
         # Saved continuation URI, if necessary.
         try:
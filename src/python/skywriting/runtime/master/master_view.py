@@ -23,13 +23,14 @@ import simplejson
 import cherrypy
 from skywriting.runtime.worker.worker_view import DataRoot
 from skywriting.runtime.master.cluster_view import WebBrowserRoot
+from skywriting.runtime.master.job_pool import JOB_PRIORITIES
 
 class MasterRoot:
     
     def __init__(self, task_pool, worker_pool, block_store, global_name_directory, job_pool):
         self.worker = WorkersRoot(worker_pool)
         self.job = JobRoot(job_pool)
-        self.task = MasterTaskRoot(global_name_directory, task_pool)
+        self.task = MasterTaskRoot(global_name_directory, task_pool, worker_pool)
         self.streamtask = MasterStreamTaskRoot(global_name_directory, task_pool)
         self.data = DataRoot(block_store)
         self.global_data = GlobalDataRoot(global_name_directory, task_pool, worker_pool)
@@ -103,6 +104,10 @@ class WorkersRoot:
                 cherrypy.engine.publish('worker_ping', worker)
             elif action == 'stopping':
                 cherrypy.engine.publish('worker_failed', worker)
+            elif action == 'blocks':
+                # The worker has garbage collected these blocks.
+                block_ids = simplejson.loads(cherrypy.request.body.read())
+                cherrypy.engine.publish('blocks_removed', worker, block_ids)
             else:
                 raise HTTPError(404)
         else:
@@ -115,14 +120,23 @@ class JobRoot:
         self.job_pool = job_pool
         
     @cherrypy.expose
-    def index(self):
+    def index(self, priority='NORMAL', share='1.0'):
         if cherrypy.request.method == 'POST':
+            # 0. Parse the scheduling parameters for the job.
+            try:
+                priority = JOB_PRIORITIES[priority.upper()]
+                share = float(share)
+            except (KeyError, ValueError):
+                raise HTTPError(400)
+            if share <= 0:
+                raise HTTPError(400)
+            
             # 1. Read task descriptor from request.
             task_descriptor = simplejson.loads(cherrypy.request.body.read(), 
                                                object_hook=json_decode_object_hook)
 
             # 2. Add to job pool (synchronously).
-            job = self.job_pool.create_job_for_task(task_descriptor)
+            job = self.job_pool.create_job_for_task(task_descriptor, priority, share)
             
             # 2a. Start job. Possibly do this as deferred work.
             self.job_pool.start_job(job)
@@ -193,9 +207,10 @@ class MasterStreamTaskRoot:
 
 class MasterTaskRoot:
     
-    def __init__(self, global_name_directory, task_pool):
+    def __init__(self, global_name_directory, task_pool, worker_pool):
         self.global_name_directory = global_name_directory
         self.task_pool = task_pool
+        self.worker_pool = worker_pool
         
     # TODO: decide how to submit tasks to the cluster. Effectively, we want to mirror
     #       the way workers do it. Want to have a one-shot distributed execution on the
@@ -207,8 +222,18 @@ class MasterTaskRoot:
     #       by invoking the master (such as cluster details), but this could potentially be
     #       provided at the master.
        
+    def get_reporting_worker(self, worker_id):
+        # Workers identify themselves when reporting the outcome of a task, in
+        # case a backup copy of the task is running on another worker.
+        if worker_id is None:
+            return None
+        try:
+            return self.worker_pool.get_worker_by_id(worker_id)
+        except KeyError:
+            return None
+       
     @cherrypy.expose 
-    def default(self, id=None, action=None):
+    def default(self, id=None, action=None, worker_id=None):
         if id is not None:
         
             task_id = id
@@ -249,15 +274,23 @@ class MasterTaskRoot:
             elif action == 'commit':
                 if cherrypy.request.method == 'POST':
                     commit_payload = simplejson.loads(cherrypy.request.body.read(), object_hook=json_decode_object_hook)
-                    self.task_pool.commit_task(task_id, commit_payload)
+                    try:
+                        self.task_pool.commit_task(task_id, commit_payload, self.get_reporting_worker(worker_id))
+                    except KeyError:
+                        # The task's job has completed and been evicted, so
+                        # this is a redundant copy of the task.
+                        return simplejson.dumps(False)
                     return simplejson.dumps(True)
                 else:
                     raise HTTPError(405)
             elif action == 'failed':
                 if cherrypy.request.method == 'POST':
-                    task = self.task_pool.get_task_by_id(task_id)
+                    try:
+                        task = self.task_pool.get_task_by_id(task_id)
+                    except KeyError:
+                        return simplejson.dumps(False)
                     failure_payload = simplejson.loads(cherrypy.request.body.read(), object_hook=json_decode_object_hook)
-                    cherrypy.engine.publish('task_failed', task, failure_payload)
+                    cherrypy.engine.publish('task_failed', task, failure_payload, self.get_reporting_worker(worker_id))
                     return simplejson.dumps(True)
                 else:
                     raise HTTPError(405)
@@ -271,7 +304,10 @@ class MasterTaskRoot:
                 self.task_pool.abort(task_id)
             elif action is None:
                 if cherrypy.request.method == 'GET':
-                    return simplejson.dumps(self.task_pool.get_task_by_id(task_id).as_descriptor(long=True), cls=SWReferenceJSONEncoder)
+                    try:
+                        return simplejson.dumps(self.task_pool.get_task_descriptor_by_id(task_id), cls=SWReferenceJSONEncoder)
+                    except KeyError:
+                        raise HTTPError(404)
         elif cherrypy.request.method == 'POST':
             # New task spawning in here.
             task_descriptor = simplejson.loads(cherrypy.request.body.read(), object_hook=json_decode_object_hook)
@@ -361,11 +397,16 @@ class GlobalDataRoot:
         elif attribute == 'task':
             if cherrypy.request.method == 'GET':
                 task_id = self.global_name_directory.get_task_for_id(real_id)
-                task = self.task_pool.get_task_by_id(task_id)
-                task_descriptor = task.as_descriptor(long=True)
-                task_descriptor['is_running'] = task.worker is not None
-                if task.worker is not None:
-                    task_descriptor['worker'] = task.worker.as_descriptor()
+                try:
+                    task = self.task_pool.get_task_by_id(task_id)
+                    task_descriptor = task.as_descriptor(long=True)
+                    task_descriptor['is_running'] = task.worker is not None
+                    if task.worker is not None:
+                        task_descriptor['worker'] = task.worker.as_descriptor()
+                except KeyError:
+                    # The task has been evicted from the task pool.
+                    task_descriptor = self.task_pool.get_task_descriptor_by_id(task_id)
+                    task_descriptor['is_running'] = False
                 return simplejson.dumps(task_descriptor, cls=SWReferenceJSONEncoder)
             else:
                 raise HTTPError(405)
@@ -11,27 +11,34 @@
 # WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
 # ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
-from skywriting.runtime.references import SW2_ConcreteReference, SWNoProvenance
+from __future__ import with_statement
 from cherrypy.process import plugins
 import urllib2
 from skywriting.runtime.block_store import BLOCK_LIST_RECORD_STRUCT,\
-    json_decode_object_hook
+    json_decode_object_hook, BLOCK_REMOVED, read_block_records
 import logging
 import cherrypy
 import os
 import simplejson
 from skywriting.runtime.master.job_pool import RECORD_HEADER_STRUCT,\
-    Job, JOB_ACTIVE
+    Job, JOB_ACTIVE, get_journal_path
+from Queue import Queue, Empty
+import threading
 from skywriting.runtime.task import build_taskpool_task_from_descriptor
 
 class RecoveryManager(plugins.SimplePlugin):
     
-    def __init__(self, bus, job_pool, task_pool, block_store, deferred_worker):
+    def __init__(self, bus, job_pool, task_pool, block_store, deferred_worker, num_recovery_threads=8):
         plugins.SimplePlugin.__init__(self, bus)
         self.job_pool = job_pool
         self.task_pool = task_pool
         self.block_store = block_store
         self.deferred_worker = deferred_worker
+        self.num_recovery_threads = num_recovery_threads
+        
+        # Mapping from worker netloc to the ID and generation of its block
+        # store when we last fetched its block list.
+        self.block_list_positions = {}
         
     def subscribe(self):
         # In order to present a consistent view to clients, we must do these
@@ -49,91 +56,137 @@ class RecoveryManager(plugins.SimplePlugin):
 
     def recover_local_blocks(self):
         if not self.block_store.is_empty():
+            local_blocks = {}
             for block_name, block_size in self.block_store.block_list_generator():
-                conc_ref = SW2_ConcreteReference(block_name, SWNoProvenance(), 
-                                                 block_size)
-                conc_ref.add_location_hint(self.block_store.netloc)
-                #cherrypy.log.error('Recovering block %s (size=%d)' % (block_name, block_size), 'RECOVERY', logging.INFO)
-                self.task_pool.publish_single_ref(block_name, conc_ref, None, False)                
+                local_blocks[block_name] = block_size
+            self.task_pool.publish_block_list(self.block_store.netloc, local_blocks, set())
 
     def recover_job_descriptors(self):
         root = self.job_pool.journal_root
         if root is None:
             return
         
+        # Jobs are recovered independently, so we recover several at once.
+        job_ids = Queue()
         for job_id in os.listdir(root):
-
+            if os.path.isdir(os.path.join(root, job_id)):
+                job_ids.put(job_id)
+        threads = []
+        for _ in range(min(self.num_recovery_threads, job_ids.qsize())):
+            thread = threading.Thread(target=self.recovery_thread_main, args=(job_ids, ))
+            threads.append(thread)
+            thread.start()
+        for thread in threads:
+            thread.join()
+            
+    def recovery_thread_main(self, job_ids):
+        while True:
             try:
-                job_dir = os.path.join(root, job_id)
-                result_path = os.path.join(job_dir, 'result')
-                if os.path.exists(result_path):
-                    with open(result_path, 'r') as result_file:
-                        result = simplejson.load(result_file, object_hook=json_decode_object_hook)
-                else:
-                    result = None
-                    
-                journal_path = os.path.join(job_dir, 'task_journal')
-                journal_file = open(journal_path, 'rb')
+                job_id = job_ids.get_nowait()
+            except Empty:
+                break
+            self.recover_job(job_id)
+
+    def recover_job(self, job_id):
+        try:
+            job_dir = os.path.join(self.job_pool.journal_root, job_id)
+            result_path = os.path.join(job_dir, 'result')
+            if os.path.exists(result_path):
+                with open(result_path, 'r') as result_file:
+                    result = simplejson.load(result_file, object_hook=json_decode_object_hook)
+            else:
+                result = None
+                
+            # If the job has been checkpointed, the root task is in the
+            # checkpoint. Otherwise, it is the first record of the journal.
+            checkpoint_path = os.path.join(job_dir, 'checkpoint')
+            if os.path.exists(checkpoint_path):
+                with open(checkpoint_path, 'r') as checkpoint_file:
+                    checkpoint = simplejson.load(checkpoint_file, object_hook=json_decode_object_hook)
+                generation = checkpoint['generation']
+                journal_file = open(get_journal_path(job_dir, generation), 'rb')
+                root_task_descriptor = checkpoint['root_task']
+            else:
+                checkpoint = None
+                generation = 0
+                journal_file = open(get_journal_path(job_dir, generation), 'rb')
                 record_type, root_task_descriptor_length = RECORD_HEADER_STRUCT.unpack(journal_file.read(RECORD_HEADER_STRUCT.size))
                 root_task_descriptor_string = journal_file.read(root_task_descriptor_length)
                 assert record_type == 'T'
                 assert len(root_task_descriptor_string) == root_task_descriptor_length
                 root_task_descriptor = simplejson.loads(root_task_descriptor_string, object_hook=json_decode_object_hook)
-                root_task_id = root_task_descriptor['task_id']
-                root_task = build_taskpool_task_from_descriptor(root_task_id, root_task_descriptor, self.task_pool, None)
-                job = Job(job_id, root_task, job_dir)
-                root_task.job = job
-                if result is not None:
-                    job.completed(result)
-                self.job_pool.add_job(job)
-                self.task_pool.add_task(root_task)
-                
-                if result is None:
-                    self.load_other_tasks_defer(job, journal_file)
-                    cherrypy.log.error('Recovered job %s' % job_id, 'RECOVERY', logging.INFO, False)
-                    cherrypy.log.error('Recovered task %s for job %s' % (root_task_id, job_id), 'RECOVERY', logging.INFO, False)
-                else:
-                    journal_file.close()
-                    cherrypy.log.error('Found information about job %s' % job_id, 'RECOVERY', logging.INFO, False)
-                
-                
-            except:
-                # We have lost critical data for the job, so we must fail it.
-                cherrypy.log.error('Error recovering job %s' % job_id, 'RECOVERY', logging.ERROR, True)
-                self.job_pool.add_failed_job(job_id)
+            root_task_id = root_task_descriptor['task_id']
+            root_task = build_taskpool_task_from_descriptor(root_task_id, root_task_descriptor, self.task_pool, None)
+            job = Job(job_id, root_task, job_dir)
+            job.journal_generation = generation
+            root_task.job = job
+            
+            # Jobs created by older masters have no scheduling file, and
+            # run with the default priority and share.
+            scheduling_path = os.path.join(job_dir, 'scheduling')
+            if os.path.exists(scheduling_path):
+                with open(scheduling_path, 'r') as scheduling_file:
+                    scheduling = simplejson.load(scheduling_file)
+                job.priority = scheduling['priority']
+                job.share = scheduling['share']
+            if result is not None:
+                job.completed(result)
+            self.job_pool.add_job(job)
+            self.task_pool.add_task(root_task)
+            
+            if result is None:
+                cherrypy.log.error('Recovered job %s' % job_id, 'RECOVERY', logging.INFO, False)
+                cherrypy.log.error('Recovered task %s for job %s' % (root_task_id, job_id), 'RECOVERY', logging.INFO, False)
+                if checkpoint is not None:
+                    self.load_checkpoint(job, checkpoint)
+                self.load_other_tasks_for_job(job, journal_file)
+            else:
+                journal_file.close()
+                cherrypy.log.error('Found information about job %s' % job_id, 'RECOVERY', logging.INFO, False)
+            
+        except:
+            # We have lost critical data for the job, so we must fail it.
+            cherrypy.log.error('Error recovering job %s' % job_id, 'RECOVERY', logging.ERROR, True)
+            self.job_pool.add_failed_job(job_id)
 
-    def load_other_tasks_defer(self, job, journal_file):
-        self.deferred_worker.do_deferred(lambda: self.load_other_tasks_for_job(job, journal_file))
+    def load_checkpoint(self, job, checkpoint):
+        '''
+        Restores the tasks and references from a job's checkpoint.
+        '''
+        self.task_pool.publish_refs(checkpoint['refs'], job, should_journal=False)
+        
+        # Parents precede their children in the checkpoint.
+        tasks = []
+        tasks_by_id = {job.root_task.task_id: job.root_task}
+        for task_descriptor in checkpoint['tasks']:
+            task_id = task_descriptor['task_id']
+            parent_task = tasks_by_id[task_descriptor['parent']]
+            task = build_taskpool_task_from_descriptor(task_id, task_descriptor, self.task_pool, parent_task)
+            task.job = job
+            task.parent.add_child(task)
+            tasks.append(task)
+            tasks_by_id[task_id] = task
+        self.task_pool.add_tasks(tasks, job)
+        
+        cherrypy.log.error('Recovered %d task(s) and %d reference(s) from checkpoint for job %s' % (len(tasks) + 1, len(checkpoint['refs']), job.id), 'RECOVERY', logging.INFO, False)
 
     def load_other_tasks_for_job(self, job, journal_file):
         '''
-        Process a the task journal for a recovered job.
+        Process the task journal for a recovered job, and any journals that
+        were started after it.
         '''
         try:
             while True:
-                record_header = journal_file.read(RECORD_HEADER_STRUCT.size)
-                if len(record_header) != RECORD_HEADER_STRUCT.size:
-                    cherrypy.log.error('Journal entry truncated for job %s' % job.id, 'RECOVERY', logging.WARNING, False)
-                    break
-                record_type, record_length = RECORD_HEADER_STRUCT.unpack(record_header)
-                record_string = journal_file.read(record_length)
-                if len(record_string) != record_length:
-                    cherrypy.log.error('Journal entry truncated for job %s' % job.id, 'RECOVERY', logging.WARNING, False)
+                self.load_journal_for_job(job, journal_file)
+                journal_file.close()
+                
+                # A checkpoint may have started a new journal, but failed
+                # before it was written.
+                next_journal_path = get_journal_path(job.job_dir, job.journal_generation + 1)
+                if not os.path.exists(next_journal_path):
                     break
-                rec = simplejson.loads(record_string, object_hook=json_decode_object_hook)
-                if record_type == 'R':
-                    self.task_pool.publish_single_ref(rec['id'], rec['ref'], job, should_journal=False)
-                elif record_type == 'T':
-                    task_id = rec['task_id']
-                    parent_task = self.task_pool.get_task_by_id(rec['parent'])
-                    task = build_taskpool_task_from_descriptor(task_id, rec, self.task_pool, parent_task)
-                    task.job = job
-                    task.parent.children.append(task)
-    
-                    cherrypy.log.error('Recovered task %s for job %s' % (task_id, job.id), 'RECOVERY', logging.INFO, False)
-                    self.task_pool.add_task(task)
-                else:
-                    cherrypy.log.error('Got invalid record type in job %s' % job.id, 'RECOVERY', logging.WARNING, False)
+                job.journal_generation += 1
+                journal_file = open(next_journal_path, 'rb')
                 
         except:
             cherrypy.log.error('Error recovering task_journal for job %s' % job.id, 'RECOVERY', logging.WARNING, True)
@@ -144,33 +197,96 @@ class RecoveryManager(plugins.SimplePlugin):
                 cherrypy.log.error('Restarting recovered job %s' % job.id, 'RECOVERY', logging.INFO)
             self.job_pool.restart_job(job)
 
+    def load_journal_for_job(self, job, journal_file):
+        while True:
+            record_header = journal_file.read(RECORD_HEADER_STRUCT.size)
+            if len(record_header) == 0:
+                break
+            elif len(record_header) != RECORD_HEADER_STRUCT.size:
+                cherrypy.log.error('Journal entry truncated for job %s' % job.id, 'RECOVERY', logging.WARNING, False)
+                break
+            record_type, record_length = RECORD_HEADER_STRUCT.unpack(record_header)
+            record_string = journal_file.read(record_length)
+            if len(record_string) != record_length:
+                cherrypy.log.error('Journal entry truncated for job %s' % job.id, 'RECOVERY', logging.WARNING, False)
+                break
+            rec = simplejson.loads(record_string, object_hook=json_decode_object_hook)
+            if record_type == 'R':
+                self.task_pool.publish_single_ref(rec['id'], rec['ref'], job, should_journal=False)
+            elif record_type == 'T':
+                task_id = rec['task_id']
+                parent_task = self.task_pool.get_task_by_id(rec['parent'])
+                task = build_taskpool_task_from_descriptor(task_id, rec, self.task_pool, parent_task)
+                task.job = job
+                task.parent.add_child(task)
+
+                cherrypy.log.error('Recovered task %s for job %s' % (task_id, job.id), 'RECOVERY', logging.INFO, False)
+                self.task_pool.add_task(task)
+            elif record_type == 'B':
+                # A batch of tasks spawned by the same parent.
+                tasks = []
+                for task_descriptor in rec:
+                    task_id = task_descriptor['task_id']
+                    parent_task = self.task_pool.get_task_by_id(task_descriptor['parent'])
+                    task = build_taskpool_task_from_descriptor(task_id, task_descriptor, self.task_pool, parent_task)
+                    task.job = job
+                    task.parent.add_child(task)
+                    tasks.append(task)
+                    
+                cherrypy.log.error('Recovered %d task(s) for job %s' % (len(tasks), job.id), 'RECOVERY', logging.INFO, False)
+                self.task_pool.add_tasks(tasks, job)
+            else:
+                cherrypy.log.error('Got invalid record type in job %s' % job.id, 'RECOVERY', logging.WARNING, False)
+
     def fetch_block_list_defer(self, worker):
         self.deferred_worker.do_deferred(lambda: self.fetch_block_names_from_worker(worker))
         
     def fetch_block_names_from_worker(self, worker):
         '''
-        Loop through the block list file from the given worker, and publish the
-        references found there.
+        Fetch the block log from the given worker, starting at the generation
+        that we last fetched from its block store, and publish the blocks that
+        have been added or removed since then.
         '''
-        
-        block_file = urllib2.urlopen('http://%s/data/' % worker.netloc)
-
-        while True:
-            record = block_file.read(BLOCK_LIST_RECORD_STRUCT.size)
-            if not record:
-                break
-            block_name, block_size = BLOCK_LIST_RECORD_STRUCT.unpack(record)
-            conc_ref = SW2_ConcreteReference(block_name, SWNoProvenance(), 
-                                             block_size)
-            conc_ref.add_location_hint(worker.netloc)
+        try:
+            block_store_id, generation = self.block_list_positions[worker.netloc]
+        except KeyError:
+            block_store_id, generation = None, 0
             
-            #cherrypy.log.error('Recovering block %s (size=%d)' % (block_name, block_size), 'RECOVERY', logging.INFO)
-            self.task_pool.publish_single_ref(block_name, conc_ref, None, False)
+        if block_store_id is not None and block_store_id == worker.block_store_id:
+            if generation == worker.block_generation:
+                cherrypy.log.error('Block list for %s is up to date' % worker.netloc, 'RECOVERY', logging.INFO)
+                return
+            block_file = urllib2.urlopen('http://%s/data/?since=%d&store_id=%s' % (worker.netloc, generation, block_store_id))
+        else:
+            block_file = urllib2.urlopen('http://%s/data/' % worker.netloc)
 
-        
-        block_file.close()
+        added_blocks = {}
+        removed_blocks = set()
+        try:
+            headers = block_file.info()
+            new_block_store_id = headers.getheader('X-Block-Store-Id')
+            if new_block_store_id is None:
+                # An older worker sends a list of all of its blocks.
+                for block_name, block_size in read_block_records(block_file, BLOCK_LIST_RECORD_STRUCT):
+                    added_blocks[block_name] = block_size
+            else:
+                # Later records supersede earlier ones for the same block.
+                for op, block_name, block_size in read_block_records(block_file):
+                    if op == BLOCK_REMOVED:
+                        added_blocks.pop(block_name, None)
+                        removed_blocks.add(block_name)
+                    else:
+                        added_blocks[block_name] = block_size
+                        removed_blocks.discard(block_name)
+                new_generation = int(headers.getheader('X-Block-Generation'))
+        finally:
+            block_file.close()
+
+        self.task_pool.publish_block_list(worker.netloc, added_blocks, removed_blocks)
+        if new_block_store_id is not None:
+            self.block_list_positions[worker.netloc] = (new_block_store_id, new_generation)
+        cherrypy.log.error('Fetched block list from %s: %d added, %d removed' % (worker.netloc, len(added_blocks), len(removed_blocks)), 'RECOVERY', logging.INFO)
         
         # Publishing recovered blocks may cause tasks to become QUEUED, so we
         # must run the scheduler.
         self.bus.publish('schedule')
-        
\ No newline at end of file
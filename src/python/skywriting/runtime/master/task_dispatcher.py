@@ -0,0 +1,108 @@
+# Copyright (c) 2010 Derek Murray <derek.murray@cl.cam.ac.uk>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+from __future__ import with_statement
+from skywriting.runtime.plugins import AsynchronousExecutePlugin
+from skywriting.runtime.block_store import SWReferenceJSONEncoder
+from skywriting.runtime.task import TASK_ASSIGNED
+from threading import Lock
+import simplejson
+import httplib2
+import cherrypy
+import logging
+
+class WorkerDispatchState:
+
+    def __init__(self):
+        # Tasks that have been assigned to the worker, but not yet sent.
+        self.pending_tasks = []
+
+        # True if the worker is in the sender queue, or a sender thread is
+        # currently sending tasks to it. This ensures that at most one sender
+        # thread uses the worker's connection at a time.
+        self.is_scheduled = False
+
+        # httplib2 keeps the underlying connection alive between requests, so
+        # we reuse the same object for all dispatches to this worker.
+        self.http = None
+
+class TaskDispatcher(AsynchronousExecutePlugin):
+    '''
+    The task dispatcher sends task descriptors from the master to workers,
+    using a dedicated pool of sender threads, so that a slow worker does not
+    stall the scheduler. Each worker has a persistent connection, and all
+    tasks that are pending for a worker when a sender picks it up are sent
+    as a single batch.
+    '''
+
+    def __init__(self, bus, num_threads=5, max_batch_size=16, timeout=30):
+        AsynchronousExecutePlugin.__init__(self, bus, num_threads, 'dispatch_tasks')
+        self.max_batch_size = max_batch_size
+        self.timeout = timeout
+        self.states = {}
+        self._lock = Lock()
+
+    def dispatch(self, worker, task):
+        with self._lock:
+            try:
+                state = self.states[worker.id]
+            except KeyError:
+                state = WorkerDispatchState()
+                self.states[worker.id] = state
+            state.pending_tasks.append(task)
+            if state.is_scheduled:
+                return
+            state.is_scheduled = True
+        self.receive_input(worker)
+
+    def handle_input(self, worker):
+        with self._lock:
+            state = self.states[worker.id]
+            batch = state.pending_tasks[:self.max_batch_size]
+            del state.pending_tasks[:self.max_batch_size]
+            if state.http is None:
+                state.http = httplib2.Http(timeout=self.timeout)
+            http = state.http
+
+        # Skip tasks that have been aborted, failed or reassigned since they
+        # were added to the batch, and release their slots on the worker.
+        descriptors = []
+        for task in batch:
+            if task.state == TASK_ASSIGNED and worker in task.get_running_workers():
+                descriptors.append(task.as_descriptor())
+            else:
+                self.bus.publish('worker_idle', worker, task)
+
+        failed = worker.failed
+        if not failed and len(descriptors) > 0:
+            try:
+                response, _ = http.request("http://%s/task/" % (worker.netloc, ), "POST", simplejson.dumps(descriptors, cls=SWReferenceJSONEncoder))
+                if response.status != 200:
+                    cherrypy.log.error('Worker %s rejected %d task(s): %s' % (worker.netloc, len(descriptors), str(response.status)), 'DISPATCH', logging.WARNING)
+                    failed = True
+            except:
+                cherrypy.log.error('Error dispatching %d task(s) to %s' % (len(descriptors), worker.netloc), 'DISPATCH', logging.WARNING, True)
+                failed = True
+
+        with self._lock:
+            if failed:
+                # Any pending tasks will be failed by the worker pool.
+                del self.states[worker.id]
+            elif len(state.pending_tasks) > 0:
+                # More tasks arrived while we were sending, so go around again.
+                self.receive_input(worker)
+            else:
+                state.is_scheduled = False
+
+        if failed and not worker.failed:
+            self.bus.publish('worker_failed', worker)
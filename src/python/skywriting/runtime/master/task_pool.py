@@ -23,7 +23,7 @@ from skywriting.runtime.references import \
     SWURLReference, SWErrorReference, SW2_ConcreteReference,\
     SWTaskOutputProvenance, SWSpawnedTaskProvenance,\
     SWTaskContinuationProvenance, SWExecResultProvenance,\
-    SWSpawnExecArgsProvenance, SW2_FutureReference
+    SWSpawnExecArgsProvenance, SW2_FutureReference, SW2_SliceReference
 from skywriting.runtime.task import TASK_RUNNABLE, TASK_ABORTED,\
     TASK_COMMITTED, TASK_ASSIGNED, TASK_FAILED,\
     build_taskpool_task_from_descriptor, TASK_QUEUED
@@ -107,7 +107,7 @@ class TaskPool(plugins.SimplePlugin):
                     except KeyError:
                         current_saving_for_netloc = 0
                     netlocs[netloc] = current_saving_for_netloc + input.size_hint
-            elif isinstance(input, SW2_ConcreteReference) and input.size_hint is not None:
+            elif (isinstance(input, SW2_ConcreteReference) or isinstance(input, SW2_SliceReference)) and input.size_hint is not None:
                 for netloc in input.location_hints:
                     try:
                         current_saving_for_netloc = netlocs[netloc]
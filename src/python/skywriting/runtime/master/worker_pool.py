@@ -15,7 +15,8 @@ from __future__ import with_statement
 from cherrypy.process import plugins
 from Queue import Queue
 from threading import Condition, RLock
-from skywriting.runtime.block_store import SWReferenceJSONEncoder
+from skywriting.runtime.master.job_pool import JOB_PRIORITY_NORMAL
+import heapq
 import random
 import datetime
 import simplejson
@@ -24,6 +25,102 @@ import uuid
 import cherrypy
 import logging
 
+def get_hostname_for_netloc(netloc):
+    return netloc.split(':')[0]
+
+class JobTaskQueue:
+    """
+    A priority queue of tasks from a single job, which returns the task with
+    the longest estimated path to a job output first, and tasks with equal
+    path lengths in FIFO order. Any task can be removed in constant time.
+    """
+    
+    def __init__(self):
+        # Heap of (-path_length, sequence, task) entries. Removed tasks are
+        # deleted from self.tasks, and their entries are discarded lazily.
+        self.heap = []
+        self.tasks = {}
+        self.sequence = 0
+        
+    def __len__(self):
+        return len(self.tasks)
+        
+    def put(self, task):
+        entry = (-task.path_length, self.sequence, task)
+        self.sequence += 1
+        self.tasks[task.task_id] = entry
+        heapq.heappush(self.heap, entry)
+        
+    def peek(self):
+        while len(self.heap) > 0:
+            entry = self.heap[0]
+            task = entry[2]
+            if self.tasks.get(task.task_id) is entry:
+                return task
+            heapq.heappop(self.heap)
+        return None
+        
+    def remove(self, task):
+        try:
+            del self.tasks[task.task_id]
+            return True
+        except KeyError:
+            return False
+
+def get_job_scheduling_key(job):
+    if job is None:
+        return (JOB_PRIORITY_NORMAL, 0)
+    return (job.priority, job.get_share_usage())
+
+class TaskQueue:
+    """
+    A queue of tasks that are waiting for a worker, which holds a separate
+    JobTaskQueue for each job. The next task is taken from the job in the
+    highest priority class that is running the fewest tasks relative to its
+    share. Tasks are removed from every queue that contains them as soon as
+    they are assigned to a worker. This is not thread-safe, and should only be
+    used from the scheduler thread.
+    """
+    
+    def __init__(self):
+        self.job_queues = {}
+        self.length = 0
+        
+    def __len__(self):
+        return self.length
+        
+    def put(self, task):
+        try:
+            job_queue = self.job_queues[task.job]
+        except KeyError:
+            job_queue = JobTaskQueue()
+            self.job_queues[task.job] = job_queue
+        if task.task_id not in job_queue.tasks:
+            self.length += 1
+        job_queue.put(task)
+        
+    def peek(self):
+        best_queue = None
+        best_key = None
+        for job, job_queue in self.job_queues.items():
+            key = get_job_scheduling_key(job)
+            if best_key is None or key < best_key:
+                best_queue = job_queue
+                best_key = key
+        if best_queue is None:
+            return None
+        return best_queue.peek()
+        
+    def remove(self, task):
+        try:
+            job_queue = self.job_queues[task.job]
+        except KeyError:
+            return
+        if job_queue.remove(task):
+            self.length -= 1
+            if len(job_queue) == 0:
+                del self.job_queues[task.job]
+
 class FeatureQueues:
     def __init__(self):
         self.queues = {}
@@ -32,49 +129,136 @@ class FeatureQueues:
         try:
             return self.queues[feature]
         except KeyError:
-            queue = Queue()
+            queue = TaskQueue()
             self.queues[feature] = queue
             return queue
 
 class Worker:
     
-    def __init__(self, worker_id, worker_descriptor, feature_queues):
+    def __init__(self, worker_id, worker_descriptor, feature_queues, host_queues):
         self.id = worker_id
         self.netloc = worker_descriptor['netloc']
+        self.hostname = get_hostname_for_netloc(self.netloc)
         self.features = worker_descriptor['features']
-        self.current_task = None
+        
+        # Older workers do not advertise their capacity, so we assume that
+        # they can run a single task at a time.
+        try:
+            self.slots = worker_descriptor['slots']
+        except KeyError:
+            self.slots = 1
+            
+        # The number of additional tasks that the worker will queue locally,
+        # so that it can start the next task as soon as a slot becomes free.
+        try:
+            self.prefetch = worker_descriptor['prefetch']
+        except KeyError:
+            self.prefetch = 0
+        try:
+            self.resources = worker_descriptor['resources']
+        except KeyError:
+            self.resources = {}
+            
+        # The identity and current generation of the worker's block store,
+        # which determine how much of its block log the master must fetch.
+        self.block_store_id = worker_descriptor.get('block_store_id')
+        self.block_generation = worker_descriptor.get('block_generation', 0)
+        
+        # Mapping from task ID to task object for each task that currently
+        # occupies a slot on this worker.
+        self.current_tasks = {}
+        self.used_resources = {}
+        for resource in self.resources.keys():
+            self.used_resources[resource] = 0
+        
         self.last_ping = datetime.datetime.now()
         
         self.failed = False
         
-        self.local_queue = Queue()
-        self.queues = [self.local_queue]
+        # Queues are listed in decreasing order of locality: tasks that are
+        # delayed for locality are first added to the worker-local queue,
+        # then to the queue for all workers on the same host, and finally
+        # to the feature queues.
+        self.local_queue = TaskQueue()
+        self.host_queue = host_queues.get_queue_for_feature(self.hostname)
+        self.queues = [self.local_queue, self.host_queue]
         for feature in self.features:
             self.queues.append(feature_queues.get_queue_for_feature(feature))
 
     def __repr__(self):
         return 'Worker(%s)' % self.id
 
+    def has_free_slot(self):
+        return len(self.current_tasks) < self.slots + self.prefetch
+
+    def can_run_task(self, task):
+        """
+        Returns True if this worker has the feature for the given task's
+        handler, and the task would fit in its remaining capacity. Resources
+        that the worker does not advertise are treated as unconstrained.
+        """
+        # Tasks in the worker-local and host queues may have any handler.
+        if task.handler not in self.features:
+            return False
+        if not self.has_free_slot():
+            return False
+        for resource, amount in task.resources.items():
+            try:
+                capacity = self.resources[resource]
+            except KeyError:
+                continue
+            if self.used_resources[resource] + amount > capacity:
+                # Always allow a task to run on an otherwise-idle worker, in
+                # case its requirements exceed the capacity of every worker.
+                return len(self.current_tasks) == 0
+        return True
+
+    # Warning: called under worker_pool._lock
+    def add_task(self, task):
+        self.current_tasks[task.task_id] = task
+        for resource, amount in task.resources.items():
+            if resource in self.used_resources:
+                self.used_resources[resource] += amount
+            
+    # Warning: called under worker_pool._lock
+    def remove_task(self, task):
+        try:
+            del self.current_tasks[task.task_id]
+        except KeyError:
+            return
+        for resource, amount in task.resources.items():
+            if resource in self.used_resources:
+                self.used_resources[resource] -= amount
+
     def as_descriptor(self):
+        current_task_ids = self.current_tasks.keys()
         return {'worker_id': self.id,
                 'netloc': self.netloc,
                 'features': self.features,
-                'current_task_id': self.current_task.task_id if self.current_task is not None else None,
+                'slots': self.slots,
+                'prefetch': self.prefetch,
+                'resources': self.resources,
+                'used_resources': self.used_resources,
+                'current_task_ids': current_task_ids,
+                'current_task_id': current_task_ids[0] if len(current_task_ids) > 0 else None,
                 'last_ping': self.last_ping.ctime(),
                 'failed':  self.failed}
         
 
 class WorkerPool(plugins.SimplePlugin):
     
-    def __init__(self, bus, deferred_worker):
+    def __init__(self, bus, deferred_worker, task_dispatcher):
         plugins.SimplePlugin.__init__(self, bus)
         self.deferred_worker = deferred_worker
+        self.task_dispatcher = task_dispatcher
         self.idle_worker_queue = Queue()
         self.workers = {}
         self.netlocs = {}
         self.idle_set = set()
         self._lock = RLock()
         self.feature_queues = FeatureQueues()
+        # Keyed by hostname rather than feature.
+        self.host_queues = FeatureQueues()
         self.event_count = 0
         self.event_condvar = Condition(self._lock)
         self.max_concurrent_waiters = 5
@@ -85,6 +269,7 @@ class WorkerPool(plugins.SimplePlugin):
         self.bus.subscribe('worker_failed', self.worker_failed)
         self.bus.subscribe('worker_idle', self.worker_idle)
         self.bus.subscribe('worker_ping', self.worker_ping)
+        self.bus.subscribe('abort_task', self.abort_task_on_worker_defer)
         self.bus.subscribe('stop', self.server_stopping, 10) 
         self.deferred_worker.do_deferred_after(30.0, self.reap_dead_workers)
         
@@ -92,6 +277,7 @@ class WorkerPool(plugins.SimplePlugin):
         self.bus.unsubscribe('worker_failed', self.worker_failed)
         self.bus.unsubscribe('worker_idle', self.worker_idle)
         self.bus.unsubscribe('worker_ping', self.worker_ping)
+        self.bus.unsubscribe('abort_task', self.abort_task_on_worker_defer)
         self.bus.unsubscribe('stop', self.server_stopping) 
         
     def allocate_worker_id(self):
@@ -100,7 +286,7 @@ class WorkerPool(plugins.SimplePlugin):
     def create_worker(self, worker_descriptor):
         with self._lock:
             id = self.allocate_worker_id()
-            worker = Worker(id, worker_descriptor, self.feature_queues)
+            worker = Worker(id, worker_descriptor, self.feature_queues, self.host_queues)
             self.workers[id] = worker
             try:
                 previous_worker_at_netloc = self.netlocs[worker.netloc]
@@ -142,50 +328,84 @@ class WorkerPool(plugins.SimplePlugin):
     
     def execute_task_on_worker(self, worker, task):
         with self._lock:
-            self.idle_set.remove(worker.id)
-            worker.current_task = task
+            worker.add_task(task)
+            if not worker.has_free_slot():
+                self.idle_set.discard(worker.id)
             task.set_assigned_to_worker(worker)
             self.event_count += 1
             self.event_condvar.notify_all()
             
-        try:
-            httplib2.Http().request("http://%s/task/" % (worker.netloc), "POST", simplejson.dumps(task.as_descriptor(), cls=SWReferenceJSONEncoder), )
-        except:
-            self.worker_failed(worker)
+        # The task will be sent to the worker asynchronously. If this fails,
+        # the dispatcher will publish a worker_failed event.
+        self.task_dispatcher.dispatch(worker, task)
+            
+    def execute_backup_task_on_worker(self, worker, task):
+        """
+        Runs a speculative copy of the given task, which is already running
+        on another worker, on the given worker. N.B. This must be called via
+        LazyTaskPool.launch_backup_task(), which ensures that the task has not
+        committed.
+        """
+        with self._lock:
+            worker.add_task(task)
+            if not worker.has_free_slot():
+                self.idle_set.discard(worker.id)
+            task.set_backup_worker(worker)
+            self.event_count += 1
+            self.event_condvar.notify_all()
             
-    def abort_task_on_worker(self, task):
-        worker = task.worker
+        self.task_dispatcher.dispatch(worker, task)
+            
+    def abort_task_on_worker(self, task, worker=None):
+        if worker is None:
+            worker = task.worker
     
         try:
-            print "Aborting task %d on worker %s" % (task.task_id, worker)
-            response, _ = httplib2.Http().request('http://%s/task/%d/abort' % (worker.netloc, task.task_id), 'POST')
+            cherrypy.log.error('Aborting task %s on worker %s' % (task.task_id, worker.id), 'WORKER_POOL', logging.INFO)
+            response, _ = httplib2.Http().request('http://%s/task/%s/abort' % (worker.netloc, task.task_id), 'POST')
             if response.status == 200:
-                self.worker_idle(worker)
+                self.worker_idle(worker, task)
             else:
-                print response
-                print 'Worker failed to abort a task:', worker 
+                cherrypy.log.error('Worker %s failed to abort task %s: %s' % (worker.id, task.task_id, str(response.status)), 'WORKER_POOL', logging.WARNING)
                 self.worker_failed(worker)
         except:
+            cherrypy.log.error('Error aborting task %s on worker %s' % (task.task_id, worker.id), 'WORKER_POOL', logging.WARNING, True)
             self.worker_failed(worker)
     
+    def abort_task_on_worker_defer(self, task, worker=None):
+        self.deferred_worker.do_deferred(lambda: self.abort_task_on_worker(task, worker))
+    
     def worker_failed(self, worker):
         cherrypy.log.error('Worker failed: %s (%s)' % (worker.id, worker.netloc), 'WORKER_POOL', logging.WARNING)
         with self._lock:
+            if worker.failed:
+                # Already handled, e.g. by the task dispatcher.
+                return
             self.event_count += 1
             self.event_condvar.notify_all()
             self.idle_set.discard(worker.id)
-            failed_task = worker.current_task
+            failed_tasks = worker.current_tasks.values()
+            worker.current_tasks = {}
             worker.failed = True
             del self.netlocs[worker.netloc]
             del self.workers[worker.id]
 
-        if failed_task is not None:
-            self.bus.publish('task_failed', failed_task, ('WORKER_FAILED', None, {}))
+        for failed_task in failed_tasks:
+            self.bus.publish('task_failed', failed_task, ('WORKER_FAILED', None, {}), worker)
         
-    def worker_idle(self, worker):
+    def worker_idle(self, worker, task=None):
+        """
+        Called when a task releases its slot on the given worker. If no task
+        is specified, all of the worker's slots are released.
+        """
         with self._lock:
-            worker.current_task = None
-            self.idle_set.add(worker.id)
+            if task is not None:
+                worker.remove_task(task)
+            else:
+                for current_task in worker.current_tasks.values():
+                    worker.remove_task(current_task)
+            if not worker.failed:
+                self.idle_set.add(worker.id)
             self.event_count += 1
             self.event_condvar.notify_all()
         self.bus.publish('schedule')
@@ -196,6 +416,13 @@ class WorkerPool(plugins.SimplePlugin):
             self.event_condvar.notify_all()
         worker.last_ping = datetime.datetime.now()
         
+    def get_running_tasks(self):
+        with self._lock:
+            running_tasks = {}
+            for worker in self.workers.values():
+                running_tasks.update(worker.current_tasks)
+            return running_tasks.values()
+
     def get_all_workers(self):
         with self._lock:
             return self.workers.values()
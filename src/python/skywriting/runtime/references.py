@@ -17,8 +17,62 @@ Created on 20 Apr 2010
 
 @author: dgm36
 '''
+from __future__ import with_statement
 
-class SWRealReference:
+from threading import Lock
+
+# Worker netlocs are interned as small integers, so that each reference stores
+# a tuple of integers rather than its own set of strings. N.B. The integers
+# are only meaningful within a single process, and must never be sent over
+# the wire or pickled.
+_netloc_ids = {}
+_netlocs = []
+_netloc_lock = Lock()
+
+def intern_netloc(netloc):
+    try:
+        return _netloc_ids[netloc]
+    except KeyError:
+        with _netloc_lock:
+            try:
+                return _netloc_ids[netloc]
+            except KeyError:
+                netloc_id = len(_netlocs)
+                _netlocs.append(netloc)
+                _netloc_ids[netloc] = netloc_id
+                return netloc_id
+
+def get_netloc_for_id(netloc_id):
+    return _netlocs[netloc_id]
+
+def intern_netlocs(netlocs):
+    """Returns a sorted tuple of the interned IDs for the given netlocs."""
+    return tuple(sorted(set(map(intern_netloc, netlocs))))
+
+class SWCompactObject(object):
+    """
+    Base class for references and provenances, which use __slots__ to reduce
+    the memory that the master needs for each object. Subclasses list the
+    attributes that make up their pickled state in _state_attributes, so that
+    pickles do not depend on the in-memory representation.
+    """
+    
+    __slots__ = ()
+    _state_attributes = ()
+    
+    def __getstate__(self):
+        state = {}
+        for attribute in self._state_attributes:
+            state[attribute] = getattr(self, attribute)
+        return state
+    
+    def __setstate__(self, state):
+        for attribute, value in state.items():
+            setattr(self, attribute, value)
+
+class SWRealReference(SWCompactObject):
+    
+    __slots__ = ()
     
     def as_tuple(self):
         pass
@@ -28,6 +82,9 @@ class SWRealReference:
 
 class SWErrorReference(SWRealReference):
     
+    __slots__ = ('reason', 'details')
+    _state_attributes = __slots__
+    
     def __init__(self, reason, details):
         self.reason = reason
         self.details = details
@@ -37,6 +94,8 @@ class SWErrorReference(SWRealReference):
 
 class SWNullReference(SWRealReference):
     
+    __slots__ = ()
+    
     def __init__(self):
         pass
     
@@ -44,20 +103,27 @@ class SWNullReference(SWRealReference):
         return ('null',)
     
 class SWFutureReference(SWRealReference):
-    pass
+    __slots__ = ()
 
-class SWProvenance:
+class SWProvenance(SWCompactObject):
+    
+    __slots__ = ()
     
     def as_tuple(self):
         pass
     
 class SWNoProvenance(SWProvenance):
     
+    __slots__ = ()
+    
     def as_tuple(self):
         return ('na', )
     
 class SWTaskOutputProvenance(SWProvenance):
     
+    __slots__ = ('task_id', 'index')
+    _state_attributes = __slots__
+    
     def __init__(self, task_id, index):
         self.task_id = task_id
         self.index = index
@@ -67,6 +133,9 @@ class SWTaskOutputProvenance(SWProvenance):
 
 class SWSpawnedTaskProvenance(SWProvenance):
     
+    __slots__ = ('task_id', 'index')
+    _state_attributes = __slots__
+    
     def __init__(self, task_id, spawn_list_index):
         self.task_id = task_id
         self.index = spawn_list_index
@@ -76,6 +145,9 @@ class SWSpawnedTaskProvenance(SWProvenance):
 
 class SWTaskContinuationProvenance(SWProvenance):
     
+    __slots__ = ('task_id', )
+    _state_attributes = __slots__
+    
     def __init__(self, task_id):
         self.task_id = task_id
         
@@ -84,6 +156,9 @@ class SWTaskContinuationProvenance(SWProvenance):
 
 class SWExecResultProvenance(SWProvenance):
     
+    __slots__ = ('task_id', 'exec_result_index')
+    _state_attributes = __slots__
+    
     def __init__(self, task_id, exec_result_index):
         self.task_id = task_id
         self.exec_result_index = exec_result_index
@@ -93,6 +168,9 @@ class SWExecResultProvenance(SWProvenance):
 
 class SWSpawnExecArgsProvenance(SWProvenance):
     
+    __slots__ = ('task_id', 'spawn_exec_index')
+    _state_attributes = __slots__
+    
     def __init__(self, task_id, spawn_exec_index):
         self.task_id = task_id
         self.spawn_exec_index = spawn_exec_index
@@ -106,6 +184,9 @@ class SW2_FutureReference(SWFutureReference):
     system-global namespace, and may be passed to other tasks or returned from
     tasks.
     """
+    
+    __slots__ = ('id', 'provenance')
+    _state_attributes = __slots__
         
     def __init__(self, id, provenance=SWNoProvenance()):
         self.id = id
@@ -122,20 +203,58 @@ class SW2_FutureReference(SWFutureReference):
 
     def __repr__(self):
         return 'SW2_FutureReference(%s, %s)' % (repr(self.id), repr(self.provenance))
+
+class SWLocatedReference(SWRealReference):
+    """
+    Base class for references that have a set of location hints, which are
+    stored as a sorted tuple of interned netloc IDs. The location_hints
+    property returns a tuple of netloc strings.
+    """
+    
+    __slots__ = ('_location_ids', )
+    
+    def _get_location_hints(self):
+        return tuple([_netlocs[x] for x in self._location_ids])
+    
+    def _set_location_hints(self, location_hints):
+        if location_hints is not None:
+            self._location_ids = intern_netlocs(location_hints)
+        else:
+            self._location_ids = ()
+    
+    location_hints = property(_get_location_hints, _set_location_hints)
+    
+    def add_location_hint(self, netloc):
+        netloc_id = intern_netloc(netloc)
+        if netloc_id not in self._location_ids:
+            self._location_ids = tuple(sorted(self._location_ids + (netloc_id, )))
+            
+    def add_location_hints(self, netlocs):
+        self._location_ids = tuple(sorted(set(self._location_ids) | set(map(intern_netloc, netlocs))))
+            
+    def remove_location_hints(self, netlocs):
+        removed_ids = set(map(intern_netloc, netlocs))
+        self._location_ids = tuple([x for x in self._location_ids if x not in removed_ids])
         
-class SW2_ConcreteReference(SWRealReference):
+    def has_location_hint(self, netloc):
+        return intern_netloc(netloc) in self._location_ids
+        
+class SW2_ConcreteReference(SWLocatedReference):
+    
+    __slots__ = ('id', 'provenance', 'size_hint', 'content_hash')
+    _state_attributes = ('id', 'provenance', 'size_hint', 'location_hints', 'content_hash')
         
-    def __init__(self, id, provenance, size_hint=None, location_hints=None):
+    def __init__(self, id, provenance, size_hint=None, location_hints=None, content_hash=None):
         self.id = id
         self.provenance = provenance
         self.size_hint = size_hint
-        if location_hints is not None:
-            self.location_hints = set(location_hints)
-        else:
-            self.location_hints = set()
+        self.location_hints = location_hints
+        self.content_hash = content_hash
         
-    def add_location_hint(self, netloc):
-        self.location_hints.add(netloc)
+    def __setstate__(self, state):
+        # References pickled by an older version do not have a content hash.
+        self.content_hash = None
+        SWLocatedReference.__setstate__(self, state)
         
     def combine_with(self, ref):
         """Add the location hints from ref to this object."""
@@ -147,35 +266,38 @@ class SW2_ConcreteReference(SWRealReference):
             if isinstance(self.provenance, SWNoProvenance):
                 self.provenance = ref.provenance
             
-            # We attempt to upgrade the size hint if more information is
-            # available from the merging reference.
+            # We attempt to upgrade the size hint and content hash if more
+            # information is available from the merging reference.
             if self.size_hint is None:
                 self.size_hint = ref.size_hint
+            if self.content_hash is None:
+                self.content_hash = ref.content_hash
             
             # We calculate the union of the two sets of location hints.
-            self.location_hints.update(ref.location_hints)
+            if ref._location_ids != self._location_ids:
+                self._location_ids = tuple(sorted(set(self._location_ids) | set(ref._location_ids)))
             
     def as_future(self):
         return SW2_FutureReference(self.id, self.provenance)
         
     def as_tuple(self):
-        return('c2', str(self.id), self.provenance.as_tuple(), self.size_hint, list(self.location_hints))
+        if self.content_hash is None:
+            return('c2', str(self.id), self.provenance.as_tuple(), self.size_hint, list(self.location_hints))
+        else:
+            return('c2', str(self.id), self.provenance.as_tuple(), self.size_hint, list(self.location_hints), self.content_hash)
         
     def __repr__(self):
-        return 'SW2_ConcreteReference(%s, %s, %s, %s)' % (repr(self.id), repr(self.provenance), repr(self.size_hint), repr(self.location_hints))
+        return 'SW2_ConcreteReference(%s, %s, %s, %s)' % (repr(self.id), repr(self.provenance), repr(self.size_hint), repr(set(self.location_hints)))
         
-class SW2_StreamReference(SWRealReference):
+class SW2_StreamReference(SWLocatedReference):
+    
+    __slots__ = ('id', 'provenance')
+    _state_attributes = ('id', 'provenance', 'location_hints')
     
     def __init__(self, id, provenance, location_hints=None):
         self.id = id
         self.provenance = provenance
-        if location_hints is not None:
-            self.location_hints = set(location_hints)
-        else:
-            self.location_hints = set()
-        
-    def add_location_hint(self, netloc):
-        self.location_hints.add(netloc)
+        self.location_hints = location_hints
 
     def combine_with(self, ref):
         """Add the location hints from ref to this object."""
@@ -187,18 +309,9 @@ class SW2_StreamReference(SWRealReference):
             if isinstance(self.provenance, SWNoProvenance):
                 self.provenance = ref.provenance
             
-            # We attempt to upgrade the size hint if more information is
-            # available from the merging reference.
-            if self.size_hint is None:
-                self.size_hint = ref.size_hint
-            
             # We calculate the union of the two sets of location hints.
-            for (netloc, access_methods) in ref.location_hints.items():
-                try:
-                    existing_access_methods = set(self.location_hints[netloc])
-                except KeyError:
-                    existing_access_methods = set()
-                self.location_hints[netloc] = list(set(access_methods) | existing_access_methods)
+            if ref._location_ids != self._location_ids:
+                self._location_ids = tuple(sorted(set(self._location_ids) | set(ref._location_ids)))
         
     def as_future(self):
         return SW2_FutureReference(self.id, self.provenance)
@@ -207,10 +320,39 @@ class SW2_StreamReference(SWRealReference):
         return('s2', str(self.id), self.provenance.as_tuple(), list(self.location_hints))
         
     def __repr__(self):
-        return 'SW2_StreamReference(%s, %s, %s)' % (repr(self.id), repr(self.provenance), repr(self.location_hints))
+        return 'SW2_StreamReference(%s, %s, %s)' % (repr(self.id), repr(self.provenance), repr(set(self.location_hints)))
                 
+class SW2_SliceReference(SWLocatedReference):
+    """
+    Used as a reference to the bytes [start, end) of the block with the given
+    ID, so that a block can be divided into extents without copying it.
+    """
+    
+    __slots__ = ('id', 'start', 'end')
+    _state_attributes = ('id', 'start', 'end', 'location_hints')
+    
+    def __init__(self, id, start, end, location_hints=None):
+        self.id = id
+        self.start = start
+        self.end = end
+        self.location_hints = location_hints
+        
+    def _get_size_hint(self):
+        return self.end - self.start
+    
+    size_hint = property(_get_size_hint)
+    
+    def as_tuple(self):
+        return ('sl2', str(self.id), self.start, self.end, list(self.location_hints))
+    
+    def __repr__(self):
+        return 'SW2_SliceReference(%s, %d, %d, %s)' % (repr(self.id), self.start, self.end, repr(set(self.location_hints)))
+
 class SW2_TombstoneReference(SWRealReference):
     
+    __slots__ = ('id', 'netlocs')
+    _state_attributes = __slots__
+    
     def __init__(self, id, netlocs=None):
         self.id = id
         if netlocs is not None:
@@ -235,6 +377,9 @@ class SWURLReference(SWRealReference):
     A reference to one or more URLs representing the same data.
     """
     
+    __slots__ = ('urls', 'size_hint')
+    _state_attributes = __slots__
+    
     def __init__(self, urls, size_hint=None):
         self.urls = urls
         self.size_hint = size_hint
@@ -250,6 +395,9 @@ class SWDataValue(SWRealReference):
     Used to store data that has been dereferenced and loaded into the environment.
     """
     
+    __slots__ = ('value', )
+    _state_attributes = __slots__
+    
     def __init__(self, value):
         self.value = value
         
@@ -289,9 +437,15 @@ def build_reference_from_tuple(reference_tuple):
     elif ref_type == 'f2':
         return SW2_FutureReference(reference_tuple[1], build_provenance_from_tuple(reference_tuple[2]))
     elif ref_type == 'c2':
-        return SW2_ConcreteReference(reference_tuple[1], build_provenance_from_tuple(reference_tuple[2]), reference_tuple[3], reference_tuple[4])
+        if len(reference_tuple) > 5:
+            content_hash = reference_tuple[5]
+        else:
+            content_hash = None
+        return SW2_ConcreteReference(reference_tuple[1], build_provenance_from_tuple(reference_tuple[2]), reference_tuple[3], reference_tuple[4], content_hash)
     elif ref_type == 's2':
         return SW2_StreamReference(reference_tuple[1], build_provenance_from_tuple(reference_tuple[2]), reference_tuple[3])
+    elif ref_type == 'sl2':
+        return SW2_SliceReference(reference_tuple[1], reference_tuple[2], reference_tuple[3], reference_tuple[4])
     elif ref_type == 't2':
         return SW2_TombstoneReference(reference_tuple[1], reference_tuple[2])
     else:
@@ -314,7 +468,7 @@ def combine_references(original, update):
         return original
     
     if (isinstance(original, SW2_ConcreteReference) or isinstance(original, SW2_StreamReference)) and isinstance(update, SW2_TombstoneReference):
-        original.location_hints.difference_update(update.netlocs)
+        original.remove_location_hints(update.netlocs)
         if len(original.location_hints) == 0:
             return original.as_future()
         else:
@@ -3,7 +3,6 @@ Created on 17 Aug 2010
 
 @author: dgm36
 '''
-import datetime
 from skywriting.runtime.references import SW2_FutureReference
 import time
 
@@ -31,14 +30,22 @@ TASK_STATE_NAMES = {}
 for (name, number) in TASK_STATES.items():
     TASK_STATE_NAMES[number] = name
 
-class Task:
+class Task(object):
+
+    # The master may hold millions of tasks, so we use __slots__ to avoid a
+    # per-object __dict__.
+    __slots__ = ('task_id', 'parent', 'children', 'continues_task', 'continuation', 
+                 'original_task_id', 'replay_ref', 'handler', 'inputs', 'dependencies',
+                 'select_group', 'select_result', 'expected_outputs', 'save_continuation',
+                 'replay_uuids', 'state')
 
     def __init__(self, task_id, parent_task, handler, inputs, dependencies, expected_outputs, save_continuation=False, continues_task=None, replay_uuids=None, select_group=None, select_result=None, state=TASK_CREATED):
         self.task_id = task_id
         
         # Task creation graph.
         self.parent = parent_task
-        self.children = []
+        # Replaced with a list when the first child is added.
+        self.children = ()
         self.continues_task = continues_task
         self.continuation = None
         
@@ -61,18 +68,41 @@ class Task:
 
     def __repr__(self):
         return 'Task(%s)' % self.task_id
+    
+    def add_child(self, child):
+        if len(self.children) == 0:
+            self.children = [child]
+        else:
+            self.children.append(child)
+
+# Shared by all tasks that do not specify any resources. N.B. This must never
+# be modified.
+NO_RESOURCES = {}
 
 class TaskPoolTask(Task):
     
-    def __init__(self, task_id, parent_task, handler, inputs, dependencies, expected_outputs, save_continuation=False, continues_task=None, replay_uuids=None, select_group=None, select_result=None, state=TASK_CREATED, task_pool=None, job=None):
+    __slots__ = ('task_pool', 'resources', '_blocking_dict', '_selecting_dict', 'history',
+                 'job', 'worker', 'saved_continuation_uri', 'backup_worker', 'assigned_time',
+                 'backup_assigned_time', 'event_index', 'current_attempt', 'path_length')
+    
+    def __init__(self, task_id, parent_task, handler, inputs, dependencies, expected_outputs, save_continuation=False, continues_task=None, replay_uuids=None, select_group=None, select_result=None, state=TASK_CREATED, task_pool=None, job=None, resources=None):
         Task.__init__(self, task_id, parent_task, handler, inputs, dependencies, expected_outputs, save_continuation, continues_task, replay_uuids, select_group, select_result, state)
         
         self.task_pool = task_pool
         
+        # Mapping from resource name (e.g. 'cpus', 'memory' or 'disk') to the
+        # amount of that resource that this task needs on a worker.
+        if resources is not None:
+            self.resources = resources
+        else:
+            self.resources = NO_RESOURCES
         
-        self._blocking_dict = {}
+        # Created when the task first blocks.
+        self._blocking_dict = None
         if select_group is not None:
             self._selecting_dict = {}
+        else:
+            self._selecting_dict = None
             
         self.history = []
         
@@ -82,11 +112,22 @@ class TaskPoolTask(Task):
         
         self.worker = None
         self.saved_continuation_uri = None
+        
+        # A speculative copy of this task may run on a second worker, if the
+        # original copy appears to be a straggler. Times are in seconds since
+        # the epoch.
+        self.backup_worker = None
+        self.assigned_time = None
+        self.backup_assigned_time = None
 
         
         self.event_index = 0
         self.current_attempt = 0
 
+        # Estimated number of tasks on the longest path from this task to a
+        # job output. Tasks with longer paths are scheduled first.
+        self.path_length = 0
+
     def set_state(self, state):
         if self.job is not None:
             self.job.record_state_change(self.state, state)
@@ -94,7 +135,9 @@ class TaskPoolTask(Task):
         self.state = state
         
     def record_event(self, description):
-        self.history.append((datetime.datetime.now(), description))
+        # Times are stored as seconds since the epoch, which is more compact
+        # than a datetime.
+        self.history.append((time.time(), description))
 
     def check_dependencies(self, global_name_directory):
         
@@ -113,7 +156,7 @@ class TaskPoolTask(Task):
                 else:
                     self.inputs[local_id] = input
     
-            if len(self._blocking_dict) > 0:
+            if self._blocking_dict:
                 self.set_state(TASK_BLOCKING)
             else:
                 self.set_state(TASK_RUNNABLE)
@@ -131,7 +174,7 @@ class TaskPoolTask(Task):
                         if len(refs) > 0:
                             self.select_result.append(i)
                         else:
-                            self.selecting_dict[global_id] = i
+                            self._selecting_dict[global_id] = i
                     else:
                         self.select_result.append(i)
 
@@ -155,13 +198,15 @@ class TaskPoolTask(Task):
     def blocked_on(self):
         if self.state == TASK_SELECTING:
             return self._selecting_dict.keys()
-        elif self.state == TASK_BLOCKING:
+        elif self.state == TASK_BLOCKING and self._blocking_dict is not None:
             return self._blocking_dict.keys()
         else:
             return []
 
     def block_on(self, global_id, local_id):
         self.set_state(TASK_BLOCKING)
+        if self._blocking_dict is None:
+            self._blocking_dict = {}
         try:
             self._blocking_dict[global_id].add(local_id)
         except KeyError:
@@ -173,16 +218,35 @@ class TaskPoolTask(Task):
             for local_id in local_ids:
                 self.inputs[local_id] = ref
             if len(self._blocking_dict) == 0:
+                self._blocking_dict = None
                 self.set_state(TASK_RUNNABLE)
         
     # Warning: called under worker_pool._lock
     def set_assigned_to_worker(self, worker):
         self.worker = worker
+        self.assigned_time = time.time()
+        self.backup_worker = None
+        self.backup_assigned_time = None
         self.set_state(TASK_ASSIGNED)
         #self.state = TASK_ASSIGNED
         #self.record_event("ASSIGNED")
         #self.task_pool.notify_task_assigned_to_worker_id(self, worker_id)
 
+    # Warning: called under worker_pool._lock
+    def set_backup_worker(self, worker):
+        self.backup_worker = worker
+        self.backup_assigned_time = time.time()
+        self.record_event('BACKUP_ASSIGNED')
+        
+    def get_running_workers(self):
+        return [worker for worker in (self.worker, self.backup_worker) if worker is not None]
+        
+    def get_start_time_on_worker(self, worker):
+        if worker is self.backup_worker:
+            return self.backup_assigned_time
+        else:
+            return self.assigned_time
+
     def convert_dependencies_to_futures(self):
         new_deps = {}
         for local_id, ref in self.dependencies.items(): 
@@ -191,7 +255,7 @@ class TaskPoolTask(Task):
 
     def make_replay_task(self, replay_task_id, replay_ref):
         
-        ret = TaskPoolTask(replay_task_id, self.parent, self.handler, self.inputs, self.dependencies, self.expected_outputs, self.save_continuation, self.continues_task, self.replay_uuids, self.select_group, self.select_result, TASK_RUNNABLE, self.task_pool)
+        ret = TaskPoolTask(replay_task_id, self.parent, self.handler, self.inputs, self.dependencies, self.expected_outputs, self.save_continuation, self.continues_task, self.replay_uuids, self.select_group, self.select_result, TASK_RUNNABLE, self.task_pool, None, self.resources)
         ret.original_task_id = self.task_id
         ret.replay_ref = replay_ref
         return ret
@@ -207,9 +271,11 @@ class TaskPoolTask(Task):
         descriptor['parent'] = self.parent.task_id if self.parent is not None else None
         
         if long:
-            descriptor['history'] = map(lambda (t, name): (time.mktime(t.timetuple()) + t.microsecond / 1e6, name), self.history)
+            descriptor['history'] = self.history
             if self.worker is not None:
                 descriptor['worker_id'] = self.worker.id
+            if self.backup_worker is not None:
+                descriptor['backup_worker_id'] = self.backup_worker.id
             descriptor['saved_continuation_uri'] = self.saved_continuation_uri
             descriptor['state'] = TASK_STATE_NAMES[self.state]
             descriptor['children'] = [x.task_id for x in self.children]
@@ -225,6 +291,8 @@ class TaskPoolTask(Task):
             descriptor['continuation'] = self.continuation
         if self.replay_uuids is not None:
             descriptor['replay_uuids'] = self.replay_uuids
+        if len(self.resources) > 0:
+            descriptor['resources'] = self.resources
             
         if self.original_task_id is not None:
             descriptor['original_task_id'] = self.original_task_id
@@ -264,9 +332,14 @@ def build_taskpool_task_from_descriptor(task_id, task_descriptor, task_pool, par
 
     replay_uuids = None
     
+    try:
+        resources = task_descriptor['resources']
+    except KeyError:
+        resources = None
+    
     state = TASK_CREATED
     
-    return TaskPoolTask(task_id, parent_task, handler, inputs, dependencies, expected_outputs, save_continuation, continues_task, replay_uuids, select_group, select_result, state, task_pool)
+    return TaskPoolTask(task_id, parent_task, handler, inputs, dependencies, expected_outputs, save_continuation, continues_task, replay_uuids, select_group, select_result, state, task_pool, None, resources)
 #
 #class Task:
 #    
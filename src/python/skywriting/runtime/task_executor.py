@@ -35,7 +35,7 @@ from skywriting.runtime.references import SWDataValue, SWURLReference,\
     SWErrorReference, SWNullReference, SW2_FutureReference,\
     SWTaskOutputProvenance, SW2_ConcreteReference,\
     SWSpawnedTaskProvenance, SWExecResultProvenance,\
-    SWSpawnExecArgsProvenance
+    SWSpawnExecArgsProvenance, SW2_SliceReference
 
 class TaskExecutorPlugin(AsynchronousExecutePlugin):
     
@@ -45,20 +45,43 @@ class TaskExecutorPlugin(AsynchronousExecutePlugin):
         self.master_proxy = master_proxy
         self.execution_features = execution_features
     
-        self.current_task_id = None
-        self.current_task_execution_record = None
+        # Mapping from task ID to execution record, for each task that is
+        # currently running on one of this worker's slots.
+        self.current_task_execution_records = {}
+        
+        # Set of task IDs that have been received from the master, but are
+        # waiting in the queue for a free slot.
+        self.queued_task_ids = set()
     
         self._lock = Lock()
     
     def abort_task(self, task_id):
         with self._lock:
-            if self.current_task_id == task_id:
-                self.current_task_execution_record.abort()
-            self.current_task_id = None
-            self.current_task_execution_record = None
+            if task_id in self.queued_task_ids:
+                # The task will be skipped when it reaches the head of the
+                # queue.
+                self.queued_task_ids.remove(task_id)
+                return
+            try:
+                execution_record = self.current_task_execution_records.pop(task_id)
+            except KeyError:
+                return
+            execution_record.abort()
+    
+    def receive_input(self, input=None):
+        with self._lock:
+            self.queued_task_ids.add(input['task_id'])
+        AsynchronousExecutePlugin.receive_input(self, input)
     
     def handle_input(self, input):
         handler = input['handler']
+        task_id = input['task_id']
+
+        with self._lock:
+            if task_id not in self.queued_task_ids:
+                cherrypy.log.error("Skipping aborted task %s" % (str(task_id), ), 'TASK', logging.INFO, False)
+                return
+            self.queued_task_ids.remove(task_id)
 
         if handler == 'swi':
             execution_record = SWInterpreterTaskExecutionRecord(input, self)
@@ -66,21 +89,22 @@ class TaskExecutorPlugin(AsynchronousExecutePlugin):
             execution_record = SWExecutorTaskExecutionRecord(input, self)
 
         with self._lock:
-            self.current_task_id = input['task_id']
-            self.current_task_execution_record = execution_record
+            self.current_task_execution_records[task_id] = execution_record
         
-        cherrypy.engine.publish("worker_event", "Start execution " + repr(input['task_id']) + " with handler " + input['handler'])
-        cherrypy.log.error("Starting task %s with handler %s" % (str(self.current_task_id), handler), 'TASK', logging.INFO, False)
+        cherrypy.engine.publish("worker_event", "Start execution " + repr(task_id) + " with handler " + handler)
+        cherrypy.log.error("Starting task %s with handler %s" % (str(task_id), handler), 'TASK', logging.INFO, False)
         try:
             execution_record.execute()
-            cherrypy.engine.publish("worker_event", "Completed execution " + repr(input['task_id']))
-            cherrypy.log.error("Completed task %s with handler %s" % (str(self.current_task_id), handler), 'TASK', logging.INFO, False)
+            cherrypy.engine.publish("worker_event", "Completed execution " + repr(task_id))
+            cherrypy.log.error("Completed task %s with handler %s" % (str(task_id), handler), 'TASK', logging.INFO, False)
         except:
-            cherrypy.log.error("Error in task %s with handler %s" % (str(self.current_task_id), handler), 'TASK', logging.ERROR, True)
+            cherrypy.log.error("Error in task %s with handler %s" % (str(task_id), handler), 'TASK', logging.ERROR, True)
 
         with self._lock:
-            self.current_task_id = None
-            self.current_task_execution_record = None
+            try:
+                del self.current_task_execution_records[task_id]
+            except KeyError:
+                pass
             
             
 class ReferenceTableEntry:
@@ -526,7 +550,7 @@ class SWRuntimeInterpreterTask:
                 if current_cont is not None:
                     spawned_cont_id = self.get_spawn_continuation_object_id(self.spawn_list[current_index].id)
                     _, size_hint = block_store.store_object(current_cont, 'pickle', spawned_cont_id)
-                    spawned_cont_ref = SW2_ConcreteReference(spawned_cont_id, SWSpawnedTaskProvenance(self.original_task_id, current_index), size_hint)
+                    spawned_cont_ref = SW2_ConcreteReference(spawned_cont_id, SWSpawnedTaskProvenance(self.original_task_id, current_index), size_hint, content_hash=block_store.get_content_hash(spawned_cont_id))
                     spawned_cont_ref.add_location_hint(self.block_store.netloc)
                     self.spawn_list[current_index].task_descriptor['dependencies']['_cont'] = spawned_cont_ref
                     self.maybe_also_publish(spawned_cont_ref)
@@ -574,7 +598,7 @@ class SWRuntimeInterpreterTask:
         if size_hint < 128:
             result_ref = SWDataValue(serializable_result)
         else:
-            result_ref = SW2_ConcreteReference(self.expected_outputs[0], SWTaskOutputProvenance(self.original_task_id, 0), size_hint)
+            result_ref = SW2_ConcreteReference(self.expected_outputs[0], SWTaskOutputProvenance(self.original_task_id, 0), size_hint, content_hash=block_store.get_content_hash(self.expected_outputs[0]))
             result_ref.add_location_hint(self.block_store.netloc)
             
         commit_bindings[self.expected_outputs[0]] = result_ref
@@ -700,7 +724,7 @@ class SWRuntimeInterpreterTask:
         
         transformed_args = map_leaf_values(args_check_mapper, args)
         _, size_hint = self.block_store.store_object(transformed_args, 'pickle', args_id)
-        args_ref = SW2_ConcreteReference(args_id, SWSpawnExecArgsProvenance(self.original_task_id, self.spawn_exec_counter), size_hint)
+        args_ref = SW2_ConcreteReference(args_id, SWSpawnExecArgsProvenance(self.original_task_id, self.spawn_exec_counter), size_hint, content_hash=self.block_store.get_content_hash(args_id))
         self.spawn_exec_counter += 1
         args_ref.add_location_hint(self.block_store.netloc)
         self.maybe_also_publish(args_ref)
@@ -711,7 +735,14 @@ class SWRuntimeInterpreterTask:
                            'handler': executor_name, 
                            'dependencies': inputs,
                            'expected_outputs': expected_output_ids}
-        
+
+        # The exec args may declare the resources that the task needs, so
+        # that the master can pack several tasks onto a multi-slot worker.
+        try:
+            task_descriptor['resources'] = args['resources']
+        except (KeyError, TypeError):
+            pass
+
         self.spawn_list.append(SpawnListEntry(new_task_id, task_descriptor))
         
         return ret
@@ -855,6 +886,10 @@ class SWRuntimeInterpreterTask:
         elif isinstance(value, SW2_ConcreteReference) or isinstance(value, SW2_FutureReference):
             hash.update('ref')
             hash.update(value.id)
+        elif isinstance(value, SW2_SliceReference):
+            hash.update('ref')
+            hash.update(value.id)
+            hash.update('[%d:%d]' % (value.start, value.end))
         elif isinstance(value, SWURLReference):
             hash.update('ref')
             hash.update(value.urls[0])
@@ -29,6 +29,7 @@ import datetime
 import simplejson
 import pickle
 import urlparse
+import urllib
 import httplib2
 import sys
 import os
@@ -41,6 +42,8 @@ def main():
     parser = OptionParser()
     parser.add_option("-m", "--master", action="store", dest="master", help="Master URI", metavar="MASTER", default=os.getenv("SW_MASTER"))
     parser.add_option("-i", "--id", action="store", dest="id", help="Job ID", metavar="ID", default="default")
+    parser.add_option("-p", "--priority", action="store", dest="priority", help="Priority class for the job (interactive, normal or batch)", metavar="CLASS", default="normal")
+    parser.add_option("-s", "--share", action="store", dest="share", help="Relative share of the cluster for the job", metavar="SHARE", type="float", default=1.0)
     parser.add_option("-e", "--env", action="store_true", dest="send_env", help="Set this flag to send the current environment with the script as _env", default=False)
     (options, args) = parser.parse_args()
    
@@ -88,7 +91,7 @@ def main():
     master_netloc = urlparse.urlparse(master_uri).netloc
     task_descriptor = {'dependencies': {'_cont' : SW2_ConcreteReference(cont_id, SWNoProvenance(), len(pickled_cont), [master_netloc])}, 'handler': 'swi'}
     
-    master_task_submit_uri = urlparse.urljoin(master_uri, "/job/")
+    master_task_submit_uri = urlparse.urljoin(master_uri, "/job/?%s" % urllib.urlencode({'priority': options.priority, 'share': options.share}))
     (_, content) = http.request(master_task_submit_uri, "POST", simplejson.dumps(task_descriptor, cls=SWReferenceJSONEncoder))
     
     print id, "SUBMITTED_JOB", now_as_timestamp() 
@@ -19,7 +19,8 @@ import simplejson
 import math
 import random
 import uuid
-from skywriting.runtime.references import SW2_ConcreteReference, SWNoProvenance
+from skywriting.runtime.references import SW2_ConcreteReference, SWNoProvenance,\
+    SW2_SliceReference
 from skywriting.runtime.block_store import SWReferenceJSONEncoder
 
 def get_worker_netlocs(master_uri):
@@ -135,6 +136,20 @@ def build_extent_list(filename, options):
 def select_targets(netlocs, num_replicas):
     assert num_replicas <= len(netlocs)
     return random.sample(netlocs, num_replicas)
+
+def select_targets_for_groups(netlocs, num_replicas, num_groups):
+    # Assigns the workers to the groups in a random rotation, so that the
+    # groups are spread evenly across all of the workers.
+    assert num_replicas <= len(netlocs)
+    shuffled_netlocs = random.sample(netlocs, len(netlocs))
+    return [[shuffled_netlocs[(i * num_replicas + j) % len(netlocs)] for j in range(num_replicas)] for i in range(num_groups)]
+
+def group_extents(extent_list, num_groups):
+    # Divides the extents into at most num_groups runs of consecutive extents.
+    if len(extent_list) == 0:
+        return []
+    num_groups = max(1, min(num_groups, len(extent_list)))
+    return [extent_list[i * len(extent_list) / num_groups:(i + 1) * len(extent_list) / num_groups] for i in range(num_groups)]
     
 def create_name_prefix(specified_name):
     if specified_name is None:
@@ -187,6 +202,8 @@ def main():
     parser.add_option("-l", "--lines", action="store_const", dest="delimiter", const="\n", help="Use newline as block delimiter")
     parser.add_option("-p", "--packet-size", action="store", dest="packet_size", help="Upload packet size in bytes", metavar="N", type="int",default=16384)
     parser.add_option("-i", "--id", action="store", dest="name", help="Block name prefix", metavar="NAME", default=None)
+    parser.add_option("-x", "--extent-blocks", action="store_true", dest="extent_blocks", help="Upload each extent as a separate block, instead of uploading runs of extents and referring to ranges of them", default=False)
+    parser.add_option("-g", "--groups", action="store", dest="groups", help="Number of blocks into which the extents are grouped (default: enough to use every worker)", metavar="N", type="int", default=None)
     (options, args) = parser.parse_args()
     
     workers = get_worker_netlocs(options.master)
@@ -199,14 +216,31 @@ def main():
     
     output_references = []
     
-    # Upload the data in extents.
     with open(input_filename, 'rb') as input_file:
-        for i, (start, finish) in enumerate(extent_list):
-            targets = select_targets(workers, options.replication)
-            block_name = make_block_id(name_prefix, i)
-            upload_extent_to_targets(input_file, block_name, start, finish, targets, options.packet_size)
-            conc_ref = SW2_ConcreteReference(block_name, SWNoProvenance(), finish - start, targets)
-            output_references.append(conc_ref)
+        if options.extent_blocks:
+            # Upload the data in extents.
+            for i, (start, finish) in enumerate(extent_list):
+                targets = select_targets(workers, options.replication)
+                block_name = make_block_id(name_prefix, i)
+                upload_extent_to_targets(input_file, block_name, start, finish, targets, options.packet_size)
+                conc_ref = SW2_ConcreteReference(block_name, SWNoProvenance(), finish - start, targets)
+                output_references.append(conc_ref)
+        else:
+            # Upload runs of consecutive extents as large blocks on different
+            # workers, and refer to each extent as a range of its block, so
+            # that splitting the input does not copy any data, but the
+            # extents are still spread across the cluster.
+            if options.groups is not None:
+                num_groups = options.groups
+            else:
+                num_groups = int(math.ceil(len(workers) / float(options.replication)))
+            groups = group_extents(extent_list, num_groups)
+            for i, (group, targets) in enumerate(zip(groups, select_targets_for_groups(workers, options.replication, len(groups)))):
+                group_start = group[0][0]
+                block_name = '%s:data:%d' % (name_prefix, i)
+                upload_extent_to_targets(input_file, block_name, group_start, group[-1][1], targets, options.packet_size)
+                for (start, finish) in group:
+                    output_references.append(SW2_SliceReference(block_name, start - group_start, finish - group_start, targets))
             
     # Upload the index object.
     index = simplejson.dumps(output_references, cls=SWReferenceJSONEncoder)
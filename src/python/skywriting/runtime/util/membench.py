@@ -0,0 +1,76 @@
+# Copyright (c) 2010 Derek Murray <derek.murray@cl.cam.ac.uk>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+'''
+Measures the memory used by the master's in-memory representations of tasks
+and references, in bytes per object.
+'''
+from __future__ import with_statement
+from optparse import OptionParser
+from skywriting.runtime.references import SW2_ConcreteReference,\
+    SW2_FutureReference, SWTaskOutputProvenance
+from skywriting.runtime.task import TaskPoolTask, TASK_BLOCKING, TASK_QUEUED,\
+    TASK_ASSIGNED, TASK_COMMITTED
+import gc
+import os
+import uuid
+
+def get_resident_bytes():
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+def make_refs(count, netlocs):
+    refs = []
+    for i in range(count):
+        hints = [netlocs[(i + j) % len(netlocs)] for j in range(3)]
+        refs.append(SW2_ConcreteReference(str(uuid.uuid1()), SWTaskOutputProvenance(str(uuid.uuid1()), 0), 1048576, hints))
+    return refs
+
+def make_tasks(count, netlocs):
+    tasks = []
+    for i in range(count):
+        task_id = str(uuid.uuid1())
+        dependencies = {'_args': SW2_FutureReference(str(uuid.uuid1())),
+                        '0': SW2_FutureReference(str(uuid.uuid1()))}
+        task = TaskPoolTask(task_id, None, 'stdinout', {}, dependencies, [str(uuid.uuid1())])
+        for state in (TASK_BLOCKING, TASK_QUEUED, TASK_ASSIGNED, TASK_COMMITTED):
+            task.set_state(state)
+        tasks.append(task)
+    return tasks
+
+def measure(factory, count, netlocs):
+    gc.collect()
+    before = get_resident_bytes()
+    objects = factory(count, netlocs)
+    gc.collect()
+    after = get_resident_bytes()
+    return float(after - before) / count, objects
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-n", "--count", action="store", dest="count", help="Number of objects of each kind to create", metavar="N", type="int", default=200000)
+    parser.add_option("-w", "--workers", action="store", dest="workers", help="Number of distinct worker netlocs", metavar="N", type="int", default=100)
+    (options, _) = parser.parse_args()
+    
+    netlocs = ['worker%d.example.com:8001' % i for i in range(options.workers)]
+    
+    ref_bytes, refs = measure(make_refs, options.count, netlocs)
+    print 'Bytes per SW2_ConcreteReference:', ref_bytes
+    del refs
+    
+    task_bytes, tasks = measure(make_tasks, options.count, netlocs)
+    print 'Bytes per TaskPoolTask (including 2 future references):', task_bytes
+    del tasks
+
+if __name__ == '__main__':
+    main()
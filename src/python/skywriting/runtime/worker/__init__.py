@@ -24,12 +24,15 @@ from skywriting.runtime.block_store import BlockStore
 from skywriting.runtime.worker.worker_view import WorkerRoot
 from skywriting.runtime.executors import ExecutionFeatures
 from skywriting.runtime.worker.pinger import Pinger
+from skywriting.runtime.worker.garbage_collector import BlockGarbageCollector
+from skywriting.runtime.worker.block_server import BlockServer
 from cherrypy.process import plugins
 import logging
 import tempfile
 import cherrypy
 import skywriting
 import httplib2
+import multiprocessing
 import os
 import socket
 import urlparse
@@ -57,14 +60,39 @@ class Worker(plugins.SimplePlugin):
             block_store_dir = tempfile.mkdtemp(prefix=os.getenv('TEMP', default='/tmp/sw-files-'))
         else:
             block_store_dir = options.blockstore
-        self.block_store = BlockStore(self.hostname, self.port, block_store_dir)
+        if options.object_cache_size is not None:
+            self.block_store = BlockStore(self.hostname, self.port, block_store_dir, options.object_cache_size * 1048576)
+        else:
+            self.block_store = BlockStore(self.hostname, self.port, block_store_dir)
+        # Stop the transfer engine after the task executor, which may be
+        # waiting for fetches to complete.
+        bus.subscribe('stop', self.block_store.transfer_engine.stop, 75)
+        if options.block_server_port is not None:
+            self.block_server = BlockServer(bus, self.block_store, self.hostname, options.block_server_port)
+        else:
+            self.block_server = BlockServer(bus, self.block_store, self.hostname)
+        self.block_server.subscribe()
         self.upload_manager = UploadManager(self.block_store)
         self.execution_features = ExecutionFeatures()
-        self.task_executor = TaskExecutorPlugin(bus, self.block_store, self.master_proxy, self.execution_features, 1)
+        if options.slots is not None:
+            self.slots = options.slots
+        else:
+            self.slots = 1
+        if options.prefetch is not None:
+            self.prefetch = options.prefetch
+        else:
+            self.prefetch = 0
+        self.task_executor = TaskExecutorPlugin(bus, self.block_store, self.master_proxy, self.execution_features, self.slots)
         self.task_executor.subscribe()
         self.server_root = WorkerRoot(self)
         self.pinger = Pinger(bus, self.master_proxy, None, 30)
         self.pinger.subscribe()
+        if options.gc_watermark is not None:
+            high_watermark = options.gc_watermark / 100.0
+            self.garbage_collector = BlockGarbageCollector(bus, self.block_store, self.master_proxy, high_watermark, high_watermark - 0.1)
+        else:
+            self.garbage_collector = BlockGarbageCollector(bus, self.block_store, self.master_proxy)
+        self.garbage_collector.subscribe()
         self.stopping = False
         self.event_log = []
         self.log_lock = Lock()
@@ -93,8 +121,24 @@ class Worker(plugins.SimplePlugin):
     def netloc(self):
         return '%s:%d' % (self.hostname, self.port)
 
+    def get_resources(self):
+        """
+        Returns the capacity of this worker as a resource vector, which the
+        master uses to pack tasks onto the worker's slots. Memory and scratch
+        disk are measured in megabytes.
+        """
+        resources = {'cpus': get_cpu_count()}
+        memory = get_physical_memory()
+        if memory is not None:
+            resources['memory'] = memory
+        disk = get_free_disk_space(self.block_store.base_dir)
+        if disk is not None:
+            resources['disk'] = disk
+        return resources
+
     def as_descriptor(self):
-        return {'netloc': self.netloc(), 'features': self.execution_features.all_features(), 'has_blocks': not self.block_store.is_empty()}
+        block_store_id, block_generation = self.block_store.get_block_log_position()
+        return {'netloc': self.netloc(), 'features': self.execution_features.all_features(), 'has_blocks': not self.block_store.is_empty(), 'block_store_id': block_store_id, 'block_generation': block_generation, 'slots': self.slots, 'prefetch': self.prefetch, 'resources': self.get_resources()}
 
     def set_master(self, master_details):
         self.master_url = master_details['master']
@@ -142,6 +186,25 @@ class Worker(plugins.SimplePlugin):
             if self.stopping:
                 raise Exception("Worker stopping")
 
+def get_cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+    
+def get_physical_memory():
+    try:
+        return (os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')) / 1048576
+    except (ValueError, OSError):
+        return None
+    
+def get_free_disk_space(path):
+    try:
+        stat = os.statvfs(path)
+        return (stat.f_bavail * stat.f_frsize) / 1048576
+    except OSError:
+        return None
+
 def worker_main(options):
     local_hostname = None
     if options.hostname is not None:
@@ -151,6 +214,10 @@ def worker_main(options):
     local_port = cherrypy.config.get('server.socket_port')
     assert(local_port)
     
+    # Each streaming fetch from this worker holds a server thread while it
+    # waits for the producer.
+    cherrypy.config.update({"server.thread_pool" : 50})
+
     w = Worker(cherrypy.engine, local_hostname, local_port, options)
     w.start_running()
 
@@ -0,0 +1,398 @@
+# Copyright (c) 2010 Derek Murray <derek.murray@cl.cam.ac.uk>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+from __future__ import with_statement
+from cherrypy.process import plugins
+from skywriting.runtime.block_store import drain_pipe
+from errno import EAGAIN, EWOULDBLOCK, EINTR
+import ctypes
+import ctypes.util
+import threading
+import cherrypy
+import logging
+import select
+import socket
+import time
+import os
+import re
+
+# A request is rejected if its headers are longer than MAX_REQUEST_BYTES. Each
+# call to sendfile() sends at most SENDFILE_CHUNK_SIZE bytes, so that one fast
+# consumer cannot starve the others. Connections with no activity for
+# IDLE_TIMEOUT seconds are closed. If accepting a connection fails (e.g.
+# because the process has run out of file descriptors), no connections are
+# accepted for ACCEPT_BACKOFF seconds.
+MAX_REQUEST_BYTES = 8192
+SENDFILE_CHUNK_SIZE = 1048576
+IDLE_TIMEOUT = 60
+ACCEPT_BACKOFF = 1.0
+
+range_regex = re.compile("^bytes=([0-9]*)-([0-9]*)$")
+
+def _libc_sendfile():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc_sendfile = libc.sendfile64
+    except (OSError, AttributeError):
+        return None
+    libc_sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    libc_sendfile.restype = ctypes.c_ssize_t
+    def sendfile(out_fd, in_fd, offset, count):
+        c_offset = ctypes.c_int64(offset)
+        sent = libc_sendfile(out_fd, in_fd, ctypes.byref(c_offset), count)
+        if sent < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return sent
+    return sendfile
+
+def _copy_sendfile(out_fd, in_fd, offset, count):
+    # Used where the platform has no sendfile(); the data passes through
+    # userspace, but the server remains single-threaded.
+    os.lseek(in_fd, offset, os.SEEK_SET)
+    data = os.read(in_fd, min(count, 65536))
+    return os.write(out_fd, data)
+
+sendfile = getattr(os, 'sendfile', None) or _libc_sendfile() or _copy_sendfile
+
+class BlockServer(plugins.SimplePlugin):
+    '''
+    Serves committed blocks over HTTP from a single thread, using sendfile()
+    to copy data from the block store directly to the socket. Supports
+    single byte-range requests (for striped and resumed fetches) and
+    persistent connections. Streaming blocks are still served by CherryPy,
+    which redirects requests for committed blocks here.
+    '''
+
+    def __init__(self, bus, block_store, hostname, port=0):
+        plugins.SimplePlugin.__init__(self, bus)
+        self.block_store = block_store
+        self.hostname = hostname
+        self.port = port
+        self.listen_socket = None
+        self.connections = {}
+        self.thread = None
+        self.is_running = False
+        self.wakeup_read, self.wakeup_write = None, None
+
+    def subscribe(self):
+        self.bus.subscribe('start', self.start, 75)
+        self.bus.subscribe('stop', self.stop)
+
+    def unsubscribe(self):
+        self.bus.unsubscribe('start', self.start)
+        self.bus.unsubscribe('stop', self.stop)
+
+    def netloc(self):
+        return '%s:%d' % (self.hostname, self.port)
+
+    def get_url_for_block(self, id):
+        return 'http://%s/data/%s' % (self.netloc(), id)
+
+    def start(self):
+        if self.thread is None:
+            self.listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.listen_socket.bind(('', self.port))
+            self.listen_socket.listen(128)
+            self.listen_socket.setblocking(0)
+            self.port = self.listen_socket.getsockname()[1]
+            self.wakeup_read, self.wakeup_write = os.pipe()
+            self.is_running = True
+            self.thread = threading.Thread(target=self.thread_main, args=())
+            self.thread.start()
+            cherrypy.log.error('Serving blocks at %s' % self.netloc(), 'BLOCK_SERVER', logging.INFO)
+
+    def stop(self):
+        # N.B. The thread clears is_running if it fails, so we check whether
+        #      it was started instead.
+        if self.thread is not None:
+            self.is_running = False
+            os.write(self.wakeup_write, 'X')
+            self.thread.join()
+            self.thread = None
+            for conn in self.connections.values():
+                conn.close()
+            self.connections = {}
+            self.listen_socket.close()
+            os.close(self.wakeup_read)
+            os.close(self.wakeup_write)
+
+    def thread_main(self):
+        try:
+            self.serve_connections()
+        except:
+            cherrypy.log.error('Block server failed: falling back to CherryPy', 'BLOCK_SERVER', logging.ERROR, True)
+        finally:
+            self.is_running = False
+
+    def serve_connections(self):
+        poller = select.poll()
+        poller.register(self.wakeup_read, select.POLLIN)
+        poller.register(self.listen_socket.fileno(), select.POLLIN)
+        registered_events = {}
+        accept_resume_time = None
+        while self.is_running:
+            try:
+                events = poller.poll(1000)
+            except select.error, e:
+                if e.args[0] == EINTR:
+                    continue
+                raise
+
+            for fd, event in events:
+                if fd == self.wakeup_read:
+                    drain_pipe(self.wakeup_read)
+                elif fd == self.listen_socket.fileno():
+                    if not self.accept_connections():
+                        poller.unregister(self.listen_socket.fileno())
+                        accept_resume_time = time.time() + ACCEPT_BACKOFF
+                else:
+                    try:
+                        conn = self.connections[fd]
+                    except KeyError:
+                        continue
+                    try:
+                        if event & (select.POLLERR | select.POLLHUP | select.POLLNVAL):
+                            conn.close()
+                        elif event & select.POLLOUT:
+                            conn.handle_write()
+                        elif event & select.POLLIN:
+                            conn.handle_read()
+                    except:
+                        cherrypy.log.error('Error serving blocks', 'BLOCK_SERVER', logging.WARNING, True)
+                        conn.close()
+
+            now = time.time()
+            if accept_resume_time is not None and now >= accept_resume_time:
+                poller.register(self.listen_socket.fileno(), select.POLLIN)
+                accept_resume_time = None
+            for fd, conn in self.connections.items():
+                if not conn.is_closed and now - conn.last_activity > IDLE_TIMEOUT:
+                    conn.close()
+                if conn.is_closed:
+                    del self.connections[fd]
+                    if fd in registered_events:
+                        poller.unregister(fd)
+                        del registered_events[fd]
+                    continue
+                wanted_event = select.POLLOUT if conn.wants_write() else select.POLLIN
+                if registered_events.get(fd) != wanted_event:
+                    if fd in registered_events:
+                        poller.modify(fd, wanted_event)
+                    else:
+                        poller.register(fd, wanted_event)
+                    registered_events[fd] = wanted_event
+
+    def accept_connections(self):
+        """
+        Accepts all pending connections. Returns False if a connection could
+        not be accepted, in which case the caller should back off.
+        """
+        while True:
+            try:
+                sock, _ = self.listen_socket.accept()
+            except socket.error, e:
+                if e.args[0] in (EAGAIN, EWOULDBLOCK, EINTR):
+                    return True
+                cherrypy.log.error('Error accepting block connection', 'BLOCK_SERVER', logging.WARNING, True)
+                return False
+            sock.setblocking(0)
+            conn = BlockConnection(self, sock)
+            self.connections[conn.fileno] = conn
+
+class BlockConnection:
+
+    def __init__(self, server, sock):
+        self.server = server
+        self.sock = sock
+        self.fileno = sock.fileno()
+        self.in_buffer = ''
+        self.out_buffer = ''
+        self.file = None
+        self.offset = 0
+        self.remaining = 0
+        self.keep_alive = True
+        self.is_closed = False
+        self.last_activity = time.time()
+
+    def wants_write(self):
+        return len(self.out_buffer) > 0 or self.file is not None
+
+    def close(self):
+        if not self.is_closed:
+            self.is_closed = True
+            self.close_file()
+            self.sock.close()
+
+    def close_file(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def handle_read(self):
+        try:
+            data = self.sock.recv(MAX_REQUEST_BYTES)
+        except socket.error, e:
+            if e.args[0] not in (EAGAIN, EWOULDBLOCK, EINTR):
+                self.close()
+            return
+        if len(data) == 0:
+            self.close()
+            return
+        self.last_activity = time.time()
+        self.in_buffer += data
+        self.process_request()
+
+    def handle_write(self):
+        try:
+            if len(self.out_buffer) > 0:
+                sent = self.sock.send(self.out_buffer)
+                self.out_buffer = self.out_buffer[sent:]
+                self.last_activity = time.time()
+                if len(self.out_buffer) > 0:
+                    return
+            if self.file is not None and self.remaining > 0:
+                sent = sendfile(self.fileno, self.file.fileno(), self.offset, min(self.remaining, SENDFILE_CHUNK_SIZE))
+                if sent == 0:
+                    # The block has been truncated underneath us, so we
+                    # cannot send the promised number of bytes.
+                    self.close()
+                    return
+                self.offset += sent
+                self.remaining -= sent
+                self.last_activity = time.time()
+        except (socket.error, OSError), e:
+            # The client may have closed the connection, e.g. when it
+            # cancels a stripe.
+            if e.args[0] not in (EAGAIN, EWOULDBLOCK, EINTR):
+                self.close()
+            return
+
+        if self.remaining == 0 and len(self.out_buffer) == 0:
+            self.close_file()
+            if self.keep_alive:
+                # The client may have pipelined another request.
+                self.process_request()
+            else:
+                self.close()
+
+    def process_request(self):
+        if self.wants_write():
+            return
+        header_end = self.in_buffer.find('\r\n\r\n')
+        if header_end == -1:
+            if len(self.in_buffer) > MAX_REQUEST_BYTES:
+                self.keep_alive = False
+                self.send_error(400, 'Bad Request')
+            return
+        request = self.in_buffer[:header_end]
+        self.in_buffer = self.in_buffer[header_end + 4:]
+
+        lines = request.split('\r\n')
+        request_line = lines[0].split()
+        if len(request_line) != 3:
+            self.keep_alive = False
+            self.send_error(400, 'Bad Request')
+            return
+        method, path, version = request_line
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        connection_header = headers.get('connection', '').lower()
+        if version == 'HTTP/1.1':
+            self.keep_alive = connection_header != 'close'
+        else:
+            self.keep_alive = connection_header == 'keep-alive'
+
+        if method not in ('GET', 'HEAD'):
+            self.send_error(405, 'Method Not Allowed')
+            return
+        path = path.split('?', 1)[0]
+        if not path.startswith('/data/') or '/' in path[6:] or len(path) == 6:
+            self.send_error(404, 'Not Found')
+            return
+        id = path[6:]
+
+        is_streaming, filename = self.server.block_store.maybe_streaming_filename(id)
+        if is_streaming:
+            # Only CherryPy can serve a block that is still being written.
+            self.send_response(302, 'Found', [('Location', 'http://%s/data/%s' % (self.server.block_store.netloc, id)), ('Content-Length', '0')])
+            return
+        try:
+            block_file = open(filename, 'rb')
+        except IOError:
+            self.send_error(404, 'Not Found')
+            return
+        size = os.fstat(block_file.fileno()).st_size
+
+        start, end = self.parse_range(headers.get('range'), size)
+        if start is None:
+            block_file.close()
+            self.send_error(416, 'Requested Range Not Satisfiable', [('Content-Range', 'bytes */%d' % size)])
+            return
+
+        response_headers = [('Content-Type', 'application/octet-stream'), ('Accept-Ranges', 'bytes'), ('Content-Length', str(end + 1 - start))]
+        if end + 1 - start == size:
+            self.send_response(200, 'OK', response_headers)
+        else:
+            response_headers.append(('Content-Range', 'bytes %d-%d/%d' % (start, end, size)))
+            self.send_response(206, 'Partial Content', response_headers)
+
+        if method == 'GET' and end >= start:
+            self.file = block_file
+            self.offset = start
+            self.remaining = end + 1 - start
+        else:
+            block_file.close()
+
+    def parse_range(self, range_header, size):
+        '''
+        Returns the first and last byte positions to send, or (None, None) if
+        the requested range is not satisfiable. Malformed and multiple ranges
+        are ignored, so the whole block is sent.
+        '''
+        if range_header is None:
+            return 0, size - 1
+        match_obj = range_regex.match(range_header.strip())
+        if match_obj is None or match_obj.group(1) == match_obj.group(2) == '':
+            return 0, size - 1
+        if match_obj.group(1) == '':
+            # A suffix range specifies the number of bytes at the end.
+            length = int(match_obj.group(2))
+            if length == 0:
+                return None, None
+            return max(0, size - length), size - 1
+        start = int(match_obj.group(1))
+        if start >= size:
+            return None, None
+        if match_obj.group(2) == '':
+            return start, size - 1
+        end = int(match_obj.group(2))
+        if end < start:
+            return 0, size - 1
+        return start, min(end, size - 1)
+
+    def send_response(self, status, reason, headers):
+        response = ['HTTP/1.1 %d %s' % (status, reason)]
+        for name, value in headers:
+            response.append('%s: %s' % (name, value))
+        if not self.keep_alive:
+            response.append('Connection: close')
+        response.append('\r\n')
+        self.out_buffer += '\r\n'.join(response)
+
+    def send_error(self, status, reason, headers=[]):
+        self.send_response(status, reason, headers + [('Content-Length', '0')])
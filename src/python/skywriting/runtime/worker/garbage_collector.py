@@ -0,0 +1,79 @@
+# Copyright (c) 2010 Derek Murray <derek.murray@cl.cam.ac.uk>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+from cherrypy.process import plugins
+from Queue import Queue, Empty
+from skywriting.runtime.plugins import THREAD_TERMINATOR
+import threading
+import cherrypy
+import logging
+
+class BlockGarbageCollector(plugins.SimplePlugin):
+    '''
+    Periodically checks the disk usage of the block store, and deletes dead
+    blocks and then replicas when it exceeds the high watermark. The master is
+    told which blocks have been deleted, so that it stops directing fetches
+    to this worker. A collection also runs when the master reports that some
+    blocks are dead.
+    '''
+
+    def __init__(self, bus, block_store, master_proxy, high_watermark=0.9, low_watermark=0.8, interval=30):
+        plugins.SimplePlugin.__init__(self, bus)
+        self.block_store = block_store
+        self.master_proxy = master_proxy
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.interval = interval
+        self.queue = Queue()
+        self.thread = None
+        self.is_running = False
+
+    def subscribe(self):
+        self.bus.subscribe('start', self.start, 75)
+        self.bus.subscribe('stop', self.stop)
+        self.bus.subscribe('collect_garbage', self.poke)
+
+    def unsubscribe(self):
+        self.bus.unsubscribe('start', self.start)
+        self.bus.unsubscribe('stop', self.stop)
+        self.bus.unsubscribe('collect_garbage', self.poke)
+
+    def start(self):
+        if not self.is_running:
+            self.is_running = True
+            self.thread = threading.Thread(target=self.thread_main, args=())
+            self.thread.start()
+
+    def stop(self):
+        if self.is_running:
+            self.is_running = False
+            self.queue.put(THREAD_TERMINATOR)
+            self.thread.join()
+
+    def poke(self):
+        self.queue.put(None)
+
+    def thread_main(self):
+        while True:
+            try:
+                if self.queue.get(timeout=self.interval) is THREAD_TERMINATOR:
+                    break
+            except Empty:
+                pass
+
+            try:
+                deleted_ids = self.block_store.collect_garbage(self.high_watermark, self.low_watermark)
+                if len(deleted_ids) > 0 and self.master_proxy.worker.id is not None:
+                    self.master_proxy.report_removed_blocks(deleted_ids)
+            except:
+                cherrypy.log.error('Error collecting garbage', 'GC', logging.WARNING, True)
@@ -111,12 +111,17 @@ class MasterProxy(SimplePlugin):
         if replay_uuid_list is not None:
             payload_dict['replay_uuids'] = map(str, replay_uuid_list)
         message_payload = simplejson.dumps(payload_dict, cls=SWReferenceJSONEncoder)
-        message_url = urljoin(self.master_url, 'task/%s/commit' % (str(task_id), ))
+        message_url = urljoin(self.master_url, 'task/%s/commit?worker_id=%s' % (str(task_id), str(self.worker.id)))
         self.backoff_request(message_url, "POST", message_payload)
         
     def failed_task(self, task_id, reason=None, details=None, bindings={}):
         message_payload = simplejson.dumps((reason, details, bindings), cls=SWReferenceJSONEncoder)
-        message_url = urljoin(self.master_url, 'task/%s/failed' % (str(task_id), ))
+        message_url = urljoin(self.master_url, 'task/%s/failed?worker_id=%s' % (str(task_id), str(self.worker.id)))
+        self.backoff_request(message_url, "POST", message_payload)
+
+    def report_removed_blocks(self, block_ids):
+        message_payload = simplejson.dumps(block_ids)
+        message_url = urljoin(self.master_url, 'worker/%s/blocks' % (str(self.worker.id), ))
         self.backoff_request(message_url, "POST", message_payload)
 
     def ping(self):
@@ -24,19 +24,32 @@ import sys
 import simplejson
 import cherrypy
 import os
+import re
 import time
 
+# Streaming responses push data in chunks of up to STREAM_CHUNK_SIZE bytes.
+# While waiting for the producer, we check for new data every
+# STREAM_POLL_INTERVAL seconds, and end the response if none arrives for
+# STREAM_IDLE_TIMEOUT seconds (the consumer will then ask again).
+STREAM_CHUNK_SIZE = 65536
+STREAM_POLL_INTERVAL = 0.05
+STREAM_IDLE_TIMEOUT = 30
+
+range_regex = re.compile("^bytes=([0-9]+)-([0-9]*)$")
+
 class WorkerRoot:
     
     def __init__(self, worker):
         self.worker = worker
         self.master = RegisterMasterRoot(worker)
         self.task = TaskRoot(worker)
-        self.data = DataRoot(worker.block_store)
+        self.data = DataRoot(worker.block_store, worker.block_server)
         self.features = FeaturesRoot(worker.execution_features)
         self.kill = KillRoot()
         self.log = LogRoot(worker)
         self.upload = UploadRoot(worker.upload_manager)
+        self.cache = CacheRoot(worker.block_store)
+        self.gc = GarbageCollectionRoot(worker.block_store)
     
     @cherrypy.expose
     def index(self):
@@ -76,7 +89,12 @@ class TaskRoot:
     def index(self):
         if cherrypy.request.method == 'POST':
             task_descriptor = simplejson.loads(cherrypy.request.body.read(), object_hook=json_decode_object_hook)
-            if task_descriptor is not None:
+            if isinstance(task_descriptor, list):
+                # The master may send a batch of task descriptors at once.
+                for descriptor in task_descriptor:
+                    self.worker.submit_task(descriptor)
+                return
+            elif task_descriptor is not None:
                 self.worker.submit_task(task_descriptor)
                 return
         raise cherrypy.HTTPError(405)
@@ -124,15 +142,37 @@ class LogRoot:
 
 class DataRoot:
     
-    def __init__(self, block_store):
+    def __init__(self, block_store, block_server=None):
         self.block_store = block_store
+        self.block_server = block_server
         
     @cherrypy.expose
-    def default(self, id):
+    def default(self, id, stream=None):
         safe_id = id
         if cherrypy.request.method == 'GET':
             is_streaming, filename = self.block_store.maybe_streaming_filename(safe_id)
-            if is_streaming:
+            if not is_streaming and self.block_server is not None and self.block_server.is_running and os.path.exists(filename):
+                # Committed blocks are sent by the block server, which does
+                # not tie up a thread for each transfer.
+                raise cherrypy.HTTPRedirect(self.block_server.get_url_for_block(safe_id), 302)
+            if is_streaming and stream is not None:
+                try:
+                    stream_file = open(filename, 'rb')
+                except IOError:
+                    # The block has been committed or rolled back since we
+                    # checked, so serve it (or a 404) as normal.
+                    is_streaming, filename = self.block_store.maybe_streaming_filename(safe_id)
+                    assert not is_streaming
+                    return serve_file(filename)
+                start, end = self.parse_range(cherrypy.request.headers.get('Range'))
+                cherrypy.response.status = 206
+                cherrypy.response.headers['Pragma'] = 'streaming'
+                cherrypy.response.headers['Content-Type'] = 'application/octet-stream'
+                if end is not None:
+                    cherrypy.response.headers['Content-Range'] = 'bytes %d-%d/*' % (start, end)
+                cherrypy.response.stream = True
+                return self.stream_generator(safe_id, stream_file, start, end)
+            elif is_streaming:
                 cherrypy.response.headers['Pragma'] = 'streaming'
             try:
                 response_body = serve_file(filename)
@@ -154,14 +194,85 @@ class DataRoot:
         else:
             raise cherrypy.HTTPError(405)
 
+    def parse_range(self, range_header):
+        if range_header is None:
+            return 0, None
+        match_obj = range_regex.match(range_header.strip())
+        if match_obj is None:
+            raise cherrypy.HTTPError(416)
+        if match_obj.group(2) == '':
+            return int(match_obj.group(1)), None
+        return int(match_obj.group(1)), int(match_obj.group(2))
+
+    def stream_generator(self, id, stream_file, start, end):
+        '''
+        Yields the data in the given range of a streaming block as the
+        producer writes it. The response ends when the range is complete, the
+        block is committed and all of its data has been sent, or the producer
+        is idle for too long. If the block is rolled back, the response is
+        aborted so that the consumer sees an incomplete transfer.
+        '''
+        try:
+            position = start
+            idle_since = time.time()
+            is_final_read = False
+            while end is None or position <= end:
+                stream_file.seek(position)
+                if end is None:
+                    data = stream_file.read(STREAM_CHUNK_SIZE)
+                else:
+                    data = stream_file.read(min(STREAM_CHUNK_SIZE, end + 1 - position))
+                if len(data) > 0:
+                    position += len(data)
+                    idle_since = time.time()
+                    yield data
+                elif is_final_read:
+                    break
+                elif not self.block_store.is_streaming(id):
+                    if not os.path.exists(self.block_store.filename(id)):
+                        raise Exception('Streaming block %s was rolled back' % id)
+                    # Read once more to get data that was written just
+                    # before the commit.
+                    is_final_read = True
+                elif time.time() - idle_since > STREAM_IDLE_TIMEOUT:
+                    break
+                else:
+                    self.block_store.wait_for_stream(id, STREAM_POLL_INTERVAL)
+        finally:
+            stream_file.close()
+
+    @cherrypy.expose
+    def batch(self):
+        if cherrypy.request.method == 'POST':
+            # The body is a list of block IDs; see BlockStore.batch_generator()
+            # for the response format.
+            ids = simplejson.loads(cherrypy.request.body.read())
+            cherrypy.response.headers['Content-Type'] = 'application/octet-stream'
+            cherrypy.response.stream = True
+            return self.block_store.batch_generator(ids)
+        else:
+            raise cherrypy.HTTPError(405)
+
     @cherrypy.expose
-    def index(self):
+    def index(self, since=None, store_id=None):
         if cherrypy.request.method == 'POST':
             id = self.block_store.allocate_new_id()
             self.block_store.store_raw_file(cherrypy.request.body, id)
             return simplejson.dumps(id)
         elif cherrypy.request.method == 'GET':
-            return serve_file(self.block_store.generate_block_list_file())
+            # The response is the block log, which the caller replays. If the
+            # caller has seen this block store up to a given generation, we
+            # send only the subsequent records.
+            block_store_id, generation = self.block_store.get_block_log_position()
+            if since is not None and store_id == block_store_id and 0 <= int(since) <= generation:
+                start = int(since)
+            else:
+                start = 0
+            cherrypy.response.headers['Content-Type'] = 'application/octet-stream'
+            cherrypy.response.headers['X-Block-Store-Id'] = block_store_id
+            cherrypy.response.headers['X-Block-Log-Start'] = str(start)
+            cherrypy.response.headers['X-Block-Generation'] = str(generation)
+            return self.block_store.block_log_generator(start, generation)
         else:
             raise cherrypy.HTTPError(405)
         
@@ -194,3 +305,27 @@ class FeaturesRoot:
     @cherrypy.expose
     def index(self):
         return simplejson.dumps(self.execution_features.all_features())
+
+class CacheRoot:
+    
+    def __init__(self, block_store):
+        self.block_store = block_store
+        
+    @cherrypy.expose
+    def index(self):
+        return simplejson.dumps(self.block_store.get_cache_stats())
+
+class GarbageCollectionRoot:
+    
+    def __init__(self, block_store):
+        self.block_store = block_store
+        
+    @cherrypy.expose
+    def index(self):
+        if cherrypy.request.method == 'POST':
+            # The master has told us that these blocks are dead.
+            block_ids = simplejson.loads(cherrypy.request.body.read())
+            self.block_store.mark_blocks_dead(block_ids)
+            cherrypy.engine.publish('collect_garbage')
+        else:
+            raise cherrypy.HTTPError(405)